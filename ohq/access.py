@@ -0,0 +1,125 @@
+"""
+Which queues each account is on the roster of, and in what role.
+
+Private-queue visibility used to take two roster queries per queue checked.
+Instead each account has an index: the ids of the queues it is staff and a
+student on, and whether it is a site admin. It is built with a few queries,
+kept in the shared cache as packed id arrays, and stored with a version
+number like the objects in ohq.caches. Each worker keeps an unpacked copy
+while the version is unchanged. Roster changes and admin toggles bump the
+versions of the accounts involved (see ohq.signals), so a visibility check
+is one shared-cache read and a set lookup.
+"""
+import time
+from array import array
+
+from django.core.cache import cache
+from django.db import transaction
+
+from ohq.caches import LRUCache
+from ohq.models import Account, Queue
+
+INDEX_TIMEOUT = 24 * 3600
+
+# the TTL only bounds how long an entry survives if the shared cache is flushed
+indexes = LRUCache(maxsize=5000, ttl=300)
+
+
+class Access:
+    """One account's roles. Immutable, so every caller can share it."""
+    __slots__ = ('account_id', 'admin', 'staff', 'students')
+
+    def __init__(self, account_id, admin, staff, students):
+        self.account_id = account_id
+        self.admin = admin # isAdmin or a superuser: staff everywhere
+        self.staff = staff # frozensets of queue ids
+        self.students = students
+
+    def is_staff(self, queue_id):
+        return self.admin or queue_id in self.staff
+
+    def can_view(self, queue):
+        """Whether the account may see and join `queue`."""
+        return queue.isPublic or self.is_staff(queue.id) or queue.id in self.students
+
+    def rostered(self):
+        """Ids of the queues the account is on the roster of."""
+        return self.staff | self.students
+
+
+def _version_key(account_id):
+    return f'ohq:access-version:{account_id}'
+
+
+def _index_key(account_id):
+    return f'ohq:access:{account_id}'
+
+
+def get_version(account_id):
+    version = cache.get(_version_key(account_id))
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(_version_key(account_id), version, None):
+            version = cache.get(_version_key(account_id), version)
+    return version
+
+
+def bump(account_ids, then=None):
+    """
+    Drops every worker's index for these accounts. Waits for the current
+    transaction to commit, so nobody rebuilds from the old rosters under the
+    new version. `then` runs right after, e.g. to tell the accounts' pages,
+    which would otherwise re-read the old index.
+    """
+    account_ids = list(account_ids)
+    def drop():
+        for account_id in account_ids:
+            indexes.delete(account_id)
+            try:
+                cache.incr(_version_key(account_id))
+            except ValueError:
+                get_version(account_id)
+        if then is not None:
+            then()
+    transaction.on_commit(drop)
+
+
+def _pack(ids):
+    return array('q', sorted(ids)).tobytes()
+
+
+def _unpack(data):
+    ids = array('q')
+    ids.frombytes(data)
+    return frozenset(ids)
+
+
+def _build(account_id):
+    row = Account.objects.filter(id=account_id).values_list('isAdmin', 'user__is_superuser').first()
+    if row is None:
+        return None
+    staff = Queue.allowedStaff.through.objects.filter(account_id=account_id).values_list('queue_id', flat=True)
+    students = Queue.allowedStudents.through.objects.filter(account_id=account_id).values_list('queue_id', flat=True)
+    return Access(account_id, row[0] or row[1], frozenset(staff), frozenset(students))
+
+
+def get(account):
+    """The Access of `account`, an Account or its id."""
+    account_id = getattr(account, 'id', account)
+    version = get_version(account_id)
+    item = indexes.get(account_id)
+    if item is not None and item[0] == version:
+        return item[1]
+
+    stored = cache.get(_index_key(account_id))
+    if stored is not None and stored['version'] == version:
+        access = Access(account_id, stored['admin'], _unpack(stored['staff']), _unpack(stored['students']))
+    else:
+        access = _build(account_id)
+        if access is None:
+            return Access(account_id, False, frozenset(), frozenset()) # no such account, nothing cached
+        cache.set(_index_key(account_id), {'version': version, 'admin': access.admin,
+                                           'staff': _pack(access.staff), 'students': _pack(access.students)},
+                  INDEX_TIMEOUT)
+    indexes.set(account_id, (version, access))
+    return access
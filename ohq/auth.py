@@ -0,0 +1,20 @@
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+
+from ohq import caches
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """
+    channels' AuthMiddleware, resolving the session's user through
+    ohq.caches instead of querying the user table on every connect.
+    """
+
+    async def resolve_scope(self, scope):
+        scope['user']._wrapped = await database_sync_to_async(caches.get_session_user)(scope['session'])
+
+
+# Drop-in replacement for channels.auth.AuthMiddlewareStack
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -0,0 +1,244 @@
+"""
+In-process caches for the objects every socket handshake needs: the
+session's User, its Account, and the Queue being opened.
+
+Entries live in a small per-process LRU, but each one is stored with a
+version number kept in the shared cache (Redis in production), and is only
+used while that version is unchanged. Saving or deleting a User, Account or
+Queue bumps its version (see ohq.signals), so every worker drops its copy on
+the next lookup. A lookup therefore costs one shared-cache read and no
+database queries while nothing changes.
+
+The same goes for the results of the roster and admin searches in the
+settings pages (see search_accounts).
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from channels.auth import _get_user_session_key
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.crypto import constant_time_compare
+
+from ohq import snapshots
+from ohq.models import Account, Queue
+
+
+class LRUCache:
+    """A small thread-safe least-recently-used cache with an optional TTL."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or (self.ttl is not None and time.monotonic() > item[1]):
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# the TTL only bounds how long an entry survives if the shared cache is flushed
+users = LRUCache(maxsize=5000, ttl=300)
+accounts = LRUCache(maxsize=5000, ttl=300)
+queues = LRUCache(maxsize=1000, ttl=300)
+
+
+def _user_version_key(user_id):
+    return f'ohq:user-version:{user_id}'
+
+
+def get_user_version(user_id):
+    version = cache.get(_user_version_key(user_id))
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(_user_version_key(user_id), version, None):
+            version = cache.get(_user_version_key(user_id), version)
+    return version
+
+
+def bump_user(user_id):
+    """Drops every worker's cached User and Account for this user."""
+    users.delete(user_id)
+    accounts.delete(user_id)
+    try:
+        cache.incr(_user_version_key(user_id))
+    except ValueError:
+        get_user_version(user_id)
+
+
+def _queue_page_version_key(queue_id):
+    return f'ohq:queue-page-version:{queue_id}'
+
+
+def get_queue_page_version(queue_id):
+    """
+    Version of what a queue's pages show about the queue itself (its
+    settings and roster). Template fragments are cached under it.
+    """
+    version = cache.get(_queue_page_version_key(queue_id))
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(_queue_page_version_key(queue_id), version, None):
+            version = cache.get(_queue_page_version_key(queue_id), version)
+    return version
+
+
+def bump_queue_page(queue_id):
+    try:
+        cache.incr(_queue_page_version_key(queue_id))
+    except ValueError:
+        get_queue_page_version(queue_id)
+
+
+# Account search: the settings pages search on every (debounced) keystroke
+SEARCH_LIMIT = 10 # results sent back
+SEARCH_CANDIDATES = 200 # matches kept per query, for narrowing down longer ones
+search_results = LRUCache(maxsize=1000, ttl=300)
+
+
+def _accounts_version_key():
+    return 'ohq:accounts-version'
+
+
+def get_accounts_version():
+    """Version of every account's nickname, email and isAdmin, as far as searches go."""
+    version = cache.get(_accounts_version_key())
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(_accounts_version_key(), version, None):
+            version = cache.get(_accounts_version_key(), version)
+    return version
+
+
+def bump_accounts():
+    try:
+        cache.incr(_accounts_version_key())
+    except ValueError:
+        get_accounts_version()
+
+
+def search_accounts(context, query, queryset, fields):
+    """
+    Up to SEARCH_LIMIT rows of `fields` (which include nickname and email)
+    for the accounts in `queryset` whose nickname or email contains `query`.
+    `context` names what the queryset excludes, along with the versions
+    that exclusion depends on (e.g. a queue's page version for its roster).
+
+    Results are cached per query. A query with a cached prefix is answered
+    from the prefix's matches: anything matching "alice" also matches
+    "alic", so when all of the prefix's matches were kept, narrowing them
+    down in memory finds every match without a database query.
+    """
+    query = query.strip().lower()
+    if not query:
+        return []
+    base = (context, get_accounts_version())
+    item = search_results.get((base, query)) or _narrow(base, query)
+    if item is None:
+        rows = list(queryset.filter(Q(nickname__icontains=query) | Q(email__icontains=query))
+                            .order_by('id').values(*fields)[:SEARCH_CANDIDATES + 1])
+        item = (rows[:SEARCH_CANDIDATES], len(rows) > SEARCH_CANDIDATES) # (matches, whether some were left out)
+    search_results.set((base, query), item)
+    return item[0][:SEARCH_LIMIT]
+
+
+def _narrow(base, query):
+    for end in range(len(query) - 1, 0, -1):
+        item = search_results.get((base, query[:end]))
+        if item is None:
+            continue
+        matches, partial = item
+        if partial:
+            return None # shorter prefixes match even more
+        return [row for row in matches if query in row['nickname'].lower() or query in row['email'].lower()], False
+    return None
+
+
+def _cached(lru, key, version, load):
+    # copies are handed out because consumers modify the objects they hold
+    item = lru.get(key)
+    if item is not None and item[0] == version:
+        return copy.copy(item[1])
+    value = load()
+    if value is not None: # misses aren't cached; creating a row doesn't always bump a version
+        lru.set(key, (version, value))
+    return copy.copy(value)
+
+
+def get_user(user_id, backend_path):
+    version = get_user_version(user_id)
+    return _cached(users, user_id, version, lambda: load_backend(backend_path).get_user(user_id))
+
+
+def get_account(user):
+    """Raises Account.DoesNotExist like Account.objects.get(user=user)."""
+    version = get_user_version(user.id)
+    account = _cached(accounts, user.id, version, lambda: Account.objects.filter(user_id=user.id).first())
+    if account is None:
+        raise Account.DoesNotExist
+    # share the caller's User instead of loading another copy through account.user
+    account.user = user
+    return account
+
+
+def get_queue(queue_id):
+    """Raises Queue.DoesNotExist like Queue.objects.get(id=queue_id)."""
+    # Queue saves and deletes bump the queue's snapshot version
+    version = snapshots.get_version(queue_id)
+    queue = _cached(queues, queue_id, version, lambda: Queue.objects.filter(id=queue_id).first())
+    if queue is None:
+        raise Queue.DoesNotExist
+    return queue
+
+
+def get_session_user(session):
+    """channels.auth.get_user, with the User coming from the caches above."""
+    user = None
+    try:
+        user_id = _get_user_session_key(session)
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        pass
+    else:
+        if backend_path in settings.AUTHENTICATION_BACKENDS:
+            user = get_user(user_id, backend_path)
+            # Verify the session
+            if hasattr(user, 'get_session_auth_hash'):
+                session_hash = session.get(HASH_SESSION_KEY)
+                session_hash_verified = session_hash and constant_time_compare(
+                    session_hash, user.get_session_auth_hash()
+                )
+                if not session_hash_verified:
+                    session.flush()
+                    user = None
+    return user or AnonymousUser()
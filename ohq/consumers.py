@@ -1,32 +1,108 @@
 from channels.generic.websocket import WebsocketConsumer
+from channels.generic.http import AsyncHttpConsumer
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
 from ohq.models import Account, AccountEntry, Queue
+from ohq import access, caches, estimates, livestate, presence, profiling, ratelimit, snapshots, traffic
 from django.utils import timezone
+from django.utils.http import parse_etags
+import asyncio
+import collections
 import json
-
-
-class QueueConsumer(WebsocketConsumer):
+import re
+import uuid
+from urllib.parse import parse_qs
+
+
+def reject_connect(consumer, retry_after):
+    # accept first so the client can read when to come back
+    consumer.accept()
+    consumer.send(text_data=json.dumps({'type': 'retry', 'retryAfter': retry_after}))
+    consumer.close(code=ratelimit.RETRY_CLOSE_CODE)
+
+
+async def send_later(channel_layer, channel_name, delay, message):
+    # schedules the send on the event loop, so the calling consumer doesn't wait
+    loop = asyncio.get_running_loop()
+    loop.call_later(delay, lambda: asyncio.ensure_future(channel_layer.send(channel_name, message)))
+
+
+class Heartbeat:
+    """
+    Application-level ping/pong for a socket (see ohq.presence). Consumers
+    call start_heartbeat() once they accept, stop_heartbeat() when they
+    disconnect, and received_pong() when the client answers a ping.
+    """
+    heartbeat_enabled = True
+
+    def start_heartbeat(self):
+        if self.heartbeat_enabled:
+            presence.connect(self.channel_name)
+            self.schedule_ping()
+
+    def stop_heartbeat(self):
+        if self.heartbeat_enabled:
+            presence.disconnect(self.channel_name)
+
+    def schedule_ping(self):
+        async_to_sync(send_later)(self.channel_layer, self.channel_name, presence.PING_INTERVAL, {'type': 'heartbeat_tick'})
+
+    def heartbeat_tick(self, event):
+        if not presence.is_connected(self.channel_name):
+            return # closed since this tick was scheduled
+        if presence.is_unresponsive(self.channel_name):
+            return self.reap()
+        for group in presence.groups(self.channel_name):
+            presence.publish(group)
+        self.send(text_data=json.dumps({'type': 'ping'}))
+        self.schedule_ping()
+
+    def received_pong(self):
+        presence.seen(self.channel_name)
+
+    # Leaves the groups now rather than when the close completes, which for a
+    # dead connection can take as long as the TCP timeout.
+    def reap(self):
+        for group in presence.groups(self.channel_name):
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+        presence.disconnect(self.channel_name)
+        self.close(code=presence.REAP_CLOSE_CODE)
+
+
+class QueueConsumer(Heartbeat, WebsocketConsumer):
     group_name = 'ohq_queue_group'
     channel_name = 'ohq_queue_channel'
 
     user = None
     account = None
     queue = None
+    limiter = None
+    sent_version = None # version of the last snapshot this socket was sent
+    refresh_pending = False # a rate-limited refresh waiting for the next snapshot
+    profile_messages = False # an admin opened this socket with ?profile=1
 
     def is_staff(self):
         if not self.account or not self.queue:
             return False
-        return self.account.isAdmin or self.queue.allowedStaff.filter(id=self.account.id).exists()
+        return access.get(self.account).is_staff(self.queue.id)
 
     def connect(self):
         self.id = self.scope['url_route']['kwargs']['id']
         self.group_name = QueueConsumer.group_name + f'_{self.id}'
+        retry_after = ratelimit.admit_connect(self.id)
+        if retry_after:
+            return reject_connect(self, retry_after)
+
         async_to_sync(self.channel_layer.group_add)(
             self.group_name, self.channel_name
         )
 
         self.accept()
+        self.start_heartbeat()
+        presence.join(self.channel_name, self.group_name)
 
         if not self.scope["user"].is_authenticated:
             self.send_error(f'You must be logged in')
@@ -35,14 +111,14 @@ class QueueConsumer(WebsocketConsumer):
         
         self.user = self.scope["user"]
         try:
-            self.account = Account.objects.get(user = self.user)
+            self.account = caches.get_account(self.user)
         except Account.DoesNotExist:
             self.send_error('Your OHQ account does not exist.')
             self.close()
             return
 
         try:
-            self.queue = Queue.objects.get(id=self.id)
+            self.queue = caches.get_queue(self.id)
         except Queue.DoesNotExist:
             self.send_error(f"queue {self.id} does not exist")
             self.close()
@@ -53,7 +129,9 @@ class QueueConsumer(WebsocketConsumer):
         #     self.close()
         #     return            
 
-        self.broadcast_queue_state()
+        traffic.record(traffic.QUEUE_CONSUMER, self.id, self.account, 'connect')
+        self.profile_messages = profiling.requested_by_socket(self.scope, self.account)
+        self.limiter = ratelimit.ActionLimiter(self.account.id)
         
         # Send user their specific account ID
         self.send(text_data=json.dumps({
@@ -61,11 +139,25 @@ class QueueConsumer(WebsocketConsumer):
             'my_account_id': self.account.id
         }))
 
+        # Only this socket needs the state, nothing changed for the rest of the
+        # group. A reconnecting client says which version it already has.
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            known_version = int(query['version'][0])
+        except (KeyError, ValueError):
+            known_version = None
+        self.send_queue_state(known_version)
+
     def disconnect(self, close_code):
         async_to_sync(self.channel_layer.group_discard)(
             self.group_name, self.channel_name
         )
+        presence.leave(self.channel_name, self.group_name)
+        self.stop_heartbeat()
+        if self.account:
+            traffic.record(traffic.QUEUE_CONSUMER, self.id, self.account, 'disconnect')
 
+    @profiling.profiled
     def receive(self, **kwargs):
         if 'text_data' not in kwargs:
             self.send_error('you must send text_data')
@@ -77,11 +169,23 @@ class QueueConsumer(WebsocketConsumer):
             self.send_error('invalid JSON sent to server')
             return
 
+        if data.get('type') == 'pong':
+            return self.received_pong()
+
         if 'action' not in data:
             self.send_error('action property not sent in JSON')
             return
 
         action = data['action']
+        traffic.record(traffic.QUEUE_CONSUMER, self.id, self.account, action, len(kwargs['text_data']))
+
+        if self.limiter is None: # connect failed, the socket is closing
+            return
+        wait = self.limiter.check(action)
+        if wait:
+            if action == 'refresh':
+                return self.defer_refresh(wait)
+            return self.send_error(f'You are doing that too often. Try again in {wait:.0f} seconds.')
 
         match action:
         # STUDENT ACTIONS
@@ -106,10 +210,13 @@ class QueueConsumer(WebsocketConsumer):
                 self.received_send_announcement(data)
             case 'freeze-all': 
                 self.received_freeze_all(data)
+            case 'batch-help' | 'batch-freeze' | 'batch-unfreeze' | 'batch-finish' | 'clear-queue':
+                self.received_batch(data, action)
             case _:
                 self.send_error(f'Invalid action property: "{action}"')
 
     # Currently only makes sure that isOpen status is up to date.
+    @profiling.profiled
     def queue_update(self, event):
         if 'model_data' not in event: return
         model_data = event['model_data']
@@ -120,8 +227,9 @@ class QueueConsumer(WebsocketConsumer):
             if not self.queue.isPublic: # refresh entire queue
                 self.queue = Queue.objects.get(id=self.queue.id)
                 # check whether user should be redirected to home
-                is_staff = self.queue.allowedStaff.filter(id=self.account.id).exists() or self.account.isAdmin or self.account.user.is_superuser
-                if (not (self.queue.allowedStudents.filter(id=self.account.id).exists() or is_staff)):
+                roles = access.get(self.account)
+                is_staff = roles.is_staff(self.queue.id)
+                if not roles.can_view(self.queue):
                     self.send(text_data=json.dumps({'type': 'redirect-home', 
                                                     'message': "You do not have permission to access this queue."}))
                 else:
@@ -130,11 +238,14 @@ class QueueConsumer(WebsocketConsumer):
                                                     'isStaff': is_staff}))
 
 
+    @profiling.profiled
     def queue_delete(self, event):
         self.send(text_data=json.dumps({'type': 'queue-deleted'}))
 
+    @profiling.profiled
     def refresh_account_entries(self, event):
-        self.broadcast_queue_state()
+        # every socket in the group gets this event, so each only updates itself
+        self.send_snapshot(snapshots.get(self.id))
 
     def received_ask_question(self, data):
         if 'text' not in data:
@@ -145,44 +256,60 @@ class QueueConsumer(WebsocketConsumer):
             self.send_error('The queue is closed. You cannot join at this time.')
             return
 
-        # Check if user is already in this queue
-        if AccountEntry.objects.filter(account=self.account, queue=self.queue).exists():
+        # None if the user is already in this queue
+        if livestate.create(self.queue, self.account, data['text']) is None:
             self.send_error('You are already on this queue.')
             return
-
-        AccountEntry.objects.create(
-            joinTime=timezone.now(),
-            account=self.account,
-            queue=self.queue,
-            question=data['text'],
-            status=AccountEntry.STATUS_WAITING
-        )
         
         self.broadcast_queue_state()
 
     def received_leave_queue(self, data):
         try:
-            entry = AccountEntry.objects.get(account=self.account, queue=self.queue)
-            entry.delete()
+            entry = livestate.find(self.queue, account=self.account)
         except AccountEntry.DoesNotExist:
             # User wasn't on queue, no action needed
-            pass
+            entry = None
+        if entry is not None and not livestate.delete(entry):
+            return self.send_error('Staff just updated your place on the queue. Please try again.')
         
         self.broadcast_queue_state()
 
     def received_unfreeze(self, data):
         try:
-            entry = AccountEntry.objects.get(account=self.account, queue=self.queue)
+            entry = livestate.find(self.queue, account=self.account)
             if entry.status == AccountEntry.STATUS_FROZEN:
                 entry.status = AccountEntry.STATUS_WAITING
                 entry.freezeTime = None
-                entry.save()
+                if not livestate.save(entry):
+                    return self.send_error('Staff just updated your place on the queue. Please try again.')
                 self.broadcast_queue_state()
         except AccountEntry.DoesNotExist:
             self.send_error('You are not on this queue.')
 
     def received_refresh(self, data):
-        self.broadcast_queue_state()
+        # Rebuilding the snapshot runs any auto-unfreeze that is due, and the
+        # group hears about a change through the version bump. Otherwise only
+        # this socket asked for the state.
+        before = snapshots.get_version(self.id)
+        if snapshots.get_fresh_version(self.id) == before:
+            self.send_snapshot(snapshots.get(self.id), force=True)
+
+    # Excess refreshes are answered by the next snapshot this socket is sent,
+    # or by one refresh once the bucket allows it, whichever comes first.
+    def defer_refresh(self, wait):
+        if self.refresh_pending:
+            return
+        self.refresh_pending = True
+        async_to_sync(send_later)(self.channel_layer, self.channel_name, wait, {
+            'type': 'deferred_refresh',
+            'stream': 'queue',
+            'queueID': self.id,
+        })
+
+    @profiling.profiled
+    def deferred_refresh(self, event):
+        if self.refresh_pending and self.limiter.check('refresh') == 0:
+            self.received_refresh({})
 
     def received_toggle_queue(self, data):
         if not self.is_staff():
@@ -192,6 +319,41 @@ class QueueConsumer(WebsocketConsumer):
         self.queue.save()
         self.broadcast_queue_state()
 
+    # Staff actions send the version of the entry they saw. If the entry has
+    # changed since (another staff member got there first), only this socket
+    # is told, with the entry as it is now.
+    def seen_version(self, data):
+        try:
+            return int(data['version'])
+        except (KeyError, TypeError, ValueError):
+            return None # older clients; the entry is still checked against the version read below
+
+    def find_for_staff(self, data):
+        """The entry a staff action is about, or None after telling the socket why not."""
+        version = self.seen_version(data)
+        try:
+            entry = livestate.find(self.queue, entry_id=data['entry_id'])
+        except AccountEntry.DoesNotExist:
+            if version is not None:
+                return self.send_conflict(data['entry_id']) # someone took them off the queue
+            return self.send_error('This entry does not exist in this queue.')
+        if version is not None and version != entry.version:
+            return self.send_conflict(data['entry_id'])
+        return entry
+
+    def send_conflict(self, entry_id):
+        livestate.record_action(self.id, conflicted=True)
+        try:
+            current = livestate.as_student(livestate.find(self.queue, entry_id=entry_id))
+        except AccountEntry.DoesNotExist:
+            current = None
+        self.send(text_data=json.dumps({
+            'type': 'conflict',
+            'entryID': entry_id,
+            'entry': current,
+            'error': 'Another staff member updated this student first.',
+        }))
+
     def received_update_status(self, data, new_status):
         if not self.is_staff():
             return self.send_error('You are not authorized to perform this action; you must be queue staff.')
@@ -199,23 +361,29 @@ class QueueConsumer(WebsocketConsumer):
         if 'entry_id' not in data:
             return self.send_error('"entry_id" not sent in JSON.')
         
-        try:
-            entry = AccountEntry.objects.get(id=data['entry_id'], queue=self.queue)
-            entry.status = new_status
+        entry = self.find_for_staff(data)
+        if entry is None:
+            return
+        entry.status = new_status
+        
+        if new_status == AccountEntry.STATUS_HELPING:
+            entry.helping_staff = self.account
+            entry.freezeTime = None # Unfreeze if they were frozen
+            entry.helpTime = timezone.now()
+        elif new_status == AccountEntry.STATUS_FROZEN:
+            entry.helping_staff = None
+            entry.freezeTime = timezone.now() # Set the freeze time
+            entry.helpTime = None
+        else:
+            entry.helping_staff = None # e.g. if set back to waiting
+            entry.freezeTime = None # Unfreeze
+            entry.helpTime = None
             
-            if new_status == AccountEntry.STATUS_HELPING:
-                entry.helping_staff = self.account
-                entry.freezeTime = None # Unfreeze if they were frozen
-            elif new_status == AccountEntry.STATUS_FROZEN:
-                entry.helping_staff = None
-                entry.freezeTime = timezone.now() # Set the freeze time
-            else:
-                entry.helping_staff = None # e.g. if set back to waiting
-                entry.freezeTime = None # Unfreeze
-                
-            entry.save()
-        except AccountEntry.DoesNotExist:
-            return self.send_error('This entry does not exist in this queue.')
+        if not livestate.save(entry): # changed since it was read
+            return self.send_conflict(data['entry_id'])
+        livestate.record_action(self.id, conflicted=False)
+        if new_status == AccountEntry.STATUS_HELPING:
+            estimates.record_help_started(self.queue.id, self.account.id)
         
         self.broadcast_queue_state()
 
@@ -226,14 +394,95 @@ class QueueConsumer(WebsocketConsumer):
         if 'entry_id' not in data:
             return self.send_error('"entry_id" not sent in JSON.')
         
-        try:
-            entry = AccountEntry.objects.get(id=data['entry_id'], queue=self.queue)
-            entry.delete()
-        except AccountEntry.DoesNotExist:
-            return self.send_error('This entry does not exist in this queue.')
+        entry = self.find_for_staff(data)
+        if entry is None:
+            return
+        if not livestate.delete(entry):
+            return self.send_conflict(data['entry_id'])
+        livestate.record_action(self.id, conflicted=False)
+        # keep the wait/help times now that the entry is gone
+        staff = entry.helping_staff or self.account
+        now = timezone.now()
+        livestate.archive(entry, staff, now)
+        help_seconds = (now - entry.helpTime).total_seconds() if entry.helpTime else None
+        estimates.record_help_finished(self.queue.id, staff.id, help_seconds)
         
         self.broadcast_queue_state()
 
+    # Batch actions act on several students at once ("entries": a list of
+    # {"entry_id", "version"}; for clear-queue, everyone the page shows) in
+    # one write and one broadcast. Students that changed since the staff
+    # member saw them are skipped and reported back as conflicts.
+    max_batch = 500
+
+    def received_batch(self, data, action):
+        if not self.is_staff():
+            return self.send_error('You are not authorized to perform this action; you must be queue staff.')
+
+        if not isinstance(data.get('entries'), list) or not data['entries']:
+            return self.send_error('"entries" must be a list of {"entry_id", "version"}.')
+        if len(data['entries']) > self.max_batch:
+            return self.send_error(f'You cannot act on more than {self.max_batch} students at once.')
+        versions = {}
+        for item in data['entries']:
+            try:
+                versions[int(item['entry_id'])] = self.seen_version(item)
+            except (KeyError, TypeError, ValueError):
+                return self.send_error('"entries" must be a list of {"entry_id", "version"}.')
+        wait = self.limiter.check('batch-entries', cost=len(versions))
+        if wait:
+            return self.send_error(f'You are doing that too often. Try again in {wait:.0f} seconds.')
+
+        now = timezone.now()
+        match action:
+            case 'batch-help':
+                staff = self.account
+                if data.get('staff_id') is not None:
+                    # help-and-assign: hand the students to another staff member
+                    try:
+                        staff_id = int(data['staff_id'])
+                    except (TypeError, ValueError):
+                        return self.send_error('"staff_id" must be an account id.')
+                    if not access.get(staff_id).is_staff(self.queue.id):
+                        return self.send_error('That account is not staff for this queue.')
+                    staff = Account.objects.get(id=staff_id)
+                done = livestate.update_many(self.queue, versions, status=AccountEntry.STATUS_HELPING,
+                                             helping_staff=staff, freezeTime=None, helpTime=now)
+                for entry in done:
+                    estimates.record_help_started(self.queue.id, staff.id)
+            case 'batch-freeze':
+                done = livestate.update_many(self.queue, versions, status=AccountEntry.STATUS_FROZEN,
+                                             helping_staff=None, freezeTime=now, helpTime=None)
+            case 'batch-unfreeze':
+                done = livestate.update_many(self.queue, versions,
+                                             match=lambda entry: entry.status == AccountEntry.STATUS_FROZEN,
+                                             status=AccountEntry.STATUS_WAITING, freezeTime=None)
+            case 'batch-finish' | 'clear-queue':
+                done = livestate.delete_many(self.queue, versions)
+                for entry in done:
+                    if action == 'clear-queue' and entry.status != AccountEntry.STATUS_HELPING:
+                        continue # never helped; nothing to archive
+                    staff = entry.helping_staff or self.account
+                    livestate.archive(entry, staff, now)
+                    help_seconds = (now - entry.helpTime).total_seconds() if entry.helpTime else None
+                    estimates.record_help_finished(self.queue.id, staff.id, help_seconds)
+
+        done_ids = [entry.id for entry in done]
+        written = set(done_ids)
+        conflicts = [entry_id for entry_id in versions if entry_id not in written]
+        for _ in done_ids:
+            livestate.record_action(self.id, conflicted=False)
+        for _ in conflicts:
+            livestate.record_action(self.id, conflicted=True)
+        self.send(text_data=json.dumps({
+            'type': 'batch-result',
+            'action': action,
+            'done': done_ids,
+            'conflicts': conflicts,
+        }))
+        if done_ids:
+            self.broadcast_queue_state()
+
     def received_send_announcement(self, data):
         if not self.is_staff():
             return self.send_error('You are not authorized to send an announcement; you must be queue staff.')
@@ -248,53 +497,75 @@ class QueueConsumer(WebsocketConsumer):
             return self.send_error('You are not authorized to freeze the queue; you must be queue staff.')
 
         # Find all waiting students and freeze them
-        # Set freezeTime to None to prevent auto-unfreezing
-        AccountEntry.objects.filter(
-            queue=self.queue,
-            status=AccountEntry.STATUS_WAITING
-        ).update(
-            status=AccountEntry.STATUS_FROZEN,
-            freezeTime=None # This prevents auto-unfreeze
-        )
+        livestate.freeze_all(self.queue)
         
         self.broadcast_queue_state()
 
     def send_error(self, error_message):
         self.send(text_data=json.dumps({'error': error_message}))
 
+    def send_queue_state(self, known_version=None):
+        message = snapshots.get(self.id)
+        if message['version'] == known_version:
+            self.sent_version = known_version
+            self.refresh_pending = False
+            self.send(text_data=json.dumps({'type': 'up-to-date', 'version': known_version}))
+        else:
+            self.send_snapshot(message)
+
+    def send_snapshot(self, message, force=False):
+        # several events can carry the same version, or one already superseded; the client needs neither
+        if self.sent_version is not None and message['version'] <= self.sent_version and not force:
+            return
+        self.sent_version = message['version']
+        self.refresh_pending = False
+        self.send(text_data=json.dumps(message))
+
     # This function will broadcast everything related to the queue state.
     def broadcast_queue_state(self):
-        timeout_seconds = self.queue.freeze_timeout
-        if timeout_seconds > 0: # Only run if auto-unfreeze is enabled
-            cutoff_time = timezone.now() - timezone.timedelta(seconds=timeout_seconds)
-            stale_entries = AccountEntry.objects.filter(
-                queue=self.queue,
-                status=AccountEntry.STATUS_FROZEN,
-                freezeTime__lt=cutoff_time # Only select entries with a non-null freezeTime
-            )
-            # Update them back to 'waiting'
-            stale_entries.update(status=AccountEntry.STATUS_WAITING, freezeTime=None)
-
         async_to_sync(self.channel_layer.group_send)(
             self.group_name,
             {
                 'type': 'broadcast_event',
-                'message': {
-                    'queue-status': self.queue.isOpen,
-                    'students': AccountEntry.get_all_students(self.id),
-                    'queue_freeze_timeout': self.queue.freeze_timeout,
-                },
+                'stream': 'queue',
+                'queueID': self.id,
+                'message': snapshots.get(self.id),
             }
         )
 
+    @profiling.profiled
     def broadcast_event(self, event):
-        self.send(text_data=json.dumps(event['message']))
+        message = event['message']
+        if self.sent_version is not None and message['version'] <= self.sent_version:
+            return # a newer snapshot already went out
+        behind = snapshots.get_version(self.id) - message['version']
+        if behind > 0:
+            if self.is_falling_behind(behind):
+                return
+            message = snapshots.get(self.id) # newer ones are queued behind this; send the newest now
+        self.send_snapshot(message)
+
+    # The server can't see a socket's outgoing buffer, but a consumer that
+    # can't keep up finds the group events piling up on its channel. Versions
+    # come from one counter per queue, so how far behind the event is needs
+    # no clock shared between workers. The late event is still answered with
+    # the newest snapshot, and the ones queued behind it are skipped; only a
+    # consumer that is far behind is closed, and the client reconnects and
+    # resumes from the version it has.
+    def is_falling_behind(self, behind):
+        if behind < ratelimit.SLOW_CONSUMER_BACKLOG:
+            return False
+        traffic.record(traffic.QUEUE_CONSUMER, self.id, self.account, 'slow-consumer')
+        self.close(code=ratelimit.SLOW_CONSUMER_CLOSE_CODE)
+        return True
 
     def broadcast_announcement(self, announcement_text):
         async_to_sync(self.channel_layer.group_send)(
             self.group_name,
             {
                 'type': 'announcement_event', # This type will be handled by announcement_event
+                'stream': 'queue',
+                'queueID': self.id,
                 'message': {
                     'type': 'announcement', # This type will be read by the client
                     'message': announcement_text
@@ -304,22 +575,308 @@ class QueueConsumer(WebsocketConsumer):
 
     # This handler is called when a message is received from the group
     # with type 'announcement_event'
+    @profiling.profiled
     def announcement_event(self, event):
         # Send the message payload directly to the client
         self.send(text_data=json.dumps(event['message']))
 
 
-class QueueListConsumer(WebsocketConsumer):
+class _QueueHttp:
+    """What the plain-HTTP queue consumers share: who is asking, and JSON errors."""
+
+    def load_account(self):
+        # (account, allowed), allowed is None when the queue doesn't exist
+        user = self.scope['user']
+        try:
+            account = caches.get_account(user)
+            queue = caches.get_queue(self.id)
+        except (Account.DoesNotExist, Queue.DoesNotExist):
+            return None, None
+        return account, access.get(account).can_view(queue)
+
+    async def send_error_response(self, status, error_message):
+        await self.send_response(status, json.dumps({'error': error_message}).encode(),
+                                 headers=[(b'Content-Type', b'application/json')])
+
+
+class QueueEventsConsumer(_QueueHttp, AsyncHttpConsumer):
+    """
+    Server-Sent Events stream of what QueueConsumer broadcasts, for networks
+    that break WebSockets. It joins the same queue group and forwards
+    snapshots, announcements and redirects as `data:` lines. It is read-only:
+    actions still go through the socket.
+    """
+    keepalive_seconds = 20 # proxies drop idle responses; a comment line keeps them open
+
+    account = None
+    keepalive = None
+    sent_version = None
+    streaming = False
+
+    async def http_request(self, message):
+        # AsyncHttpConsumer ends the response once handle() returns; keep this
+        # one open until the client goes away (http_disconnect)
+        if 'body' in message:
+            self.body.append(message['body'])
+        if not message.get('more_body'):
+            await self.handle(b''.join(self.body))
+            if not self.streaming:
+                await self.disconnect()
+                raise StopConsumer()
+
+    async def handle(self, body):
+        self.id = self.scope['url_route']['kwargs']['id']
+        self.group_name = QueueConsumer.group_name + f'_{self.id}'
+
+        retry_after = ratelimit.admit_connect(self.id)
+        if retry_after:
+            # an ended stream makes EventSource reconnect after its `retry` delay
+            await self.send_headers(headers=[(b'Content-Type', b'text/event-stream')])
+            return await self.send_body(f'retry: {int(retry_after * 1000)}\n\n'.encode())
+
+        if not self.scope['user'].is_authenticated:
+            return await self.send_error_response(403, 'You must be logged in')
+        self.account, allowed = await database_sync_to_async(self.load_account)()
+        if allowed is None:
+            return await self.send_error_response(404, f'queue {self.id} does not exist')
+        if not allowed:
+            return await self.send_error_response(403, 'You do not have permission to access this queue.')
+
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'),
+            (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no'), # stop nginx from buffering the stream
+        ])
+        self.streaming = True
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        traffic.record(traffic.QUEUE_CONSUMER, self.id, self.account, 'connect-sse')
+        await self.send_event({'type': 'connection_established', 'my_account_id': self.account.id})
+        await self.send_snapshot()
+        self.keepalive = asyncio.create_task(self.send_keepalives())
+
+    async def disconnect(self):
+        if self.keepalive:
+            self.keepalive.cancel()
+        if self.streaming:
+            self.streaming = False
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            traffic.record(traffic.QUEUE_CONSUMER, self.id, self.account, 'disconnect-sse')
+
+    async def finish(self):
+        # end the response and stop the consumer without waiting for the client
+        await self.send_body(b'')
+        await self.disconnect()
+        raise StopConsumer()
+
+    async def send_event(self, message):
+        await self.send_body(f'data: {json.dumps(message)}\n\n'.encode(), more_body=True)
+
+    async def send_keepalives(self):
+        while True:
+            await asyncio.sleep(self.keepalive_seconds)
+            await self.send_body(b': keepalive\n\n', more_body=True)
+
+    async def send_snapshot(self, message=None):
+        if message is None:
+            message = await database_sync_to_async(snapshots.get)(self.id)
+        # the socket consumers in the group may broadcast the same version several times
+        if message.get('version') is not None and message['version'] == self.sent_version:
+            return
+        self.sent_version = message.get('version')
+        await self.send_event(message)
+
+    # Group events, mirroring QueueConsumer's handlers
+
+    async def broadcast_event(self, event):
+        await self.send_snapshot(event['message'])
+
+    async def refresh_account_entries(self, event):
+        # unlike the socket consumers, don't rebroadcast; the snapshot is cached
+        await self.send_snapshot()
+
+    async def queue_update(self, event):
+        if not event.get('model_data', {}).get('queue-publicity', True):
+            _, allowed = await database_sync_to_async(self.load_account)()
+            if not allowed:
+                await self.send_event({'type': 'redirect-home',
+                                       'message': 'You do not have permission to access this queue.'})
+                return await self.finish()
+        await self.send_snapshot()
+
+    async def queue_delete(self, event):
+        await self.send_event({'type': 'queue-deleted'})
+        await self.finish()
+
+    async def announcement_event(self, event):
+        await self.send_event(event['message'])
+
+
+class QueueStateConsumer(_QueueHttp, AsyncHttpConsumer):
+    """
+    The snapshot the queue socket broadcasts, for clients that only poll
+    (kiosk displays, scripts). Answers 304 while the ETag still matches, and
+    with ?wait=<seconds> parks until the queue changes before answering.
+    Served by channels rather than a Django view: Django's middleware
+    includes sync-only WhiteNoise, which would hold a thread for every
+    parked request.
+    """
+    max_wait = 30 # longest a long-poll request is held open
+    recheck = 5 # how often a parked request rechecks for timed-out freezes, which send no message
+
+    async def handle(self, body):
+        self.id = self.scope['url_route']['kwargs']['id']
+        if not self.scope['user'].is_authenticated:
+            return await self.send_error_response(403, 'You must be logged in')
+        _, allowed = await database_sync_to_async(self.load_account)()
+        if allowed is None:
+            return await self.send_error_response(404, f'Queue {self.id} does not exist')
+        if not allowed:
+            return await self.send_error_response(403, 'You do not have permission to access this queue.')
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            wait = min(float(query.get('wait', [0])[0]), self.max_wait)
+        except ValueError:
+            return await self.send_error_response(400, 'wait must be a number of seconds.')
+
+        headers = dict(self.scope['headers'])
+        known = parse_etags(headers.get(b'if-none-match', b'').decode('latin-1'))
+
+        def unchanged(version):
+            return f'"{version}"' in known or '*' in known
+
+        try:
+            version = await database_sync_to_async(snapshots.get_fresh_version)(self.id)
+            if wait > 0 and unchanged(version):
+                version = await self.wait_for_version(version, wait)
+            if unchanged(version):
+                status, body = 304, b''
+            else:
+                message = await database_sync_to_async(snapshots.get)(self.id)
+                version = message['version']
+                status, body = 200, json.dumps(message).encode()
+        except Queue.DoesNotExist:
+            return await self.send_error_response(404, f'Queue {self.id} does not exist')
+        await self.send_response(status, body, headers=[
+            (b'Content-Type', b'application/json'),
+            (b'ETag', f'"{version}"'.encode()),
+            (b'Cache-Control', b'private, no-cache'),
+        ])
+
+    async def wait_for_version(self, version, wait):
+        # Listen on the queue's socket group: every change to the queue is
+        # followed by a message there, so no polling of the version is needed.
+        group_name = QueueConsumer.group_name + f'_{self.id}'
+        channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(group_name, channel_name)
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + wait
+            # the version may have moved before we joined the group
+            current = await database_sync_to_async(snapshots.get_fresh_version)(self.id)
+            while current == version and loop.time() < deadline:
+                try:
+                    await asyncio.wait_for(self.channel_layer.receive(channel_name),
+                                           min(deadline - loop.time(), self.recheck))
+                except asyncio.TimeoutError:
+                    pass
+                current = await database_sync_to_async(snapshots.get_fresh_version)(self.id)
+            return current
+        finally:
+            await self.channel_layer.group_discard(group_name, channel_name)
+
+
+class QueueListConsumer(Heartbeat, WebsocketConsumer):
+    # Home pages are split into groups by what they can show: the public
+    # catalogue, each course the user is on the roster of, each queue they
+    # pinned, all queues for admins, and one group per account for the user's
+    # own tabs. A change to a queue is sent only to that queue's groups.
     group_name = 'ohq_queue_list_group'
     channel_name = 'ohq_queue_listchannel'
 
+    interest_groups_joined = None # the groups this socket is in (channels itself acts on `groups`)
+    seen_events = None # ids of the group events already handled, see queue_groups()
+    profile_messages = False # an admin opened this socket with ?profile=1
+
+    @classmethod
+    def public_group(cls):
+        return cls.group_name + '_public'
+
+    @classmethod
+    def admin_group(cls):
+        return cls.group_name + '_admin'
+
+    @classmethod
+    def course_group(cls, course_number):
+        # group names may only have ASCII letters, digits, hyphens, underscores and periods
+        return cls.group_name + '_course_' + re.sub(r'[^A-Za-z0-9]', '', course_number)
+
+    @classmethod
+    def pinned_group(cls, queue_id):
+        return cls.group_name + f'_pinned_{queue_id}'
+
+    @classmethod
+    def account_group(cls, account_id):
+        return cls.group_name + f'_account_{account_id}'
+
+    @classmethod
+    def task_reply(cls, account_id):
+        """enqueue() arguments that send a task's progress to the account's home pages."""
+        return {'reply_group': cls.account_group(account_id), 'reply_tag': {'stream': 'queue-list'}}
+
+    @classmethod
+    def queue_groups(cls, queue_id, course_number, is_public):
+        """Every group with home pages that show this queue."""
+        groups = {cls.admin_group(), cls.course_group(course_number), cls.pinned_group(queue_id)}
+        if is_public:
+            groups.add(cls.public_group())
+        return groups
+
+    @classmethod
+    def notify(cls, groups, event):
+        # A page in several of the groups gets the event once from each, so
+        # they all share an id and the page handles only the first.
+        channel_layer = get_channel_layer()
+        event = dict(event, stream='queue-list', eventID=uuid.uuid4().hex)
+        for group in groups:
+            async_to_sync(channel_layer.group_send)(group, event)
+
+    def interest_groups(self):
+        """The groups this user's home page belongs in."""
+        groups = {self.public_group(), self.account_group(self.account.id)}
+        roles = access.get(self.account)
+        if roles.admin:
+            groups.add(self.admin_group())
+        courses = Queue.objects.filter(id__in=roles.rostered()).values_list('courseNumber', flat=True).distinct()
+        groups.update(self.course_group(course) for course in courses)
+        groups.update(self.pinned_group(queue_id) for queue_id in self.account.pinned.values_list('id', flat=True))
+        return groups
+
+    def join_groups(self):
+        groups = self.interest_groups()
+        for group in groups - self.interest_groups_joined:
+            async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
+            presence.join(self.channel_name, group)
+        for group in self.interest_groups_joined - groups:
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+            presence.leave(self.channel_name, group)
+        self.interest_groups_joined = groups
+
+    def is_duplicate(self, event):
+        if 'eventID' not in event:
+            return False
+        if event['eventID'] in self.seen_events:
+            return True
+        self.seen_events.append(event['eventID'])
+        return False
+
     def connect(self):
-        self.group_name = QueueListConsumer.group_name
-        async_to_sync(self.channel_layer.group_add)(
-            self.group_name, self.channel_name
-        )
+        retry_after = ratelimit.admit_connect()
+        if retry_after:
+            return reject_connect(self, retry_after)
 
         self.accept()
+        self.start_heartbeat()
 
         if not self.scope["user"].is_authenticated:
             self.send_error(f'You must be logged in')
@@ -333,22 +890,43 @@ class QueueListConsumer(WebsocketConsumer):
 
         self.user = self.scope["user"]
         try:
-            self.account = Account.objects.get(user = self.user)
+            self.account = caches.get_account(self.user)
         except Account.DoesNotExist:
             self.send_error('Your OHQ account does not exist.')
             self.close()
             return
 
+        self.interest_groups_joined = set()
+        self.seen_events = collections.deque(maxlen=50)
+        self.join_groups()
+
         self.last_sort_type = 'name' # what this user has their courses sorted by
         self.query = '' # current query, if any
-        self.broadcast_queue_list_state()
+        traffic.record(traffic.QUEUE_LIST_CONSUMER, None, self.account, 'connect')
+        self.profile_messages = profiling.requested_by_socket(self.scope, self.account)
+        # only this socket needs its lists; don't send them through the whole group
+        pinned, all_queues = Queue.get_queues(self.account)
+        self.send(text_data=json.dumps({
+            'userID': str(self.user.id),
+            'pinned': pinned,
+            'queues': all_queues,
+        }))
 
     def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.group_name, self.channel_name
-        )
-
+        for group in self.interest_groups_joined or ():
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+            presence.leave(self.channel_name, group)
+        self.interest_groups_joined = set()
+        self.stop_heartbeat()
+        if getattr(self, 'account', None):
+            traffic.record(traffic.QUEUE_LIST_CONSUMER, None, self.account, 'disconnect')
+
+    @profiling.profiled
     def queue_add(self, event):
+        if self.is_duplicate(event):
+            return
+        # the change may have moved this user in or out of a course (or made them admin)
+        self.join_groups()
         # re-broadcast whatever the main queue list section view is like
         if len(self.query) == 0:
             print("self.last_sort_type")
@@ -359,12 +937,19 @@ class QueueListConsumer(WebsocketConsumer):
         self.broadcast_pinned()
 
     # A queue has been deleted
+    @profiling.profiled
     def queue_delete(self, event):
         print('dele')
-        if 'queueID' not in event:
+        if 'queueID' not in event or self.is_duplicate(event):
             return
         self.send(text_data=json.dumps({'type': 'queue-delete', 'queueID': event['queueID']}))
 
+    # progress of a background task this user started (see ohq/tasks.py)
+    @profiling.profiled
+    def task_progress(self, event):
+        self.send(text_data=json.dumps(dict(event['status'], type='task')))
+
+    @profiling.profiled
     def receive(self, **kwargs):
         if 'text_data' not in kwargs:
             self.send_error('you must send text_data')
@@ -376,6 +961,9 @@ class QueueListConsumer(WebsocketConsumer):
             self.send_error('invalid JSON sent to server')
             return
 
+        if data.get('type') == 'pong':
+            return self.received_pong()
+
         if 'action' not in data:
             self.send_error('action property not sent in JSON')
             return
@@ -390,6 +978,7 @@ class QueueListConsumer(WebsocketConsumer):
         if userID != self.user.id: 
             print(repr(userID), repr(self.user.id))
             return
+        traffic.record(traffic.QUEUE_LIST_CONSUMER, None, self.account, action, len(kwargs['text_data']))
 
         # i.e. searching, filters, sorting, pinning...
         match action:
@@ -416,7 +1005,7 @@ class QueueListConsumer(WebsocketConsumer):
             self.account.pinned.remove(queue)
         else:
             self.account.pinned.add(queue)
-        self.account.save()
+        self.join_groups()
         self.broadcast_pinned()
 
     def received_search(self, data):
@@ -454,9 +1043,10 @@ class QueueListConsumer(WebsocketConsumer):
 
     def broadcast_sort(self, queues):
         async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
+            self.account_group(self.account.id),
             {
                 'type': 'broadcast_event',
+                'stream': 'queue-list',
                 'message': {
                     'userID': str(self.user.id),
                     'queues': queues,
@@ -467,9 +1057,10 @@ class QueueListConsumer(WebsocketConsumer):
     def broadcast_search(self, query):
         results = Queue.get_queues_from_search(self.account, query)
         async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
+            self.account_group(self.account.id),
             {
                 'type': 'broadcast_event',
+                'stream': 'queue-list',
                 'message': {
                     'userID': str(self.user.id),
                     'queues': results,
@@ -480,9 +1071,10 @@ class QueueListConsumer(WebsocketConsumer):
     def broadcast_pinned(self):
         pinned, _ = Queue.get_queues(self.account)
         async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
+            self.account_group(self.account.id),
             {
                 'type': 'broadcast_event',
+                'stream': 'queue-list',
                 'message': {
                     'userID': str(self.user.id),
                     'pinned': pinned,
@@ -493,9 +1085,10 @@ class QueueListConsumer(WebsocketConsumer):
     def broadcast_queue_list_state(self):
         pinned, all_queues = Queue.get_queues(self.account)
         async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
+            self.account_group(self.account.id),
             {
                 'type': 'broadcast_event',
+                'stream': 'queue-list',
                 'message': {
                     'userID': str(self.user.id),
                     'pinned': pinned,
@@ -504,5 +1097,182 @@ class QueueListConsumer(WebsocketConsumer):
             }
         )
 
+    @profiling.profiled
     def broadcast_event(self, event):
-        self.send(text_data=json.dumps(event['message']))
\ No newline at end of file
+        self.send(text_data=json.dumps(event['message']))
+
+class _Stream:
+    """
+    Runs a consumer's logic as one stream of a MultiplexConsumer: it shares
+    the parent's socket and channel, and everything it sends is tagged with
+    the stream it belongs to. The parent runs the socket's heartbeat.
+    """
+    heartbeat_enabled = False
+
+    def __init__(self, parent, scope, tag):
+        super().__init__()
+        self.parent = parent
+        self.scope = scope
+        self.tag = tag
+        self.channel_layer = parent.channel_layer
+        self.channel_name = parent.channel_name
+
+    def accept(self, subprotocol=None, headers=None):
+        pass # the parent socket is already open
+
+    def send(self, text_data=None, bytes_data=None, close=False):
+        message = json.loads(text_data)
+        message.update(self.tag)
+        self.parent.send(text_data=json.dumps(message))
+
+    def close(self, code=None, reason=None):
+        self.parent.close_stream(self)
+
+
+class QueueStream(_Stream, QueueConsumer):
+    pass
+
+
+class QueueListStream(_Stream, QueueListConsumer):
+    pass
+
+
+class MultiplexConsumer(Heartbeat, WebsocketConsumer):
+    """
+    One socket for the queue list and any number of queues. Clients send
+
+        {"subscribe": "queue", "queueID": 3}    {"unsubscribe": "queue", "queueID": 3}
+        {"subscribe": "queue-list"}             {"unsubscribe": "queue-list"}
+
+    and then the usual actions of that stream with its tag added, e.g.
+    {"stream": "queue", "queueID": 3, "action": "help", "entry_id": 7}.
+    Everything sent back carries the same "stream" (and "queueID") tag.
+    """
+    max_streams = 20
+
+    streams = None
+
+    def connect(self):
+        retry_after = ratelimit.admit_connect()
+        if retry_after:
+            return reject_connect(self, retry_after)
+        self.accept()
+        self.start_heartbeat()
+
+        if not self.scope["user"].is_authenticated:
+            self.send_error(f'You must be logged in')
+            self.close()
+            return
+
+        self.streams = {}
+
+    def disconnect(self, close_code):
+        for stream in list((self.streams or {}).values()):
+            stream.disconnect(close_code)
+        self.streams = {}
+        self.stop_heartbeat()
+
+    def receive(self, **kwargs):
+        if self.streams is None:
+            return
+        if 'text_data' not in kwargs:
+            self.send_error('you must send text_data')
+            return
+
+        try:
+            data = json.loads(kwargs['text_data'])
+        except json.JSONDecodeError:
+            self.send_error('invalid JSON sent to server')
+            return
+
+        if data.get('type') == 'pong':
+            return self.received_pong()
+        if 'subscribe' in data:
+            return self.received_subscribe(data)
+        if 'unsubscribe' in data:
+            return self.received_unsubscribe(data)
+
+        key = self.stream_key(data.get('stream'), data.get('queueID'))
+        if key not in self.streams:
+            return self.send_error('You are not subscribed to that stream.')
+        # the queue list's own actions use queueID (e.g. pin), so only the stream tag is removed
+        data.pop('stream')
+        self.streams[key].receive(text_data=json.dumps(data))
+
+    def stream_key(self, kind, queue_id):
+        if kind == 'queue':
+            try:
+                return ('queue', int(queue_id))
+            except (TypeError, ValueError):
+                return None
+        if kind == 'queue-list':
+            return ('queue-list', None)
+        return None
+
+    def received_subscribe(self, data):
+        key = self.stream_key(data['subscribe'], data.get('queueID'))
+        if key is None:
+            return self.send_error('Invalid stream to subscribe to.')
+        if key in self.streams:
+            return
+        if len(self.streams) >= self.max_streams:
+            return self.send_error(f'You cannot follow more than {self.max_streams} streams at once.')
+
+        kind, queue_id = key
+        if kind == 'queue':
+            # a private queue streams only to its roster (and admins), like the queue page
+            if not self.can_view(queue_id):
+                return self.send(text_data=json.dumps({
+                    'type': 'stream-closed', 'stream': kind, 'queueID': queue_id,
+                    'error': 'You do not have permission to access this queue.',
+                }))
+            scope = dict(self.scope, url_route={'args': (), 'kwargs': {'id': queue_id}})
+            stream = QueueStream(self, scope, {'stream': kind, 'queueID': queue_id})
+        else:
+            stream = QueueListStream(self, self.scope, {'stream': kind})
+        self.streams[key] = stream
+        stream.connect()
+
+    def can_view(self, queue_id):
+        try:
+            account = caches.get_account(self.scope['user'])
+            queue = caches.get_queue(queue_id)
+        except Account.DoesNotExist:
+            return False
+        except Queue.DoesNotExist:
+            return True # the stream itself reports that the queue is gone
+        return access.get(account).can_view(queue)
+
+    def received_unsubscribe(self, data):
+        key = self.stream_key(data['unsubscribe'], data.get('queueID'))
+        stream = self.streams.pop(key, None)
+        if stream is not None:
+            stream.disconnect(1000)
+
+    # called by a stream that closes itself, e.g. it failed to connect
+    def close_stream(self, stream):
+        for key, value in list(self.streams.items()):
+            if value is stream:
+                del self.streams[key]
+                stream.disconnect(1000)
+                self.send(text_data=json.dumps(dict(stream.tag, type='stream-closed')))
+
+    def send_error(self, error_message):
+        self.send(text_data=json.dumps({'error': error_message}))
+
+    # Group events of every stream arrive on this one channel; the tag on the
+    # event says which stream it is for.
+    def route_event(self, event):
+        key = self.stream_key(event.get('stream'), event.get('queueID'))
+        stream = (self.streams or {}).get(key)
+        if stream is not None:
+            getattr(stream, event['type'])(event)
+
+    broadcast_event = route_event
+    announcement_event = route_event
+    refresh_account_entries = route_event
+    deferred_refresh = route_event
+    task_progress = route_event
+    queue_update = route_event
+    queue_delete = route_event
+    queue_add = route_event
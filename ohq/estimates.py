@@ -0,0 +1,83 @@
+"""
+Streaming estimate of how long students will wait on each queue.
+
+Every queue keeps a few numbers in the cache: an exponentially weighted
+moving average of how long a help session takes, and when each staff
+member last started or finished helping someone. Both are updated in O(1)
+on help/finish-help transitions, so estimating a wait never scans history.
+Concurrent updates from different workers can occasionally overwrite each
+other, which only costs the estimate one sample.
+"""
+import time
+
+from django.core.cache import cache
+
+from ohq.models import AccountEntry
+
+ALPHA = 0.3 # weight of the newest help duration in the average
+STAFF_IDLE_SECONDS = 15 * 60 # staff who haven't helped anyone for this long are not counted
+STATE_TIMEOUT = 24 * 3600
+
+
+def _key(queue_id):
+    return f'ohq:wait-estimate:{queue_id}'
+
+
+def _load(queue_id):
+    return cache.get(_key(queue_id)) or {'helpSeconds': None, 'staff': {}}
+
+
+def _store(queue_id, state, now):
+    # forget idle staff so the state stays as small as the active staff list
+    state['staff'] = {staff_id: seen for staff_id, seen in state['staff'].items()
+                      if now - seen < STAFF_IDLE_SECONDS}
+    cache.set(_key(queue_id), state, STATE_TIMEOUT)
+
+
+def record_help_started(queue_id, staff_id):
+    now = time.time()
+    state = _load(queue_id)
+    state['staff'][staff_id] = now
+    _store(queue_id, state, now)
+
+
+def record_help_finished(queue_id, staff_id, help_seconds):
+    now = time.time()
+    state = _load(queue_id)
+    if help_seconds is not None:
+        previous = state['helpSeconds']
+        state['helpSeconds'] = (help_seconds if previous is None
+                                else ALPHA * help_seconds + (1 - ALPHA) * previous)
+    if staff_id is not None:
+        state['staff'][staff_id] = now
+    _store(queue_id, state, now)
+
+
+def annotate(queue_id, entries):
+    """
+    Adds 'estimatedWait' (seconds, or None when there is no estimate yet)
+    to every entry dict of a queue snapshot, in queue order.
+
+    With S active staff of whom B are busy, the k-th waiting student
+    (0-based) is helped right away while k < S - B, and otherwise after
+    roughly (k - (S - B) + 1) average help sessions shared across S staff.
+    """
+    state = _load(queue_id)
+    help_seconds = state['helpSeconds']
+    now = time.time()
+    busy = sum(1 for e in entries if e['status'] == AccountEntry.STATUS_HELPING)
+    active = sum(1 for seen in state['staff'].values() if now - seen < STAFF_IDLE_SECONDS)
+    servers = max(active, busy, 1)
+    free = servers - busy
+
+    position = 0
+    for entry in entries:
+        if entry['status'] != AccountEntry.STATUS_WAITING or help_seconds is None:
+            entry['estimatedWait'] = None
+            continue
+        if position < free:
+            entry['estimatedWait'] = 0
+        else:
+            entry['estimatedWait'] = round((position - free + 1) * help_seconds / servers)
+        position += 1
+    return entries
@@ -0,0 +1,742 @@
+"""
+Live state of queue entries, with write-behind persistence.
+
+By default (OHQ_LIVE_STATE unset) entries are read and written straight
+through the AccountEntry table. With 'redis', or 'memory' for tests and
+single-process deployments, each open queue's entries live in a store
+instead: a sorted set orders them by join time and a hash holds each
+entry's status, staff and question. Every change is also appended to a
+write queue that a background thread applies to AccountEntry in batches,
+so joining, helping and finishing never wait on the SQL database.
+
+Either way entries are handed out as AccountEntry instances, so callers
+read and set the same fields. In the live modes they are not saved rows
+and must be written back through save()/delete() here. Their ids are the
+table's: loaded entries keep theirs, and new ones take the next id from
+a counter the store keeps above the table's largest, which the write
+behind then inserts them with. An id a page holds stays valid however
+often the queue is dropped and reloaded.
+
+Every change bumps the entry's version, and save()/delete() only apply if
+the entry is still at the version it was read at (or the one a staff
+member saw, if given). Two staff acting on the same student at once can't
+both win; the loser is told and shown the entry as it now is.
+
+A queue is loaded from the table the first time it is used. Code that
+writes AccountEntry rows directly (e.g. the roster task) must flush()
+first; the save/delete signals then discard() the queue so it reloads.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+
+from ohq import snapshots, tasks
+from ohq.models import Account, AccountEntry, HelpSession, Queue
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5 # seconds between write-behind batches
+BATCH_SIZE = 500
+FLUSH_LOCK_TIMEOUT = 60
+
+
+def enabled():
+    return bool(settings.OHQ_LIVE_STATE)
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _to_dict(entry):
+    return {
+        'id': entry.id,
+        'queue_id': entry.queue_id,
+        'account_id': entry.account_id,
+        'name': entry.account.nickname,
+        'question': entry.question,
+        'status': entry.status,
+        'joinTime': _iso(entry.joinTime),
+        'helping_staff_id': entry.helping_staff_id,
+        'helping_staff_name': entry.helping_staff.nickname if entry.helping_staff_id else None,
+        'freezeTime': _iso(entry.freezeTime),
+        'helpTime': _iso(entry.helpTime),
+        'version': entry.version,
+    }
+
+
+def _to_model(data):
+    entry = AccountEntry(
+        id=data['id'],
+        queue_id=data['queue_id'],
+        question=data['question'],
+        status=data['status'],
+        joinTime=_time(data['joinTime']),
+        freezeTime=_time(data['freezeTime']),
+        helpTime=_time(data['helpTime']),
+        version=data.get('version', 0),
+    )
+    # only what the entry shows is kept, so these stand in for the real rows
+    entry.account = Account(id=data['account_id'], nickname=data['name'])
+    if data['helping_staff_id']:
+        entry.helping_staff = Account(id=data['helping_staff_id'], nickname=data['helping_staff_name'])
+    return entry
+
+
+def _student(data):
+    # the same dict AccountEntry.get_all_students builds
+    student = {key: data[key] for key in
+               ('id', 'account_id', 'name', 'question', 'status', 'joinTime', 'helping_staff_name', 'freezeTime')}
+    student['version'] = data.get('version', 0)
+    return student
+
+
+def _order(data):
+    return datetime.fromisoformat(data['joinTime']).timestamp()
+
+
+class MemoryStore:
+    """Keeps the live state in this process."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.flushing = threading.Lock()
+        self.queues = {} # queue id -> {entry id: entry dict}
+        self.last_id = 0
+        self.writes = deque()
+
+    def _new_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def reserve_ids(self, last_id):
+        """Makes new ids start after `last_id`."""
+        with self.lock:
+            self.last_id = max(self.last_id, last_id)
+
+    def is_loaded(self, queue_id):
+        return queue_id in self.queues
+
+    def load(self, queue_id, entries):
+        with self.lock:
+            if queue_id in self.queues:
+                return
+            self.queues[queue_id] = {data['id']: dict(data) for data in entries}
+
+    def drop(self, queue_id):
+        with self.lock:
+            self.queues.pop(queue_id, None)
+
+    def entries(self, queue_id):
+        with self.lock:
+            entries = [dict(data) for data in self.queues.get(queue_id, {}).values()]
+        return sorted(entries, key=lambda data: (_order(data), data['id']))
+
+    def get(self, queue_id, entry_id):
+        with self.lock:
+            data = self.queues.get(queue_id, {}).get(entry_id)
+            return dict(data) if data else None
+
+    def find_account(self, queue_id, account_id):
+        with self.lock:
+            for data in self.queues.get(queue_id, {}).values():
+                if data['account_id'] == account_id:
+                    return dict(data)
+        return None
+
+    def add(self, queue_id, data):
+        with self.lock:
+            if self.find_account(queue_id, data['account_id']) is not None:
+                return None
+            data = dict(data, id=self._new_id())
+            self.queues.setdefault(queue_id, {})[data['id']] = data
+            return dict(data)
+
+    def _is_at(self, queue_id, entry_id, version):
+        current = self.queues.get(queue_id, {}).get(entry_id)
+        return current is not None and current.get('version', 0) == version
+
+    def put(self, queue_id, data, version):
+        with self.lock:
+            if not self._is_at(queue_id, data['id'], version):
+                return False
+            self.queues[queue_id][data['id']] = dict(data)
+            return True
+
+    def remove(self, queue_id, data, version):
+        with self.lock:
+            if not self._is_at(queue_id, data['id'], version):
+                return False
+            del self.queues[queue_id][data['id']]
+            return True
+
+    def push_writes(self, ops):
+        with self.lock:
+            self.writes.extend(ops)
+
+    def pop_writes(self, count):
+        with self.lock:
+            return [self.writes.popleft() for _ in range(min(count, len(self.writes)))]
+
+    def requeue(self, ops):
+        with self.lock:
+            self.writes.extendleft(reversed(ops))
+
+    @contextmanager
+    def flush_lock(self):
+        with self.flushing:
+            yield
+
+
+class RedisStore:
+    """
+    Keeps the live state in Redis, shared by every worker:
+
+        ohq:live:<queue>:order      sorted set of entry ids, scored by join time
+        ohq:live:<queue>:entries    hash of entry id -> entry fields (JSON)
+        ohq:live:<queue>:accounts   hash of account id -> entry id
+        ohq:live:<queue>:loaded     set once the queue is loaded from the table
+        ohq:live:writes             list of writes not yet in the table
+    """
+
+    # joins only if the account isn't on the queue yet
+    ADD = """
+    if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then return 0 end
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+    redis.call('ZADD', KEYS[3], ARGV[4], ARGV[2])
+    return 1
+    """
+    # updates only if the entry is still on the queue, at the expected version
+    PUT = """
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if not current or (cjson.decode(current)['version'] or 0) ~= tonumber(ARGV[3]) then return 0 end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+    """
+    # never moves the id counter back
+    RESERVE = """
+    if tonumber(redis.call('GET', KEYS[1]) or '0') < tonumber(ARGV[1]) then
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    """
+    # likewise for taking an entry off the queue
+    REMOVE = """
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if not current or (cjson.decode(current)['version'] or 0) ~= tonumber(ARGV[3]) then return 0 end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[2])
+    return 1
+    """
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.add_script = self.redis.register_script(self.ADD)
+        self.put_script = self.redis.register_script(self.PUT)
+        self.remove_script = self.redis.register_script(self.REMOVE)
+        self.reserve_script = self.redis.register_script(self.RESERVE)
+
+    def _keys(self, queue_id):
+        prefix = f'ohq:live:{queue_id}'
+        return f'{prefix}:order', f'{prefix}:entries', f'{prefix}:accounts', f'{prefix}:loaded'
+
+    def reserve_ids(self, last_id):
+        self.reserve_script(keys=['ohq:live:last-id'], args=[last_id])
+
+    def is_loaded(self, queue_id):
+        return bool(self.redis.exists(self._keys(queue_id)[3]))
+
+    def load(self, queue_id, entries):
+        from redis.exceptions import WatchError
+        order, entries_key, accounts, loaded = self._keys(queue_id)
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(loaded)
+                if pipe.exists(loaded):
+                    return
+                pipe.multi()
+                for data in entries:
+                    pipe.hset(entries_key, data['id'], json.dumps(data))
+                    pipe.hset(accounts, data['account_id'], data['id'])
+                    pipe.zadd(order, {data['id']: _order(data)})
+                pipe.set(loaded, 1)
+                pipe.execute()
+            except WatchError:
+                pass # another worker loaded it first
+
+    def drop(self, queue_id):
+        self.redis.delete(*self._keys(queue_id))
+
+    def entries(self, queue_id):
+        order, entries_key, _, _ = self._keys(queue_id)
+        with self.redis.pipeline(transaction=True) as pipe:
+            ids, entries = pipe.zrange(order, 0, -1).hgetall(entries_key).execute()
+        return [json.loads(entries[entry_id]) for entry_id in ids if entry_id in entries]
+
+    def get(self, queue_id, entry_id):
+        value = self.redis.hget(self._keys(queue_id)[1], entry_id)
+        return json.loads(value) if value else None
+
+    def find_account(self, queue_id, account_id):
+        entry_id = self.redis.hget(self._keys(queue_id)[2], account_id)
+        return self.get(queue_id, int(entry_id)) if entry_id else None
+
+    def add(self, queue_id, data):
+        order, entries_key, accounts, _ = self._keys(queue_id)
+        data = dict(data, id=self.redis.incr('ohq:live:last-id'))
+        added = self.add_script(keys=[accounts, entries_key, order],
+                                args=[data['account_id'], data['id'], json.dumps(data), _order(data)])
+        return data if added else None
+
+    def put(self, queue_id, data, version):
+        return bool(self.put_script(keys=[self._keys(queue_id)[1]], args=[data['id'], json.dumps(data), version]))
+
+    def remove(self, queue_id, data, version):
+        order, entries_key, accounts, _ = self._keys(queue_id)
+        return bool(self.remove_script(keys=[entries_key, order, accounts],
+                                       args=[data['id'], data['account_id'], version]))
+
+    def push_writes(self, ops):
+        self.redis.rpush('ohq:live:writes', *[json.dumps(op) for op in ops])
+
+    def pop_writes(self, count):
+        with self.redis.pipeline(transaction=True) as pipe:
+            ops, _ = pipe.lrange('ohq:live:writes', 0, count - 1).ltrim('ohq:live:writes', count, -1).execute()
+        return [json.loads(op) for op in ops]
+
+    def requeue(self, ops):
+        self.redis.lpush('ohq:live:writes', *[json.dumps(op) for op in reversed(ops)])
+
+    @contextmanager
+    def flush_lock(self):
+        with self.redis.lock('ohq:live:flush-lock', timeout=FLUSH_LOCK_TIMEOUT):
+            yield
+
+
+_store = None
+_flusher = None
+_lock = threading.Lock()
+_flushing = threading.local()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                if settings.OHQ_LIVE_STATE == 'redis':
+                    _store = RedisStore(settings.OHQ_REDIS_URL)
+                else:
+                    _store = MemoryStore()
+    return _store
+
+
+def _loaded(queue_id):
+    store = get_store()
+    if not store.is_loaded(queue_id):
+        flush() # so the table has everything written before the queue was last dropped
+        store.reserve_ids(AccountEntry.objects.aggregate(last=Max('id'))['last'] or 0)
+        rows = AccountEntry.objects.filter(queue_id=queue_id).select_related('account', 'helping_staff')
+        store.load(queue_id, [_to_dict(entry) for entry in rows.order_by('joinTime')])
+        _start_flusher()
+    return store
+
+
+def _changed(queue_id, ops):
+    get_store().push_writes(ops)
+    snapshots.bump(queue_id)
+    _start_flusher()
+
+
+def get_all_students(queue_id):
+    if not enabled():
+        return AccountEntry.get_all_students(queue_id)
+    return [_student(data) for data in _loaded(queue_id).entries(queue_id)]
+
+
+def find(queue, account=None, entry_id=None):
+    """
+    The entry of `account`, or with id `entry_id`, on `queue`.
+    Raises AccountEntry.DoesNotExist like AccountEntry.objects.get.
+    """
+    if not enabled():
+        if account is not None:
+            return AccountEntry.objects.get(account=account, queue=queue)
+        return AccountEntry.objects.get(id=entry_id, queue=queue)
+
+    store = _loaded(queue.id)
+    if account is not None:
+        data = store.find_account(queue.id, account.id)
+    else:
+        try:
+            data = store.get(queue.id, int(entry_id))
+        except (TypeError, ValueError):
+            data = None
+    if data is None:
+        raise AccountEntry.DoesNotExist
+    return _to_model(data)
+
+
+def create(queue, account, question):
+    """Puts `account` on `queue`; returns None if it is already on it."""
+    if not enabled():
+        if AccountEntry.objects.filter(account=account, queue=queue).exists():
+            return None
+        return AccountEntry.objects.create(
+            joinTime=timezone.now(),
+            account=account,
+            queue=queue,
+            question=question,
+            status=AccountEntry.STATUS_WAITING
+        )
+
+    entry = AccountEntry(joinTime=timezone.now(), account=account, queue=queue,
+                         question=question, status=AccountEntry.STATUS_WAITING)
+    data = _loaded(queue.id).add(queue.id, _to_dict(entry))
+    if data is None:
+        return None
+    _changed(queue.id, [{'op': 'save', 'entry': data}])
+    return _to_model(data)
+
+
+def save(entry, version=None):
+    """
+    Writes `entry` back if it is still at `version` (by default the version
+    it was read at) and bumps its version. Returns False, writing nothing,
+    if it changed or left the queue meanwhile.
+    """
+    if version is None:
+        version = entry.version
+    if not enabled():
+        updated = AccountEntry.objects.filter(id=entry.id, version=version).update(
+            question=entry.question, status=entry.status, helping_staff=entry.helping_staff,
+            freezeTime=entry.freezeTime, helpTime=entry.helpTime, version=version + 1)
+        if not updated:
+            return False
+        entry.version = version + 1
+        snapshots.bump(entry.queue_id) # update() skips the save signals
+        return True
+    entry.version = version + 1
+    data = _to_dict(entry)
+    if not get_store().put(entry.queue_id, data, version):
+        entry.version = version
+        return False
+    _changed(entry.queue_id, [{'op': 'save', 'entry': data}])
+    return True
+
+
+def delete(entry, version=None):
+    """Takes `entry` off its queue on the same terms as save()."""
+    if version is None:
+        version = entry.version
+    if not enabled():
+        deleted, _ = AccountEntry.objects.filter(id=entry.id, version=version).delete()
+        return bool(deleted)
+    data = _to_dict(entry)
+    if not get_store().remove(entry.queue_id, data, version):
+        return False
+    _changed(entry.queue_id, [{'op': 'delete', 'entry': data}])
+    return True
+
+
+def update_many(queue, versions, match=None, **fields):
+    """
+    save() for several entries of `queue` in one go: sets `fields` on each
+    entry in `versions` (entry id -> the version the caller saw, or None)
+    that is still at that version and passes `match`. Returns the entries
+    written, as they now are.
+    """
+    if not enabled():
+        written = []
+        with transaction.atomic():
+            rows = AccountEntry.objects.select_for_update(of=('self',)).filter(queue=queue, id__in=list(versions))
+            for entry in rows.select_related('account', 'helping_staff'):
+                if versions[entry.id] in (None, entry.version) and (match is None or match(entry)):
+                    written.append(entry)
+            AccountEntry.objects.filter(id__in=[entry.id for entry in written]) \
+                                .update(version=F('version') + 1, **fields)
+        for entry in written:
+            for name, value in fields.items():
+                setattr(entry, name, value)
+            entry.version += 1
+        if written:
+            snapshots.bump(queue.id) # update() skips the save signals
+        return written
+
+    store = _loaded(queue.id)
+    written, ops = [], []
+    for entry_id, version in versions.items():
+        data = store.get(queue.id, entry_id)
+        if data is None or version not in (None, data.get('version', 0)):
+            continue
+        entry = _to_model(data)
+        if match is not None and not match(entry):
+            continue
+        for name, value in fields.items():
+            setattr(entry, name, value)
+        entry.version += 1
+        data = _to_dict(entry)
+        if store.put(queue.id, data, entry.version - 1):
+            written.append(entry)
+            ops.append({'op': 'save', 'entry': data})
+    if ops:
+        _changed(queue.id, ops)
+    return written
+
+
+def delete_many(queue, versions, match=None):
+    """delete() for several entries of `queue` in one go, on the terms of update_many(). Returns those removed."""
+    if not enabled():
+        removed = []
+        with transaction.atomic():
+            rows = AccountEntry.objects.select_for_update(of=('self',)).filter(queue=queue, id__in=list(versions))
+            for entry in rows.select_related('account', 'helping_staff'):
+                if versions[entry.id] in (None, entry.version) and (match is None or match(entry)):
+                    removed.append(entry)
+            with _own_writes(): # one snapshot bump below instead of a refresh per row
+                AccountEntry.objects.filter(id__in=[entry.id for entry in removed]).delete()
+        if removed:
+            snapshots.bump(queue.id)
+        return removed
+
+    store = _loaded(queue.id)
+    removed, ops = [], []
+    for entry_id, version in versions.items():
+        data = store.get(queue.id, entry_id)
+        if data is None or version not in (None, data.get('version', 0)):
+            continue
+        entry = _to_model(data)
+        if match is not None and not match(entry):
+            continue
+        if store.remove(queue.id, data, entry.version):
+            removed.append(entry)
+            ops.append({'op': 'delete', 'entry': data})
+    if ops:
+        _changed(queue.id, ops)
+    return removed
+
+
+def as_student(entry):
+    """The entry as it appears in a queue snapshot's 'students'."""
+    return _student(_to_dict(entry))
+
+
+def archive(entry, staff, finish_time):
+    """HelpSession.archive, written behind in the live modes and run as a task otherwise."""
+    if not enabled():
+        tasks.enqueue('archive-session', queue_id=entry.queue_id, account_id=entry.account_id,
+                      staff_id=staff.id if staff else None, joinTime=_iso(entry.joinTime),
+                      helpTime=_iso(entry.helpTime), finishTime=finish_time.isoformat())
+        return
+    get_store().push_writes([{
+        'op': 'archive',
+        'entry': _to_dict(entry),
+        'staff_id': staff.id if staff else None,
+        'finishTime': finish_time.isoformat(),
+    }])
+    _start_flusher()
+
+
+def _update_where(queue_id, match, **fields):
+    store = _loaded(queue_id)
+    ops = []
+    for data in store.entries(queue_id):
+        if match(data):
+            version = data.get('version', 0)
+            data.update(fields, version=version + 1)
+            if store.put(queue_id, data, version): # an entry changed meanwhile is left as it now is
+                ops.append({'op': 'save', 'entry': data})
+    if ops:
+        _changed(queue_id, ops)
+    return len(ops)
+
+
+def freeze_all(queue):
+    """Freezes every waiting student, without a freezeTime so they aren't auto-unfrozen."""
+    if not enabled():
+        AccountEntry.objects.filter(
+            queue=queue,
+            status=AccountEntry.STATUS_WAITING
+        ).update(
+            status=AccountEntry.STATUS_FROZEN,
+            freezeTime=None, # This prevents auto-unfreeze
+            version=F('version') + 1
+        )
+        snapshots.bump(queue.id) # update() skips the save signals
+        return
+    _update_where(queue.id, lambda data: data['status'] == AccountEntry.STATUS_WAITING,
+                  status=AccountEntry.STATUS_FROZEN, freezeTime=None)
+
+
+def unfreeze_stale(queue):
+    """Puts frozen students whose freeze timed out back to waiting."""
+    if queue.freeze_timeout <= 0: # auto-unfreeze is disabled
+        return 0
+    cutoff_time = timezone.now() - timezone.timedelta(seconds=queue.freeze_timeout)
+    if enabled():
+        return _update_where(queue.id, lambda data: (data['status'] == AccountEntry.STATUS_FROZEN
+                                                     and data['freezeTime']
+                                                     and _time(data['freezeTime']) < cutoff_time),
+                             status=AccountEntry.STATUS_WAITING, freezeTime=None)
+    updated = AccountEntry.objects.filter(
+        queue=queue,
+        status=AccountEntry.STATUS_FROZEN,
+        freezeTime__lt=cutoff_time # Only select entries with a non-null freezeTime
+    ).update(status=AccountEntry.STATUS_WAITING, freezeTime=None, version=F('version') + 1)
+    if updated:
+        snapshots.bump(queue.id)
+    return updated
+
+
+# Staff actions on entries, and how many of them lost a race with another
+# staff member, counted per queue and hour for the analytics page.
+CONFLICT_WINDOW = 24 # hours
+
+
+def _action_key(queue_id, hour, outcome):
+    return f'ohq:entry-actions:{queue_id}:{hour}:{outcome}'
+
+
+def record_action(queue_id, conflicted):
+    key = _action_key(queue_id, int(time.time() // 3600), 'conflict' if conflicted else 'ok')
+    cache.add(key, 0, (CONFLICT_WINDOW + 1) * 3600)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass # expired in between; one action isn't worth a retry
+
+
+def conflict_stats(queue_id):
+    """{'actions': n, 'conflicts': m, 'rate': m / n} over the last CONFLICT_WINDOW hours."""
+    hour = int(time.time() // 3600)
+    counts = cache.get_many([_action_key(queue_id, h, outcome)
+                             for h in range(hour - CONFLICT_WINDOW + 1, hour + 1)
+                             for outcome in ('ok', 'conflict')])
+    actions = sum(counts.values())
+    conflicts = sum(count for key, count in counts.items() if key.endswith(':conflict'))
+    return {'actions': actions, 'conflicts': conflicts, 'rate': conflicts / actions if actions else 0}
+
+
+def discard(queue_id):
+    """Drops a queue's live state; it is reloaded from the table when next used."""
+    if not enabled():
+        return
+    get_store().drop(queue_id)
+    flush()
+
+
+def writing_behind():
+    """True while this thread writes entries on our behalf (queued writes, batches); their signals are our own."""
+    return getattr(_flushing, 'active', False)
+
+
+@contextmanager
+def _own_writes():
+    _flushing.active = True
+    try:
+        yield
+    finally:
+        _flushing.active = False
+
+
+def flush():
+    """Applies every queued write to the AccountEntry and HelpSession tables."""
+    if not enabled():
+        return
+    store = get_store()
+    with store.flush_lock():
+        while True:
+            ops = store.pop_writes(BATCH_SIZE)
+            if not ops:
+                return
+            try:
+                _apply(ops)
+            except Exception:
+                store.requeue(ops)
+                raise
+
+
+def _apply(ops):
+    # writes for queues or accounts deleted since would fail the whole batch
+    queue_ids = set(Queue.objects.filter(id__in={op['entry']['queue_id'] for op in ops})
+                    .values_list('id', flat=True))
+    account_ids = set(Account.objects.filter(id__in={op['entry']['account_id'] for op in ops})
+                      .values_list('id', flat=True))
+    ops = [op for op in ops if op['entry']['queue_id'] in queue_ids and op['entry']['account_id'] in account_ids]
+
+    # only the last write of each entry matters. Entries are keyed by id, not
+    # by student: one who left and rejoined has a delete and a new entry
+    latest = {}
+    archives = []
+    for op in ops:
+        if op['op'] == 'archive':
+            archives.append(op)
+        else:
+            latest[op['entry']['id']] = op
+
+    with _own_writes(), transaction.atomic():
+        for op in archives:
+            staff = Account(id=op['staff_id']) if op['staff_id'] else None
+            HelpSession.archive(_to_model(op['entry']), staff, datetime.fromisoformat(op['finishTime']))
+
+        # deletes first, so the old row is gone before the student's new entry goes in
+        deletes = [entry_id for entry_id, op in latest.items() if op['op'] == 'delete']
+        AccountEntry.objects.filter(id__in=deletes).delete()
+
+        saves = [_to_model(op['entry']) for op in latest.values() if op['op'] == 'save']
+        existing = set(AccountEntry.objects.filter(id__in=[entry.id for entry in saves]).values_list('id', flat=True))
+        updates = [entry for entry in saves if entry.id in existing]
+        creates = [entry for entry in saves if entry.id not in existing] # with the id the store gave them
+        if creates:
+            # a row for the same student under another id was written directly meanwhile; the store has them
+            match = Q()
+            for entry in creates:
+                match |= Q(queue_id=entry.queue_id, account_id=entry.account_id)
+            AccountEntry.objects.filter(match).exclude(id__in=[entry.id for entry in creates]).delete()
+
+        AccountEntry.objects.bulk_update(updates, ['joinTime', 'question', 'status', 'helping_staff',
+                                                   'freezeTime', 'helpTime', 'version'])
+        AccountEntry.objects.bulk_create(creates)
+        if creates:
+            # rows inserted with explicit ids don't advance Postgres' sequence
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [AccountEntry]):
+                    cursor.execute(sql)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        close_old_connections()
+        try:
+            flush()
+        except Exception:
+            logger.exception('Writing queue entries behind failed; will retry')
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_forever, name='ohq-livestate-flush', daemon=True)
+            _flusher.start()
+            atexit.register(flush)
@@ -0,0 +1,608 @@
+"""
+Load-testing harness for the queue pages.
+
+Students and course staff are simulated as WebSocket clients of the real
+ASGI application (webapps.asgi) through channels' WebsocketCommunicator, so
+every message goes through the same auth middleware, routing, consumers,
+signals and channel layer that it would behind Daphne.
+"""
+import asyncio
+import bisect
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from importlib import import_module
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from ohq import livestate, traffic
+from ohq.consumers import QueueConsumer
+from ohq.models import Account, AccountEntry, Queue, QueueHistory
+
+# Every user and queue created by the harness starts with this prefix so
+# that it can be told apart from (and cleaned up without touching) real data.
+FIXTURE_PREFIX = 'loadtest_'
+
+# Snapshots arriving later than this after an action are not attributed to it.
+LATENCY_WINDOW = 5.0
+
+
+class QueryCounter:
+    """
+    Counts SQL queries made from any thread, grouped by the label the
+    running thread set with track(). The consumers run in asgiref's sync
+    worker thread, so CaptureQueriesContext in the harness thread would
+    not see their queries.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __call__(self, execute, sql, params, many, context):
+        label = getattr(self._local, 'label', 'other')
+        with self._lock:
+            self.counts[label] = self.counts.get(label, 0) + 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def track(self, label):
+        previous = getattr(self._local, 'label', 'other')
+        self._local.label = label
+        try:
+            yield
+        finally:
+            self._local.label = previous
+
+    def _install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def start(self):
+        # connections are per thread, so hook every connection opened from now on
+        connection_created.connect(self._install, weak=False, dispatch_uid=id(self))
+        for conn in connections.all(initialized_only=True):
+            self._install(connection=conn)
+
+    def stop(self):
+        connection_created.disconnect(dispatch_uid=id(self))
+        for conn in connections.all(initialized_only=True):
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+@contextmanager
+def instrument_consumers(counter):
+    """
+    Labels the queries QueueConsumer makes with the action (or channel
+    layer event) that caused them for the duration of the block.
+    """
+    originals = {name: getattr(QueueConsumer, name)
+                 for name in ('connect', 'receive', 'refresh_account_entries')}
+
+    def labelled(name, method):
+        def wrapper(self, *args, **kwargs):
+            label = name
+            if name == 'receive':
+                try:
+                    label = json.loads(kwargs.get('text_data') or '{}').get('action', name)
+                except (json.JSONDecodeError, AttributeError):
+                    pass
+            with counter.track(label):
+                return method(self, *args, **kwargs)
+        return wrapper
+
+    for name, method in originals.items():
+        setattr(QueueConsumer, name, labelled(name, method))
+    try:
+        yield
+    finally:
+        for name, method in originals.items():
+            setattr(QueueConsumer, name, method)
+
+
+def percentile(values, p):
+    # nearest-rank percentile; values need not be sorted
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values, scale=1.0):
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': scale * sum(values) / len(values),
+        'p50': scale * percentile(values, 50),
+        'p90': scale * percentile(values, 90),
+        'p99': scale * percentile(values, 99),
+        'max': scale * max(values),
+    }
+
+
+class SimulatedClient:
+    """
+    A single browser tab with a queue page open (or, given a different
+    path, any other page with a socket such as the queue list).
+    """
+
+    def __init__(self, application, queue_id, role, nickname, session_key, path=None):
+        self.application = application
+        self.headers = [(b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode())]
+        self.path = path or f'/ohq/data/queue/{queue_id}'
+        self.communicator = None
+        self.queue_id = queue_id
+        self.role = role
+        self.nickname = nickname
+        self.account_id = None
+        self.messages = 0
+        self.snapshot = []
+        self.snapshot_times = []
+        self.closed = False
+        self.retries = 0
+        self._reader = None
+
+    async def connect(self):
+        # like the browsers, come back when admission control says to
+        while True:
+            self.communicator = WebsocketCommunicator(self.application, self.path, headers=self.headers)
+            connected, _ = await self.communicator.connect(timeout=30)
+            if not connected:
+                raise RuntimeError(f'{self.nickname} could not connect to queue {self.queue_id}')
+            message = await self.communicator.output_queue.get()
+            data = json.loads(message['text']) if message['type'] == 'websocket.send' else {}
+            if data.get('type') != 'retry':
+                break
+            self.retries += 1
+            await self.communicator.disconnect(timeout=5)
+            await asyncio.sleep(data['retryAfter'])
+        self._handle(message)
+        self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        # read the output queue directly: receive_from() cancels the consumer on timeout
+        while not self.closed:
+            self._handle(await self.communicator.output_queue.get())
+
+    def _handle(self, message):
+        if message['type'] == 'websocket.close':
+            self.closed = True
+            return
+        if message['type'] != 'websocket.send':
+            return
+        self.messages += 1
+        data = json.loads(message['text'])
+        if data.get('type') == 'connection_established':
+            self.account_id = data['my_account_id']
+        elif data.get('type') == 'ping':
+            # answered like a browser would, or long runs get their sockets reaped
+            asyncio.ensure_future(self.send({'type': 'pong'}))
+        elif 'students' in data:
+            self.snapshot_times.append(time.perf_counter())
+            self.snapshot = data['students']
+
+    async def send(self, data):
+        await self.communicator.send_json_to(data)
+
+    async def disconnect(self):
+        if self._reader:
+            self._reader.cancel()
+        if not self.closed:
+            await self.communicator.disconnect(timeout=5)
+
+    def pick_entry(self, action):
+        # the entry a staff member would most likely act on next
+        entries = self.snapshot
+        if action == 'finish-help':
+            helping = [e for e in entries if e['status'] == AccountEntry.STATUS_HELPING]
+            mine = [e for e in helping if e['helping_staff_name'] == self.nickname]
+            candidates = mine or helping or entries
+        else:
+            candidates = [e for e in entries if e['status'] == AccountEntry.STATUS_WAITING] or entries
+        return candidates[0]['id'] if candidates else None
+
+    def choose_action(self, rng):
+        entries = self.snapshot
+        if self.role == 'student':
+            mine = next((e for e in entries if e['account_id'] == self.account_id), None)
+            if mine is None:
+                if rng.random() < 0.7:
+                    return {'action': 'ask-question', 'text': f'question from {self.nickname}'}
+                return {'action': 'refresh'}
+            if mine['status'] == AccountEntry.STATUS_FROZEN and rng.random() < 0.5:
+                return {'action': 'unfreeze'}
+            if rng.random() < 0.1:
+                return {'action': 'leave-queue'}
+            return {'action': 'refresh'}
+
+        helping = [e for e in entries if e['status'] == AccountEntry.STATUS_HELPING
+                   and e['helping_staff_name'] == self.nickname]
+        if helping:
+            action = 'finish-help' if rng.random() < 0.8 else 'freeze'
+            return {'action': action, 'entry_id': helping[0]['id']}
+        waiting = [e for e in entries if e['status'] == AccountEntry.STATUS_WAITING]
+        if waiting:
+            action = 'help' if rng.random() < 0.85 else 'freeze'
+            return {'action': action, 'entry_id': waiting[0]['id']}
+        return {'action': 'refresh'}
+
+
+class LoadTest:
+    """
+    Drives `students` students and `staff` staff members on each of `queues`
+    queues for `duration` seconds. Every client waits an exponentially
+    distributed think time (mean `think` seconds) between actions.
+    """
+
+    def __init__(self, queues=1, students=20, staff=2, duration=30.0, think=1.0, seed=0):
+        self.num_queues = queues
+        self.num_students = students
+        self.num_staff = staff
+        self.duration = duration
+        self.think = think
+        self.seed = seed
+        self.members = [] # (queue id, role, nickname, session key)
+        self.session_keys = []
+
+    def create_fixture(self):
+        for q in range(self.num_queues):
+            queue = Queue.objects.create(queueName=f'{FIXTURE_PREFIX}queue_{q}',
+                                         courseNumber=f'99{q % 1000:03d}',
+                                         description='Created by the load-testing harness',
+                                         isOpen=True)
+            for role, count in (('staff', self.num_staff), ('student', self.num_students)):
+                for i in range(count):
+                    username = f'{FIXTURE_PREFIX}{queue.id}_{role}_{i}'
+                    user = User.objects.create(username=username, email=f'{username}@example.com')
+                    user.set_unusable_password()
+                    user.save()
+                    account = Account.objects.get(user=user)
+                    account.nickname = username
+                    account.save()
+                    if role == 'staff':
+                        queue.allowedStaff.add(account)
+
+                    session_key = login_session(user)
+                    self.session_keys.append(session_key)
+                    self.members.append((queue.id, role, username, session_key))
+
+    def delete_fixture(self):
+        logout_sessions(self.session_keys)
+        self.session_keys = []
+        delete_fixture_data()
+
+    async def run(self):
+        from webapps.asgi import application
+
+        counter = QueryCounter()
+        clients = [SimulatedClient(application, *member) for member in self.members]
+        actions = [] # (queue id, action, send time)
+        rng = random.Random(self.seed)
+
+        counter.start()
+        try:
+            with instrument_consumers(counter):
+                # everyone opens the page at once, as at the start of OH
+                connect_times = []
+
+                async def timed_connect(client):
+                    start = time.perf_counter()
+                    await client.connect()
+                    connect_times.append(time.perf_counter() - start)
+
+                await asyncio.gather(*(timed_connect(c) for c in clients))
+
+                start = time.perf_counter()
+                deadline = start + self.duration
+
+                async def drive(client, client_rng):
+                    while True:
+                        await asyncio.sleep(client_rng.expovariate(1 / self.think))
+                        if time.perf_counter() >= deadline or client.closed:
+                            return
+                        data = client.choose_action(client_rng)
+                        actions.append((client.queue_id, data['action'], time.perf_counter()))
+                        await client.send(data)
+
+                await asyncio.gather(*(drive(c, random.Random(rng.random())) for c in clients))
+                elapsed = time.perf_counter() - start
+                # let the last broadcasts drain before measuring
+                await asyncio.sleep(min(LATENCY_WINDOW, 2.0))
+                for client in clients:
+                    await client.disconnect()
+        finally:
+            counter.stop()
+
+        config = {
+            'queues': self.num_queues,
+            'students_per_queue': self.num_students,
+            'staff_per_queue': self.num_staff,
+            'duration': self.duration,
+            'think': self.think,
+            'seed': self.seed,
+        }
+        return build_report(config, clients, actions, connect_times, counter.counts, elapsed)
+
+
+class TrafficReplay:
+    """
+    Replays a recorded trace. Every recorded queue and anonymized account
+    gets a stand-in queue or user (named with `prefix`); accounts that took
+    staff actions on a queue are made staff of its stand-in. Staff actions
+    are aimed at whichever entry the staff member would most likely pick
+    from their latest snapshot, since entry ids are not recorded.
+    """
+
+    prefix = 'replay_'
+
+    def __init__(self, path, speed=1.0, limit=None):
+        self.path = path
+        self.speed = speed
+        self.events = traffic.load_trace(path)[:limit]
+        self.queues = {} # recorded queue id -> stand-in Queue
+        self.users = {} # anonymized account -> (user id, nickname, session key)
+        self.staff = set() # (recorded queue id, anonymized account)
+
+    def create_fixture(self):
+        first_action = {}
+        for _, consumer, queue_id, anon, action, _ in self.events:
+            if consumer == traffic.QUEUE_CONSUMER and action in traffic.STAFF_ACTIONS:
+                self.staff.add((queue_id, anon))
+            if consumer == traffic.QUEUE_CONSUMER and action in ('toggle-queue', 'ask-question'):
+                first_action.setdefault(queue_id, action)
+
+        for queue_id in sorted({e[2] for e in self.events if e[2] is not None}):
+            self.queues[queue_id] = Queue.objects.create(
+                queueName=f'{self.prefix}queue_{queue_id}',
+                courseNumber=f'98{queue_id % 1000:03d}',
+                description=f'Stand-in for queue {queue_id} from {self.path}',
+                # a queue that was toggled before anyone asked a question started closed
+                isOpen=first_action.get(queue_id) != 'toggle-queue',
+            )
+
+        for anon in sorted({e[3] for e in self.events if e[3] is not None}):
+            username = f'{self.prefix}{anon}'
+            user = User.objects.create(username=username, email=f'{username}@example.com')
+            user.set_unusable_password()
+            user.save()
+            Account.objects.filter(user=user).update(nickname=username)
+            self.users[anon] = (user.id, username, login_session(user))
+
+        for queue_id, anon in self.staff:
+            if queue_id in self.queues and anon in self.users:
+                account = Account.objects.get(user_id=self.users[anon][0])
+                self.queues[queue_id].allowedStaff.add(account)
+
+    def delete_fixture(self):
+        logout_sessions([session_key for _, _, session_key in self.users.values()])
+        delete_fixture_data(prefix=self.prefix)
+
+    def payload(self, client, consumer, action, size):
+        data = {'action': action}
+        if consumer == traffic.QUEUE_LIST_CONSUMER:
+            data['userID'] = str(client.user_id)
+            if action == 'pin':
+                data['queueID'] = next(iter(self.queues.values())).id if self.queues else 0
+            elif action == 'sort':
+                data['type'] = 'name'
+            elif action == 'search':
+                overhead = len(json.dumps({**data, 'query': ''}))
+                data['query'] = (self.prefix + 'queue_')[:max(0, size - overhead)]
+        elif action in ('ask-question', 'send-announcement'):
+            overhead = len(json.dumps({**data, 'text': ''}))
+            data['text'] = 'x' * max(1, size - overhead)
+        elif action in ('help', 'freeze', 'finish-help'):
+            entry_id = client.pick_entry(action)
+            if entry_id is None:
+                return None
+            data['entry_id'] = entry_id
+        elif action.startswith('batch-'):
+            # as many of the current entries as fit in the recorded message
+            data['entries'] = []
+            for entry in client.snapshot:
+                data['entries'].append({'entry_id': entry['id'], 'version': entry.get('version')})
+                if len(json.dumps(data)) > size:
+                    data['entries'].pop()
+                    break
+            if not data['entries']:
+                return None
+        return data
+
+    async def run(self):
+        from webapps.asgi import application
+
+        counter = QueryCounter()
+        clients = {} # currently connected, by (consumer, queue id, account)
+        all_clients = []
+        actions = []
+        connect_times = []
+        skipped = 0
+        max_lag = 0.0
+
+        async def client_for(consumer, queue_id, anon):
+            key = (consumer, queue_id, anon)
+            client = clients.get(key)
+            if client is not None and not client.closed:
+                return client
+            user_id, nickname, session_key = self.users[anon]
+            if consumer == traffic.QUEUE_LIST_CONSUMER:
+                client = SimulatedClient(application, None, 'queue-list', nickname, session_key,
+                                         path='/ohq/data/queue-list')
+            else:
+                role = 'staff' if (queue_id, anon) in self.staff else 'student'
+                client = SimulatedClient(application, self.queues[queue_id].id, role, nickname,
+                                         session_key)
+            client.user_id = user_id
+            start = time.perf_counter()
+            await client.connect()
+            connect_times.append(time.perf_counter() - start)
+            clients[key] = client
+            all_clients.append(client)
+            return client
+
+        counter.start()
+        try:
+            with instrument_consumers(counter):
+                start = time.perf_counter()
+                t0 = self.events[0][0] if self.events else 0
+                for recorded, consumer, queue_id, anon, action, size in self.events:
+                    if anon not in self.users:
+                        continue
+                    delay = (recorded - t0) / self.speed - (time.perf_counter() - start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    else:
+                        max_lag = max(max_lag, -delay)
+
+                    if action == 'disconnect':
+                        client = clients.pop((consumer, queue_id, anon), None)
+                        if client is not None:
+                            await client.disconnect()
+                        continue
+                    client = await client_for(consumer, queue_id, anon)
+                    if action == 'connect':
+                        continue
+                    data = self.payload(client, consumer, action, size)
+                    if data is None:
+                        skipped += 1
+                        continue
+                    actions.append((client.queue_id, action, time.perf_counter()))
+                    await client.send(data)
+                elapsed = time.perf_counter() - start
+                await asyncio.sleep(min(LATENCY_WINDOW, 2.0))
+                for client in clients.values():
+                    await client.disconnect()
+        finally:
+            counter.stop()
+
+        config = {
+            'trace': self.path,
+            'speed': self.speed,
+            'events': len(self.events),
+            'skipped_actions': skipped,
+            'max_schedule_lag': max_lag,
+        }
+        return build_report(config, all_clients, actions, connect_times,
+                            counter.counts, elapsed)
+
+
+def build_report(config, clients, actions, connect_times, query_counts, elapsed):
+    """
+    Summarizes a run. `actions` holds a (queue id, action, send time) tuple
+    for every action sent; broadcast latency is the time from each action
+    until every socket on that queue next receives a snapshot.
+    """
+    latencies = []
+    by_queue = {}
+    for client in clients:
+        by_queue.setdefault(client.queue_id, []).append(client)
+    for queue_id, _, sent in actions:
+        for client in by_queue[queue_id]:
+            i = bisect.bisect_left(client.snapshot_times, sent)
+            if i < len(client.snapshot_times) and client.snapshot_times[i] - sent <= LATENCY_WINDOW:
+                latencies.append(client.snapshot_times[i] - sent)
+
+    action_counts = {}
+    for _, action, _ in actions:
+        action_counts[action] = action_counts.get(action, 0) + 1
+    queries = {
+        label: {
+            'queries': count,
+            'per_action': count / action_counts[label] if label in action_counts else None,
+        }
+        for label, count in sorted(query_counts.items())
+    }
+    total_queries = sum(query_counts.values())
+
+    messages = {}
+    for role in sorted({c.role for c in clients}):
+        counts = [c.messages for c in clients if c.role == role]
+        if counts:
+            messages[role] = {
+                'sockets': len(counts),
+                'mean': sum(counts) / len(counts),
+                'min': min(counts),
+                'max': max(counts),
+            }
+
+    return {
+        'config': config,
+        'elapsed': elapsed,
+        'actions': len(actions),
+        'actions_by_type': action_counts,
+        'throughput': len(actions) / elapsed if elapsed else 0,
+        'messages_per_second': sum(c.messages for c in clients) / elapsed if elapsed else 0,
+        'connect_ms': summarize(connect_times, scale=1000),
+        'connect_retries': sum(c.retries for c in clients),
+        'broadcast_latency_ms': summarize(latencies, scale=1000),
+        'queries': queries,
+        'queries_per_action': total_queries / len(actions) if actions else None,
+        'messages_per_socket': messages,
+    }
+
+
+def login_session(user):
+    """Logs `user` in without going through the login views; returns the session key."""
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def logout_sessions(session_keys):
+    session_store = import_module(settings.SESSION_ENGINE).SessionStore
+    for session_key in session_keys:
+        session_store(session_key).delete()
+
+
+def delete_fixture_data(prefix=FIXTURE_PREFIX):
+    users = User.objects.filter(username__startswith=prefix)
+    accounts = Account.objects.filter(user__in=users)
+    livestate.flush()
+    AccountEntry.objects.filter(account__in=accounts).delete()
+    QueueHistory.objects.filter(account__in=accounts).delete()
+    Queue.objects.filter(queueName__startswith=prefix).delete()
+    accounts.delete()
+    users.delete()
+
+
+def format_report(report):
+    lines = []
+    config = report['config']
+    if 'trace' in config:
+        lines.append(f"replay of {config['trace']} at {config['speed']}x, {report['elapsed']:.1f}s")
+    else:
+        lines.append(f"{config['queues']} queue(s) x ({config['students_per_queue']} students + "
+                     f"{config['staff_per_queue']} staff), {report['elapsed']:.1f}s")
+    lines.append(f"actions: {report['actions']} ({report['throughput']:.1f}/s), "
+                 f"messages delivered: {report['messages_per_second']:.1f}/s")
+    for name in ('connect_ms', 'broadcast_latency_ms'):
+        stats = report[name]
+        if stats['count']:
+            lines.append(f"{name}: p50 {stats['p50']:.1f}  p90 {stats['p90']:.1f}  "
+                         f"p99 {stats['p99']:.1f}  max {stats['max']:.1f}  (n={stats['count']})")
+    if report['connect_retries']:
+        lines.append(f"connects turned away by admission control: {report['connect_retries']}")
+    lines.append('queries:')
+    for label, stats in report['queries'].items():
+        per_action = f"  ({stats['per_action']:.1f} per action)" if stats['per_action'] is not None else ''
+        lines.append(f"  {label}: {stats['queries']}{per_action}")
+    if report['queries_per_action'] is not None:
+        lines.append(f"  total per action: {report['queries_per_action']:.1f}")
+    lines.append('messages per socket:')
+    for role, stats in report['messages_per_socket'].items():
+        lines.append(f"  {role}: mean {stats['mean']:.1f}  min {stats['min']}  max {stats['max']}")
+    return '\n'.join(lines)
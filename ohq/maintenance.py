@@ -0,0 +1,139 @@
+"""
+Periodic maintenance, run by exactly one worker process at a time.
+
+Every process runs a small thread that competes for a lease: a Redis lock
+when REDIS_URL is set, and otherwise a local stand-in that is always held,
+since without Redis there is only one process. The holder renews the lease
+every RENEW_INTERVAL seconds and runs the registered tasks that are due. If
+it dies, the lease expires after LEASE seconds and another process takes
+over. Tasks run between renewals, so each must finish well within LEASE.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from ohq import snapshots
+from ohq.models import Queue
+
+logger = logging.getLogger(__name__)
+
+LEASE = 10
+RENEW_INTERVAL = 3
+
+
+class LocalLease:
+    def acquire(self):
+        return True
+
+    def renew(self):
+        return True
+
+
+class RedisLease:
+    def __init__(self, url):
+        import redis
+        # not thread-local: the token has to survive between the runner's loops
+        self.lock = redis.Redis.from_url(url).lock('ohq:maintenance-leader', timeout=LEASE, thread_local=False)
+
+    def acquire(self):
+        return self.lock.acquire(blocking=False)
+
+    def renew(self):
+        from redis.exceptions import LockError
+        try:
+            return self.lock.reacquire() # only while the lock is still ours
+        except LockError:
+            return False
+
+
+_tasks = []
+
+
+def task(interval):
+    """Registers a function for the leader to run every `interval` seconds."""
+    def register(function):
+        _tasks.append((function, interval))
+        return function
+    return register
+
+
+def run_forever(lease):
+    leading = False
+    next_run = {}
+    while True:
+        close_old_connections()
+        try:
+            leading = lease.renew() if leading else lease.acquire()
+        except Exception:
+            logger.exception('Could not reach the maintenance lease')
+            leading = False
+        if not leading:
+            next_run.clear() # whoever leads next starts the schedule afresh
+        else:
+            for function, interval in _tasks:
+                now = time.monotonic()
+                if now < next_run.get(function, 0):
+                    continue
+                next_run[function] = now + interval
+                try:
+                    function()
+                except Exception:
+                    logger.exception(f'Maintenance task {function.__name__} failed')
+        time.sleep(RENEW_INTERVAL)
+
+
+_runner = None
+_lock = threading.Lock()
+
+
+def start():
+    global _runner
+    with _lock:
+        if _runner is not None:
+            return
+        url = settings.OHQ_REDIS_URL
+        lease = RedisLease(url) if url else LocalLease()
+        _runner = threading.Thread(target=run_forever, args=(lease,), name='ohq-maintenance', daemon=True)
+        _runner.start()
+
+
+@task(interval=5)
+def unfreeze_due_students():
+    """
+    Rebuilds the snapshots of watched queues once they're due, which puts
+    timed-out frozen students back to waiting and tells the queue's sockets.
+    """
+    for queue_id in Queue.objects.filter(freeze_timeout__gt=0).values_list('id', flat=True):
+        if snapshots.is_due(queue_id):
+            snapshots.get_fresh_version(queue_id)
+
+
+@task(interval=60)
+def create_debug_queues():
+    # objects already exist. creating debug entry is unnecessary
+    if Queue.objects.exists():
+        return
+    queue = Queue()
+    queue.queueName = "Web Application Development"
+    queue.courseNumber = '17437'
+    queue.description = "This is a test queue with a very very very very very very very very very very very very long description"
+    queue.save()
+
+    queue2 = Queue()
+    queue2.queueName = "Foundations of Software Engineering"
+    queue2.courseNumber = '17313'
+    queue2.description = "See Piazza for OH rules"
+    queue2.save()
+    
+    queue3 = Queue()
+    queue3.queueName = "Principles of Imperative Computation"
+    queue3.courseNumber = '15122'
+    queue3.save()
+
+    queue4 = Queue()
+    queue4.queueName = "Distributed Systems"
+    queue4.courseNumber = '15440'
+    queue4.save()
@@ -0,0 +1,164 @@
+import contextlib
+import io
+import json
+import statistics
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import RequestFactory
+
+from ohq import views
+from ohq.management.commands.gen_dataset import QUEUE_MARKER, USER_PREFIX, generate, teardown
+from ohq.models import Account, AccountEntry, Queue
+
+DEFAULT_BASELINE = settings.BASE_DIR / 'ohq' / 'benchmark_baseline.json'
+
+# dataset sizes passed to gen_dataset's generate()
+TIERS = {
+    'small': {'users': 1000, 'queues': 30, 'students_per_private_queue': 50},
+    'medium': {'users': 5000, 'queues': 100, 'students_per_private_queue': 150},
+    'large': {'users': 20000, 'queues': 300, 'students_per_private_queue': 250},
+}
+
+
+class Command(BaseCommand):
+    help = ('Times and counts queries for the model-layer hot paths across dataset tiers, '
+            'writes the results as JSON and fails if query counts regress past a baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tiers', nargs='+', choices=list(TIERS), default=['small', 'medium'])
+        parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+        parser.add_argument('--output', help='write the JSON results to this file')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE),
+                            help='query-count baseline to compare against')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='overwrite the baseline with the query counts from this run')
+        parser.add_argument('--tolerance', type=int, default=0,
+                            help='extra queries allowed over the baseline before failing')
+        parser.add_argument('--keep', action='store_true',
+                            help='leave the last tier\'s dataset in the database')
+
+    def handle(self, *args, **options):
+        results = {'commit': current_commit(), 'vendor': connection.vendor, 'tiers': {}}
+        for tier in options['tiers']:
+            self.stdout.write(f'Generating {tier} dataset...')
+            teardown()
+            generate(seed=0, **TIERS[tier])
+            try:
+                results['tiers'][tier] = run_tier(options['repeat'])
+            finally:
+                if not options['keep'] or tier != options['tiers'][-1]:
+                    teardown()
+            for name, result in results['tiers'][tier].items():
+                self.stdout.write(f"  {name:<48} {result['median_ms']:9.2f} ms  "
+                                  f"{result['queries']:6d} queries")
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        if options['save_baseline']:
+            baseline = {tier: {name: result['queries'] for name, result in benches.items()}
+                        for tier, benches in results['tiers'].items()}
+            with open(options['baseline'], 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write(f"Saved baseline to {options['baseline']}")
+            return
+
+        try:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            self.stdout.write('No baseline found; skipping the query-count check.')
+            return
+
+        regressions = []
+        for tier, benches in results['tiers'].items():
+            for name, result in benches.items():
+                expected = baseline.get(tier, {}).get(name)
+                if expected is not None and result['queries'] > expected + options['tolerance']:
+                    regressions.append(f"{tier}/{name}: {result['queries']} queries (baseline {expected})")
+        if regressions:
+            raise CommandError('Query count regressions:\n  ' + '\n  '.join(regressions))
+        self.stdout.write('Query counts are within the baseline.')
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=settings.BASE_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def measure(func, repeat):
+    # the first call warms caches and is the one whose queries are counted.
+    # CaptureQueriesContext is capped by the 9000-entry query log, so count directly.
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count), contextlib.redirect_stdout(io.StringIO()):
+        func()
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'queries': queries,
+        'min_ms': min(timings),
+        'median_ms': statistics.median(timings),
+    }
+
+
+def run_tier(repeat):
+    """Runs every benchmark against whatever synthetic dataset is loaded."""
+    synthetic = Account.objects.filter(user__username__startswith=USER_PREFIX).order_by('id')
+    student = synthetic.filter(students__description__startswith=QUEUE_MARKER).first()
+    staff = synthetic.filter(staff__description__startswith=QUEUE_MARKER).first()
+    admin = synthetic.exclude(id__in=[student.id, staff.id]).first()
+    Account.objects.filter(id=admin.id).update(isAdmin=True)
+    admin.isAdmin = True
+
+    queues = Queue.objects.filter(description__startswith=QUEUE_MARKER)
+    busiest = queues.annotate(entries=Count('accountentry')).order_by('-entries', 'id').first()
+    private = queues.filter(isPublic=False).order_by('id').first() or busiest
+
+    factory = RequestFactory()
+
+    def api(view, path, params, *args):
+        def call():
+            request = factory.get(path, params)
+            request.user = admin.user
+            return view(request, *args)
+        return call
+
+    benches = {}
+    for label, account in (('student', student), ('staff', staff)):
+        for order in ('queueName', 'courseNumber', 'recent'):
+            benches[f'get_queues[{label},{order}]'] = lambda a=account, o=order: Queue.get_queues(a, orderBy=o)
+        for query in ('15', '15-1', 'Intro', 'Advanced Robotics'):
+            benches[f'get_queues_from_search[{label},{query}]'] = \
+                lambda a=account, q=query: Queue.get_queues_from_search(a, q)
+    benches['get_all_students'] = lambda: AccountEntry.get_all_students(busiest.id)
+    benches['get_staff'] = lambda: busiest.get_staff()
+    benches['get_students'] = lambda: private.get_students()
+    for query in ('ali', 'smith', 'synth_00001'):
+        benches[f'user_search_api[staff,{query}]'] = api(
+            views.user_search_api, '/', {'q': query, 'lookupStaff': 'true'}, private.id)
+        benches[f'user_search_api[student,{query}]'] = api(
+            views.user_search_api, '/', {'q': query, 'lookupStaff': 'false'}, private.id)
+        benches[f'site_search_api[{query}]'] = api(views.site_search_api, '/', {'q': query})
+
+    return {name: measure(func, repeat) for name, func in benches.items()}
@@ -0,0 +1,210 @@
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ohq.models import Account, AccountEntry, HelpSession, Queue, QueueHistory, QueueRollup
+
+# Generated users are named USER_PREFIX + number and generated queues have
+# descriptions starting with QUEUE_MARKER, so teardown never touches real data.
+USER_PREFIX = 'synth_'
+QUEUE_MARKER = '[synthetic] '
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'David', 'Erin', 'Frank', 'Grace', 'Heidi', 'Ivan',
+               'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy', 'Rupert', 'Sybil', 'Trent',
+               'Uma', 'Victor', 'Wendy', 'Xavier', 'Yara', 'Zach']
+LAST_NAMES = ['Smith', 'Nguyen', 'Garcia', 'Chen', 'Patel', 'Kim', 'Johnson', 'Lee', 'Brown',
+              'Martinez', 'Singh', 'Wang', 'Lopez', 'Davis', 'Wilson', 'Zhang', 'Khan']
+DEPARTMENTS = ['05', '10', '11', '15', '17', '18', '21', '36']
+TITLE_PREFIXES = ['Introduction to', 'Principles of', 'Foundations of', 'Advanced',
+                  'Topics in', 'Applied', 'Theory of', 'Practical']
+TITLE_SUBJECTS = ['Machine Learning', 'Computer Systems', 'Algorithms', 'Web Applications',
+                  'Distributed Systems', 'Databases', 'Software Engineering', 'Security',
+                  'Computer Graphics', 'Operating Systems', 'Compilers', 'Robotics',
+                  'Probability', 'Linear Algebra', 'Networks', 'Human-Computer Interaction']
+
+
+class Command(BaseCommand):
+    help = ('Bulk-generates synthetic users, accounts, queues, rosters, pins, hides, queue '
+            'history and live queue entries for scale testing, or tears them down again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--queues', type=int, default=300)
+        parser.add_argument('--private-ratio', type=float, default=0.3,
+                            help='fraction of queues that are private')
+        parser.add_argument('--open-ratio', type=float, default=0.2,
+                            help='fraction of queues that are open with students waiting')
+        parser.add_argument('--staff-per-queue', type=int, default=6)
+        parser.add_argument('--students-per-private-queue', type=int, default=250)
+        parser.add_argument('--pins-per-user', type=int, default=3)
+        parser.add_argument('--hides-per-user', type=int, default=1)
+        parser.add_argument('--history-per-user', type=int, default=8)
+        parser.add_argument('--entries-per-open-queue', type=int, default=40)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--teardown', action='store_true',
+                            help='delete all previously generated data instead of generating')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['teardown']:
+            deleted = teardown()
+            self.stdout.write(f'Deleted {deleted} rows in {time.perf_counter() - start:.1f}s')
+            return
+
+        counts = generate(**{key: options[key] for key in (
+            'users', 'queues', 'private_ratio', 'open_ratio', 'staff_per_queue',
+            'students_per_private_queue', 'pins_per_user', 'hides_per_user',
+            'history_per_user', 'entries_per_open_queue', 'batch_size', 'seed')},
+            log=self.stdout.write)
+        total = sum(counts.values())
+        self.stdout.write(f'Inserted {total} rows in {time.perf_counter() - start:.1f}s')
+
+
+def generate(users=20000, queues=300, private_ratio=0.3, open_ratio=0.2, staff_per_queue=6,
+             students_per_private_queue=250, pins_per_user=3, hides_per_user=1,
+             history_per_user=8, entries_per_open_queue=40, batch_size=5000, seed=0, log=None):
+    """
+    Inserts a synthetic dataset with bulk_create (so no signals fire) and
+    returns the number of rows inserted per table.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    counts = {}
+
+    def insert(model, objects):
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        name = model._meta.db_table
+        counts[name] = counts.get(name, 0) + len(objects)
+        if log:
+            log(f'  {name}: {len(objects)}')
+
+    with transaction.atomic():
+        # continue numbering after any earlier run so usernames stay unique
+        offset = User.objects.filter(username__startswith=USER_PREFIX).count()
+        password = make_password(None) # one unusable password hash shared by everyone
+        names = []
+        user_objects = []
+        for i in range(offset, offset + users):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            username = f'{USER_PREFIX}{i:07d}'
+            names.append(f'{first} {last}')
+            user_objects.append(User(username=username, first_name=first, last_name=last,
+                                     email=f'{username}@example.com', password=password,
+                                     date_joined=now))
+        insert(User, user_objects)
+        generated = Q(username__startswith=USER_PREFIX, username__gte=user_objects[0].username,
+                      username__lte=user_objects[-1].username) if user_objects else Q(pk__in=[])
+        user_ids = list(User.objects.filter(generated).order_by('username').values_list('id', flat=True))
+
+        insert(Account, [Account(user_id=user_id, email=user.email, nickname=name)
+                         for user_id, user, name in zip(user_ids, user_objects, names)])
+        account_ids = list(Account.objects.filter(user__in=User.objects.filter(generated))
+                           .values_list('id', flat=True))
+
+        queue_objects = []
+        for i in range(queues):
+            title = f'{rng.choice(TITLE_PREFIXES)} {rng.choice(TITLE_SUBJECTS)}'
+            queue_objects.append(Queue(
+                queueName=title[:50],
+                courseNumber=f'{rng.choice(DEPARTMENTS)}{rng.randrange(1000):03d}',
+                description=f'{QUEUE_MARKER}Office hours for {title}',
+                isPublic=rng.random() >= private_ratio,
+                isOpen=rng.random() < open_ratio,
+            ))
+        insert(Queue, queue_objects)
+        queue_rows = list(Queue.objects.filter(description__startswith=QUEUE_MARKER)
+                          .order_by('-id').values_list('id', 'isPublic', 'isOpen')[:queues])
+        public_ids = [queue_id for queue_id, is_public, _ in queue_rows if is_public]
+        public_set = set(public_ids)
+
+        # rosters; remember what each account can see for pins and history
+        visible = {}
+        staff_of = {}
+        staff_rows, student_rows = [], []
+        for queue_id, is_public, _ in queue_rows:
+            staff = rng.sample(account_ids, min(staff_per_queue, len(account_ids)))
+            staff_of[queue_id] = staff
+            for account_id in staff:
+                staff_rows.append(Queue.allowedStaff.through(queue_id=queue_id, account_id=account_id))
+                visible.setdefault(account_id, []).append(queue_id)
+            if not is_public:
+                staff = set(staff)
+                for account_id in rng.sample(account_ids, min(students_per_private_queue, len(account_ids))):
+                    student_rows.append(Queue.allowedStudents.through(queue_id=queue_id, account_id=account_id))
+                    if account_id not in staff:
+                        visible.setdefault(account_id, []).append(queue_id)
+        insert(Queue.allowedStaff.through, staff_rows)
+        insert(Queue.allowedStudents.through, student_rows)
+
+        pin_rows, hide_rows, history_rows = [], [], []
+        for account_id in account_ids:
+            choices = public_ids + [q for q in visible.get(account_id, []) if q not in public_set]
+            if not choices:
+                continue
+            picked = rng.sample(choices, min(len(choices), pins_per_user + hides_per_user))
+            for queue_id in picked[:pins_per_user]:
+                pin_rows.append(Queue.pinnedQueues.through(queue_id=queue_id, account_id=account_id))
+            for queue_id in picked[pins_per_user:]:
+                hide_rows.append(Queue.hiddenQueues.through(queue_id=queue_id, account_id=account_id))
+            for queue_id in rng.sample(choices, min(len(choices), history_per_user)):
+                history_rows.append(QueueHistory(
+                    account_id=account_id, queue_id=queue_id,
+                    lastUsedTime=now - timezone.timedelta(seconds=rng.randrange(120 * 24 * 3600))))
+        insert(Queue.pinnedQueues.through, pin_rows)
+        insert(Queue.hiddenQueues.through, hide_rows)
+        insert(QueueHistory, history_rows)
+
+        entry_rows = []
+        for queue_id, _, is_open in queue_rows:
+            if not is_open:
+                continue
+            students = rng.sample(account_ids, min(entries_per_open_queue, len(account_ids)))
+            for position, account_id in enumerate(students):
+                joined = now - timezone.timedelta(seconds=60 * (len(students) - position))
+                roll = rng.random()
+                entry = AccountEntry(joinTime=joined, account_id=account_id, queue_id=queue_id,
+                                     question=f'Question #{position + 1}',
+                                     status=AccountEntry.STATUS_WAITING)
+                if roll < 0.15:
+                    entry.status = AccountEntry.STATUS_HELPING
+                    entry.helping_staff_id = rng.choice(staff_of[queue_id])
+                elif roll < 0.25:
+                    entry.status = AccountEntry.STATUS_FROZEN
+                    entry.freezeTime = now - timezone.timedelta(seconds=rng.randrange(600))
+                entry_rows.append(entry)
+        insert(AccountEntry, entry_rows)
+
+    return counts
+
+
+def teardown():
+    """
+    Deletes everything generate() created, dependents first so nothing is
+    left for a cascade to collect. These are regular deletes, so the
+    post_delete signals (and the broadcasts they send) run for every row.
+    """
+    users = User.objects.filter(username__startswith=USER_PREFIX)
+    accounts = Account.objects.filter(user__in=users)
+    queues = Queue.objects.filter(description__startswith=QUEUE_MARKER)
+    deleted = 0
+    with transaction.atomic():
+        querysets = [
+            AccountEntry.objects.filter(Q(queue__in=queues) | Q(account__in=accounts)),
+            QueueHistory.objects.filter(Q(queue__in=queues) | Q(account__in=accounts)),
+            HelpSession.objects.filter(queue__in=queues),
+            QueueRollup.objects.filter(queue__in=queues),
+        ]
+        for through in (Queue.allowedStaff.through, Queue.allowedStudents.through,
+                        Queue.pinnedQueues.through, Queue.hiddenQueues.through):
+            querysets.append(through.objects.filter(Q(queue__in=queues) | Q(account__in=accounts)))
+        querysets += [queues, accounts, users]
+        for queryset in querysets:
+            deleted += queryset.delete()[0]
+    return deleted
@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+from ohq.loadtest import LoadTest, delete_fixture_data, format_report
+
+
+class Command(BaseCommand):
+    help = ('Simulates students and staff on queue pages over WebSockets and reports '
+            'throughput, broadcast latency, queries per action and messages per socket.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queues', type=int, default=1, help='number of queues to load')
+        parser.add_argument('--students', type=int, default=20, help='students per queue')
+        parser.add_argument('--staff', type=int, default=2, help='staff members per queue')
+        parser.add_argument('--duration', type=float, default=30.0, help='seconds to run for')
+        parser.add_argument('--think', type=float, default=1.0,
+                            help='mean seconds each client waits between actions')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', help='also write the full report to this file')
+        parser.add_argument('--keep', action='store_true',
+                            help='leave the generated users and queues in the database')
+        parser.add_argument('--cleanup', action='store_true',
+                            help='only delete data left behind by an earlier --keep run')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            delete_fixture_data()
+            return
+
+        harness = LoadTest(queues=options['queues'], students=options['students'],
+                           staff=options['staff'], duration=options['duration'],
+                           think=options['think'], seed=options['seed'])
+        harness.create_fixture()
+        try:
+            report = asyncio.run(harness.run())
+        finally:
+            if not options['keep']:
+                harness.delete_fixture()
+
+        self.stdout.write(format_report(report))
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+
+from ohq.loadtest import summarize
+from ohq.management.commands.benchmark import TIERS
+from ohq.management.commands.gen_dataset import QUEUE_MARKER, USER_PREFIX, generate, teardown
+from ohq.models import Account, Queue
+
+
+class Command(BaseCommand):
+    help = ('Requests the home page, a queue page and a queue settings page from many threads '
+            'at once and reports their latency and throughput at each concurrency level.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tier', choices=list(TIERS), default='small')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                            help='numbers of threads requesting at once')
+        parser.add_argument('--requests', type=int, default=200, help='requests per page per level')
+        parser.add_argument('--json', help='also write the results to this file')
+        parser.add_argument('--keep', action='store_true',
+                            help='leave the generated dataset in the database')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Generating {options['tier']} dataset...")
+        teardown()
+        generate(seed=0, **TIERS[options['tier']])
+        try:
+            results = run_pages(options['concurrency'], options['requests'])
+        finally:
+            if not options['keep']:
+                teardown()
+
+        for page, levels in results.items():
+            self.stdout.write(page)
+            for threads, result in levels.items():
+                latency = result['latency_ms']
+                self.stdout.write(f"  {threads:>4} threads  {result['per_second']:8.1f} req/s  "
+                                  f"p50 {latency['p50']:8.2f} ms  p90 {latency['p90']:8.2f} ms  "
+                                  f"p99 {latency['p99']:8.2f} ms" +
+                                  (f"  {result['errors']} errors" if result['errors'] else ''))
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+
+def run_pages(levels, requests):
+    synthetic = Account.objects.filter(user__username__startswith=USER_PREFIX).order_by('id')
+    queues = Queue.objects.filter(description__startswith=QUEUE_MARKER)
+    busiest = queues.annotate(entries=Count('accountentry')).order_by('-entries', 'id').first()
+    private = queues.filter(isPublic=False).order_by('id').first() or busiest
+    admin = synthetic.first()
+    Account.objects.filter(id=admin.id).update(isAdmin=True)
+
+    pages = {
+        'queue_list_action': (reverse('queue-list'), list(synthetic[:64])),
+        'queue_action': (reverse('queue', args=[busiest.id]), list(synthetic[:64])),
+        'queue_settings_action': (reverse('queue-settings', args=[private.id]), [admin]),
+    }
+    return {page: {threads: run_level(path, accounts, threads, requests) for threads in levels}
+            for page, (path, accounts) in pages.items()}
+
+
+def run_level(path, accounts, threads, requests):
+    """`requests` GETs of `path` spread over `threads` threads, each logged in as one of `accounts`."""
+    clients = []
+    for i in range(threads):
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(accounts[i % len(accounts)].user)
+        clients.append(client)
+    # one untimed request per client warms the caches a running server would have warm
+    with contextlib.redirect_stdout(io.StringIO()):
+        for client in clients:
+            client.get(path)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(client):
+        try:
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                    remaining[0] -= 1
+                start = time.perf_counter()
+                response = client.get(path)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if response.status_code != 200:
+                        errors.append(response.status_code)
+        finally:
+            close_old_connections()
+
+    workers = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # the views print their names
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'latency_ms': summarize(latencies, scale=1000),
+        'per_second': len(latencies) / elapsed,
+        'errors': len(errors),
+    }
@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ohq.loadtest import TrafficReplay, format_report
+
+
+class Command(BaseCommand):
+    help = ('Replays a WebSocket traffic recording (see OHQ_TRAFFIC_LOG) against stand-in '
+            'queues and users and reports the same measurements as loadtest.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help='file written by the traffic recorder')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='playback speed multiplier, e.g. 10 for ten times faster')
+        parser.add_argument('--limit', type=int, help='only replay the first LIMIT events')
+        parser.add_argument('--json', help='also write the full report to this file')
+        parser.add_argument('--keep', action='store_true',
+                            help='leave the stand-in users and queues in the database')
+
+    def handle(self, *args, **options):
+        if options['speed'] <= 0:
+            raise CommandError('--speed must be positive')
+        try:
+            replay = TrafficReplay(options['trace'], speed=options['speed'], limit=options['limit'])
+        except FileNotFoundError:
+            raise CommandError(f"{options['trace']} does not exist")
+
+        replay.create_fixture()
+        try:
+            report = asyncio.run(replay.run())
+        finally:
+            if not options['keep']:
+                replay.delete_fixture()
+
+        self.stdout.write(format_report(report))
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=2)
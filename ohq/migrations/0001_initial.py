@@ -0,0 +1,96 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Account',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('isAdmin', models.BooleanField(default=False)),
+                ('email', models.EmailField(max_length=25)),
+                ('nickname', models.CharField(blank=True, max_length=50)),
+                ('user', models.ForeignKey(default=None, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Queue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queueName', models.CharField(max_length=50)),
+                ('courseNumber', models.CharField(max_length=5)),
+                ('description', models.CharField(blank=True, max_length=500)),
+                ('isPublic', models.BooleanField(default=True)),
+                ('isOpen', models.BooleanField(default=False)),
+                ('freeze_timeout', models.IntegerField(default=600)),
+                ('allowedStaff', models.ManyToManyField(related_name='staff', to='ohq.account')),
+                ('allowedStudents', models.ManyToManyField(related_name='students', to='ohq.account')),
+                ('hiddenQueues', models.ManyToManyField(related_name='hidden', to='ohq.account')),
+                ('pinnedQueues', models.ManyToManyField(related_name='pinned', to='ohq.account')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HelpSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joinTime', models.DateTimeField()),
+                ('helpTime', models.DateTimeField()),
+                ('finishTime', models.DateTimeField()),
+                ('account', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='ohq.account')),
+                ('staff', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='helped_sessions', to='ohq.account')),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ohq.queue')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joinTime', models.DateTimeField()),
+                ('question', models.CharField(blank=True, max_length=500)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('helping', 'Being Helped'), ('frozen', 'Frozen')], default='waiting', max_length=16)),
+                ('freezeTime', models.DateTimeField(blank=True, null=True)),
+                ('helpTime', models.DateTimeField(blank=True, null=True)),
+                ('version', models.IntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='ohq.account')),
+                ('helping_staff', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='helping', to='ohq.account')),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ohq.queue')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QueueHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lastUsedTime', models.DateTimeField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='ohq.account')),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ohq.queue')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QueueRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('count', models.IntegerField(default=0)),
+                ('totalWait', models.FloatField(default=0)),
+                ('totalHelp', models.FloatField(default=0)),
+                ('waitHistogram', models.JSONField(default=list)),
+                ('helpHistogram', models.JSONField(default=list)),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ohq.queue')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('queue', 'granularity', 'start'), name='unique_queue_rollup')],
+            },
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import User # possibly unnecessary once we use Oauth?
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+import bisect
 
 # Stores additional information about a user of the OHQ outside of 
 # Django user class itself.
@@ -50,6 +52,8 @@ class Queue(models.Model):
     
     @classmethod
     def get_queues(cls, account, orderBy='queueName'):
+        from ohq import access
+        roles = access.get(account)
         pinned_list = []
         all_queues = []
         pinned = account.pinned.all()
@@ -59,9 +63,7 @@ class Queue(models.Model):
         else:
             all_entries = cls.objects.all().order_by(orderBy)
         for entry in all_entries:
-            is_staff = entry.allowedStaff.filter(id=account.id).exists() or account.isAdmin or account.user.is_superuser
-            if (not entry.isPublic and not (entry.allowedStudents.filter(id=account.id).exists()
-                                            or is_staff)):
+            if not roles.can_view(entry):
                 continue
             entry_dict = {
                 'id': entry.id,
@@ -80,6 +82,8 @@ class Queue(models.Model):
     def get_queues_from_search(cls, account, query):
         if query == '':
             return []
+        from ohq import access
+        roles = access.get(account)
         all_queues = []
         # query either is prefix of queue name or course number
         # allow for people to search by course code with or without the -
@@ -94,9 +98,7 @@ class Queue(models.Model):
             all_entries = cls.objects.filter(models.Q(queueName__istartswith=query) |
                                              models.Q(courseNumber__istartswith=query)).order_by('queueName')
         for entry in all_entries:
-            is_staff = entry.allowedStaff.filter(id=account.id).exists() or account.isAdmin or account.user.is_superuser
-            if (not entry.isPublic and not (entry.allowedStudents.filter(id=account.id).exists()
-                                            or is_staff)):
+            if not roles.can_view(entry):
                 continue
             entry_dict = {
                 'id': entry.id,
@@ -130,6 +132,8 @@ class AccountEntry(models.Model):
     status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_WAITING)
     helping_staff = models.ForeignKey(Account, on_delete=models.SET_NULL, null=True, blank=True, related_name='helping')
     freezeTime = models.DateTimeField(null=True, blank=True) # To store when the student was frozen
+    helpTime = models.DateTimeField(null=True, blank=True) # When staff most recently started helping
+    version = models.IntegerField(default=0) # Bumped by every change; staff actions say which version they saw
 
     @classmethod
     # expects that you do the error checking of whether queueID is valid earlier
@@ -146,7 +150,8 @@ class AccountEntry(models.Model):
                 'status': entry.status,
                 'joinTime': entry.joinTime.isoformat(),
                 'helping_staff_name': entry.helping_staff.nickname if entry.helping_staff else None,
-                'freezeTime': entry.freezeTime.isoformat() if entry.freezeTime else None
+                'freezeTime': entry.freezeTime.isoformat() if entry.freezeTime else None,
+                'version': entry.version,
             }
             entries_list.append(entry_dict)
         return entries_list
@@ -156,4 +161,126 @@ class AccountEntry(models.Model):
 class QueueHistory(models.Model):
     lastUsedTime = models.DateTimeField(blank = False)
     account = models.ForeignKey(Account, blank = False, on_delete = models.PROTECT)
-    queue = models.ForeignKey(Queue, blank = False, on_delete = models.CASCADE)
\ No newline at end of file
+    queue = models.ForeignKey(Queue, blank = False, on_delete = models.CASCADE)
+
+
+# Append-only archive of finished help sessions. Written when staff finish
+# helping a student, right before the AccountEntry itself is deleted.
+class HelpSession(models.Model):
+    queue = models.ForeignKey(Queue, on_delete = models.CASCADE)
+    account = models.ForeignKey(Account, on_delete = models.SET_NULL, null = True)
+    staff = models.ForeignKey(Account, on_delete = models.SET_NULL, null = True, related_name = 'helped_sessions')
+    joinTime = models.DateTimeField()
+    helpTime = models.DateTimeField()
+    finishTime = models.DateTimeField()
+
+    @classmethod
+    def archive(cls, entry, staff, finishTime):
+        # a student can be finished without ever being marked as helped
+        helpTime = entry.helpTime or finishTime
+        with transaction.atomic():
+            session = cls.objects.create(
+                queue_id = entry.queue_id,
+                account_id = entry.account_id,
+                staff = staff,
+                joinTime = entry.joinTime,
+                helpTime = helpTime,
+                finishTime = finishTime,
+            )
+            waitSeconds = max(0.0, (helpTime - entry.joinTime).total_seconds())
+            helpSeconds = max(0.0, (finishTime - helpTime).total_seconds())
+            for granularity in (QueueRollup.GRANULARITY_HOUR, QueueRollup.GRANULARITY_DAY):
+                QueueRollup.add_session(entry.queue_id, granularity, finishTime, waitSeconds, helpSeconds)
+        return session
+
+
+# Per-queue statistics over finished help sessions, one row per hour and
+# per day. Maintained on every archived session so that analytics never
+# need to scan HelpSession.
+class QueueRollup(models.Model):
+    GRANULARITY_HOUR = 'hour'
+    GRANULARITY_DAY = 'day'
+    GRANULARITY_CHOICES = [
+        (GRANULARITY_HOUR, 'Hourly'),
+        (GRANULARITY_DAY, 'Daily'),
+    ]
+    # Upper bounds (in seconds) of the histogram buckets used for the p90s.
+    # The last bucket holds everything longer than an hour.
+    BUCKET_BOUNDS = [30, 60, 120, 180, 300, 420, 600, 900, 1200, 1800, 2700, 3600]
+
+    queue = models.ForeignKey(Queue, on_delete = models.CASCADE)
+    granularity = models.CharField(max_length = 4, choices = GRANULARITY_CHOICES)
+    start = models.DateTimeField()
+    count = models.IntegerField(default = 0)
+    totalWait = models.FloatField(default = 0) # seconds
+    totalHelp = models.FloatField(default = 0) # seconds
+    waitHistogram = models.JSONField(default = list)
+    helpHistogram = models.JSONField(default = list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields = ['queue', 'granularity', 'start'], name = 'unique_queue_rollup'),
+        ]
+
+    @classmethod
+    def bucket_start(cls, granularity, time):
+        time = time.replace(minute = 0, second = 0, microsecond = 0)
+        if granularity == cls.GRANULARITY_DAY:
+            time = time.replace(hour = 0)
+        return time
+
+    @classmethod
+    def add_session(cls, queueID, granularity, finishTime, waitSeconds, helpSeconds):
+        # callers hold a transaction, so the row stays locked until it commits
+        rollup, _ = cls.objects.select_for_update().get_or_create(
+            queue_id = queueID,
+            granularity = granularity,
+            start = cls.bucket_start(granularity, finishTime),
+        )
+        rollup.count += 1
+        rollup.totalWait += waitSeconds
+        rollup.totalHelp += helpSeconds
+        rollup.waitHistogram = cls._add_to_histogram(rollup.waitHistogram, waitSeconds)
+        rollup.helpHistogram = cls._add_to_histogram(rollup.helpHistogram, helpSeconds)
+        rollup.save()
+
+    @classmethod
+    def _add_to_histogram(cls, histogram, seconds):
+        histogram = histogram or [0] * (len(cls.BUCKET_BOUNDS) + 1)
+        histogram[bisect.bisect_left(cls.BUCKET_BOUNDS, seconds)] += 1
+        return histogram
+
+    @classmethod
+    def _percentile(cls, histogram, p):
+        # upper bound of the bucket holding the p-th percentile (None past the last bound)
+        total = sum(histogram)
+        if total == 0:
+            return None
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if seen >= p / 100 * total:
+                return cls.BUCKET_BOUNDS[i] if i < len(cls.BUCKET_BOUNDS) else None
+        return None
+
+    def to_dict(self):
+        return {
+            'start': self.start.isoformat(),
+            'count': self.count,
+            'meanWait': self.totalWait / self.count if self.count else None,
+            'p90Wait': self._percentile(self.waitHistogram, 90),
+            'meanHelp': self.totalHelp / self.count if self.count else None,
+            'p90Help': self._percentile(self.helpHistogram, 90),
+        }
+
+    @classmethod
+    def get_recent(cls, queueID, granularity, buckets):
+        # one row per bucket, so this is constant-time however long the history is
+        since = cls.bucket_start(granularity, timezone.now())
+        if granularity == cls.GRANULARITY_DAY:
+            since -= timezone.timedelta(days = buckets - 1)
+        else:
+            since -= timezone.timedelta(hours = buckets - 1)
+        rollups = cls.objects.filter(queue_id = queueID, granularity = granularity,
+                                     start__gte = since).order_by('-start')
+        return [rollup.to_dict() for rollup in rollups]
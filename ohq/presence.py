@@ -0,0 +1,163 @@
+"""
+Heartbeat bookkeeping for open sockets.
+
+Every socket is pinged every PING_INTERVAL seconds and the client answers
+with a pong (see the Heartbeat mixin in ohq.consumers). A socket whose last
+pong is older than STALE_AFTER has missed a ping; once it is older than
+REAP_AFTER the socket is closed and taken out of its groups, so broadcasts
+stop paying for laptops that went to sleep mid-OH.
+
+Each worker knows only its own sockets. For the live/stale gauge, every
+worker publishes its per-group counts to the shared cache and gauge() adds
+up the recent ones. Joins and leaves only mark their groups dirty; a burst
+of them (say, every page reconnecting after a restart) is published
+FLUSH_DELAY later in one pass over the channels and one cache round trip.
+"""
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import cache
+
+PING_INTERVAL = 25
+STALE_AFTER = PING_INTERVAL + 10
+REAP_AFTER = 2 * PING_INTERVAL + 10
+REAP_CLOSE_CODE = 4001
+PUBLISH_INTERVAL = 10
+FLUSH_DELAY = 1
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+# channel name -> {'lastSeen': time of the last pong, 'groups': set of group names}
+_channels = {}
+_lock = threading.Lock()
+_published = {} # group name -> when this worker last published its counts
+_dirty = set() # groups whose membership changed since they were last published
+_flush_timer = None
+
+
+def connect(channel_name):
+    with _lock:
+        _channels.setdefault(channel_name, {'lastSeen': time.time(), 'groups': set()})
+
+
+def disconnect(channel_name):
+    with _lock:
+        entry = _channels.pop(channel_name, None)
+        if entry:
+            _mark_dirty(entry['groups'])
+
+
+def join(channel_name, group):
+    with _lock:
+        _channels.setdefault(channel_name, {'lastSeen': time.time(), 'groups': set()})['groups'].add(group)
+        _mark_dirty([group])
+
+
+def leave(channel_name, group):
+    with _lock:
+        entry = _channels.get(channel_name)
+        if not entry or group not in entry['groups']:
+            return
+        entry['groups'].discard(group)
+        _mark_dirty([group])
+
+
+def seen(channel_name):
+    with _lock:
+        entry = _channels.get(channel_name)
+        if entry:
+            entry['lastSeen'] = time.time()
+
+
+def is_connected(channel_name):
+    return channel_name in _channels
+
+
+def is_unresponsive(channel_name):
+    entry = _channels.get(channel_name)
+    return entry is not None and time.time() - entry['lastSeen'] > REAP_AFTER
+
+
+def groups(channel_name):
+    with _lock:
+        entry = _channels.get(channel_name)
+        return set(entry['groups']) if entry else set()
+
+
+def _count(groups):
+    # {group: [live, stale]} for this worker, in one pass over its channels; hold _lock
+    now = time.time()
+    counts = {group: [0, 0] for group in groups}
+    for entry in _channels.values():
+        stale = now - entry['lastSeen'] > STALE_AFTER
+        for group in entry['groups'] & counts.keys():
+            counts[group][stale] += 1
+    return counts
+
+
+def local_counts(group):
+    """This worker's live and stale members of `group`."""
+    with _lock:
+        return tuple(_count([group])[group])
+
+
+def _gauge_key(group):
+    return f'ohq:presence:{group}'
+
+
+def _store(counts):
+    # The read-modify-write can race with another worker, which only costs
+    # that worker's counts until its next publish.
+    now = time.time()
+    keys = {_gauge_key(group): group for group in counts}
+    current = cache.get_many(list(keys))
+    updates = {}
+    for key, group in keys.items():
+        workers = {worker: entry for worker, entry in (current.get(key) or {}).items() if now - entry[2] < REAP_AFTER}
+        workers[WORKER_ID] = (*counts[group], now)
+        updates[key] = workers
+        _published[group] = now
+    cache.set_many(updates, REAP_AFTER)
+
+
+def _mark_dirty(groups):
+    # hold _lock
+    global _flush_timer
+    _dirty.update(groups)
+    if _flush_timer is None and _dirty:
+        _flush_timer = threading.Timer(FLUSH_DELAY, publish_dirty)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def publish_dirty():
+    """Publishes every group whose membership changed since the last flush."""
+    global _flush_timer
+    with _lock:
+        _flush_timer = None
+        counts = _count(_dirty)
+        _dirty.clear()
+    if counts:
+        _store(counts)
+
+
+def publish(group):
+    # throttled per group: every member's heartbeat calls this
+    if time.time() - _published.get(group, 0) < PUBLISH_INTERVAL:
+        return
+    with _lock:
+        counts = _count([group])
+    _store(counts)
+
+
+def gauge(group):
+    """{'live': n, 'stale': m} members of `group` across all workers."""
+    now = time.time()
+    live = stale = 0
+    for worker_live, worker_stale, updated in (cache.get(_gauge_key(group)) or {}).values():
+        if now - updated < REAP_AFTER:
+            live += worker_live
+            stale += worker_stale
+    return {'live': live, 'stale': stale}
@@ -0,0 +1,214 @@
+"""
+Opt-in profiling of requests and socket messages.
+
+A site admin profiles one request by adding ?profile=1 (or an X-OHQ-Profile
+header) to it, and every message on a socket by opening the socket with
+?profile=1. Setting OHQ_PROFILE_SAMPLE_RATE also profiles that fraction of
+all requests and socket messages, so a queue that only goes slow in the
+middle of OH gets caught too.
+
+Each profile is a cProfile dump (open it with pstats or snakeviz) written
+to OHQ_PROFILE_DIR. The file name carries when it was taken, how long it
+took and what it was, so listing the slowest needs no index. Only the
+newest OHQ_PROFILE_KEEP files are kept. See the site-profiles page.
+"""
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from ohq import caches
+from ohq.models import Account
+
+logger = logging.getLogger(__name__)
+
+KIND_HTTP = 'http'
+KIND_SOCKET = 'socket'
+HEADER = 'X-OHQ-Profile'
+
+_local = threading.local() # cProfile can't nest, so only the outermost capture profiles
+
+
+def _is_admin(user, account=None):
+    if not user or not user.is_authenticated:
+        return False
+    if user.is_superuser:
+        return True
+    try:
+        return (account or caches.get_account(user)).isAdmin
+    except Account.DoesNotExist:
+        return False
+
+
+def sampled():
+    rate = settings.OHQ_PROFILE_SAMPLE_RATE
+    return rate > 0 and random.random() < rate
+
+
+def requested(request):
+    """Whether an admin asked for this request to be profiled."""
+    flag = request.GET.get('profile') or request.headers.get(HEADER)
+    return flag in ('1', 'true') and _is_admin(request.user)
+
+
+def requested_by_socket(scope, account):
+    """Whether an admin opened this socket with ?profile=1."""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('profile', [''])[0] in ('1', 'true') and _is_admin(scope.get('user'), account)
+
+
+def _file_name(kind, label, duration):
+    slug = re.sub(r'[^A-Za-z0-9.-]+', '-', label).strip('-')[:80] or 'unknown'
+    return f'{int(time.time() * 1000)}_{int(duration * 1e6)}_{kind}_{slug}.prof'
+
+
+def _parse(name):
+    if not name.endswith('.prof'):
+        return None
+    try:
+        taken, duration, kind, label = name[:-len('.prof')].split('_', 3)
+        return {
+            'name': name,
+            'taken': datetime.fromtimestamp(int(taken) / 1000, tz=timezone.utc),
+            'duration': int(duration) / 1000, # ms
+            'kind': kind,
+            'label': label,
+        }
+    except ValueError:
+        return None
+
+
+def _rotate(directory):
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.prof'))
+    for name in names[:max(0, len(names) - settings.OHQ_PROFILE_KEEP)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass # another worker got there first
+
+
+@contextmanager
+def capture(kind, label):
+    """
+    Profiles the block and saves the profile. Yields a dict that holds the
+    saved file's name under 'name' once the block is done.
+    """
+    trace = {'name': None}
+    if getattr(_local, 'active', False):
+        yield trace
+        return
+    profiler = cProfile.Profile()
+    _local.active = True
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield trace
+    finally:
+        profiler.disable()
+        _local.active = False
+        duration = time.perf_counter() - start
+        try:
+            os.makedirs(settings.OHQ_PROFILE_DIR, exist_ok=True)
+            trace['name'] = _file_name(kind, label, duration)
+            profiler.dump_stats(os.path.join(settings.OHQ_PROFILE_DIR, trace['name']))
+            _rotate(settings.OHQ_PROFILE_DIR)
+        except OSError:
+            logger.exception('Could not save a profile')
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the rest of the middleware and the view for chosen requests.
+    Async-capable, so it doesn't force async views onto a thread; the
+    profile of an async request also has whatever else the event loop ran
+    meanwhile.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not (sampled() or requested(request)):
+            return self.get_response(request)
+        with capture(KIND_HTTP, f'{request.method} {request.path}') as trace:
+            response = self.get_response(request)
+        if trace['name']:
+            response[HEADER] = trace['name']
+        return response
+
+    async def __acall__(self, request):
+        # requested() may load the user from the database
+        if not (sampled() or await sync_to_async(requested)(request)):
+            return await self.get_response(request)
+        with capture(KIND_HTTP, f'{request.method} {request.path}') as trace:
+            response = await self.get_response(request)
+        if trace['name']:
+            response[HEADER] = trace['name']
+        return response
+
+
+def profiled(method):
+    """
+    Profiles a consumer's receive or group-event handler when the socket
+    asked for it (its `profile_messages` attribute) or the message is sampled.
+    """
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        if not (getattr(self, 'profile_messages', False) or sampled()):
+            return method(self, *args, **kwargs)
+        label = f'{type(self).__name__}.{method.__name__}'
+        if getattr(self, 'id', None) is not None:
+            label += f' queue {self.id}'
+        if 'text_data' in kwargs:
+            try:
+                label += f' {json.loads(kwargs["text_data"]).get("action")}'
+            except (ValueError, AttributeError):
+                pass
+        with capture(KIND_SOCKET, label):
+            return method(self, *args, **kwargs)
+    return run
+
+
+def slowest(limit=50):
+    """The slowest profiles kept, slowest first."""
+    try:
+        names = os.listdir(settings.OHQ_PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    traces = [trace for trace in map(_parse, names) if trace]
+    return sorted(traces, key=lambda trace: trace['duration'], reverse=True)[:limit]
+
+
+def path(name):
+    """Path of a kept profile, or None if there's no such profile."""
+    if os.path.basename(name) != name or _parse(name) is None:
+        return None
+    full = os.path.join(settings.OHQ_PROFILE_DIR, name)
+    return full if os.path.exists(full) else None
+
+
+def report(name, lines=40):
+    """The pstats listing of a profile: its most expensive calls by cumulative time."""
+    out = io.StringIO()
+    stats = pstats.Stats(path(name), stream=out)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(lines)
+    return out.getvalue()
@@ -0,0 +1,134 @@
+"""
+Token buckets for admission control and per-action rate limits.
+
+After a restart every open page reconnects at once. New sockets are admitted
+through two buckets kept in each worker process: one for the whole worker and
+one per queue. A connect that finds either bucket empty is told how long to
+wait (close code RETRY_CLOSE_CODE) and the clients back off with jitter, so
+the reconnects spread out instead of arriving as one spike.
+
+Once connected, each action a queue socket sends is limited per socket and
+per account (see ActionLimiter).
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from ohq.caches import LRUCache
+
+# like HTTP 429; 4000-4999 are free for applications
+RETRY_CLOSE_CODE = 4029
+# a socket that can't keep up with its queue's updates is dropped with this code
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# how many snapshot versions a group event may be behind the queue's current
+# version when it reaches a consumer before the consumer counts as falling behind
+SLOW_CONSUMER_BACKLOG = 50
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, count=1):
+        """Takes `count` tokens; returns 0 if they were available, else seconds until they are."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return 0
+            return (count - self.tokens) / self.rate
+
+
+def _bucket(rate):
+    # a couple of seconds' worth of burst
+    return TokenBucket(rate, max(1, 2 * rate))
+
+
+worker_connects = _bucket(settings.OHQ_CONNECT_RATE)
+queue_connects = LRUCache(maxsize=5000)
+_queue_lock = threading.Lock()
+
+
+def _jitter(wait):
+    # spread the retries of clients rejected together over [wait, 2 * wait)
+    return round(wait * (1 + random.random()), 2)
+
+
+def admit_connect(queue_id=None):
+    """
+    Returns 0 when a new socket (for queue_id, if given) may connect now,
+    or how many seconds the client should wait before retrying.
+    """
+    wait = worker_connects.take()
+    if wait:
+        return _jitter(wait)
+    if queue_id is None:
+        return 0
+    with _queue_lock:
+        bucket = queue_connects.get(queue_id)
+        if bucket is None:
+            bucket = _bucket(settings.OHQ_QUEUE_CONNECT_RATE)
+            queue_connects.set(queue_id, bucket)
+    wait = bucket.take()
+    return _jitter(wait) if wait else 0
+
+
+# Queue socket actions: (tokens per second, burst). Anything not listed,
+# including unknown actions, shares the default bucket.
+ACTION_RATES = {
+    'refresh': (1, 3),
+    'ask-question': (0.2, 3),
+    'send-announcement': (0.1, 2),
+    'freeze-all': (0.1, 2),
+    'clear-queue': (0.1, 2),
+    'batch-help': (0.5, 5),
+    'batch-freeze': (0.5, 5),
+    'batch-unfreeze': (0.5, 5),
+    'batch-finish': (0.5, 5),
+    # batches also pay per student, at the rate of clicking them one by one;
+    # the burst covers one batch of QueueConsumer.max_batch
+    'batch-entries': (5, 500),
+}
+DEFAULT_ACTION_RATE = (5, 20)
+ACCOUNT_FACTOR = 2 # an account's limit across all its sockets, relative to one socket's
+
+account_actions = LRUCache(maxsize=20000)
+_account_lock = threading.Lock()
+
+
+class ActionLimiter:
+    """
+    One socket's buckets, one per action type, checked together with the
+    same account's buckets shared by all of its sockets in this worker.
+    """
+
+    def __init__(self, account_id):
+        self.account_id = account_id
+        self.buckets = {}
+
+    def check(self, action, cost=1):
+        """Returns 0 if `action` (taking `cost` tokens) may run now, else seconds until it may."""
+        key = action if action in ACTION_RATES else None
+        rate, burst = ACTION_RATES.get(action, DEFAULT_ACTION_RATE)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        wait = bucket.take(cost)
+        if wait:
+            return wait
+        with _account_lock:
+            shared = account_actions.get((self.account_id, key))
+            if shared is None:
+                shared = TokenBucket(rate * ACCOUNT_FACTOR, burst * ACCOUNT_FACTOR)
+                account_actions.set((self.account_id, key), shared)
+        return shared.take(cost)
@@ -1,7 +1,15 @@
 from django.urls import path
+from ohq.auth import CachedAuthMiddlewareStack
 from ohq import consumers
 
 websocket_urlpatterns = [
     path('ohq/data/queue/<int:id>', consumers.QueueConsumer.as_asgi()),
     path('ohq/data/queue-list', consumers.QueueListConsumer.as_asgi()),
-]
\ No newline at end of file
+    path('ohq/data/multiplex', consumers.MultiplexConsumer.as_asgi()),
+]
+
+# plain HTTP routes served by channels instead of Django; everything else falls through to urls.py
+http_urlpatterns = [
+    path('ohq/events/queue/<int:id>', CachedAuthMiddlewareStack(consumers.QueueEventsConsumer.as_asgi())),
+    path('api/queue/<int:id>/state', CachedAuthMiddlewareStack(consumers.QueueStateConsumer.as_asgi())),
+]
@@ -1,17 +1,28 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.db.models import Q
 from .models import Account, AccountEntry, Queue
 from .consumers import QueueConsumer, QueueListConsumer
+from . import access, caches, livestate, snapshots
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
+@receiver(pre_save, sender=User)
+def user_saving(sender, instance, update_fields=None, **kwargs):
+    # of the user's fields only is_superuser is in the access index; the
+    # last_login save at every sign-in leaves it alone
+    instance._was_superuser = None
+    if instance.id is not None and (update_fields is None or 'is_superuser' in update_fields):
+        instance._was_superuser = User.objects.filter(id=instance.id).values_list('is_superuser', flat=True).first()
+
 @receiver(post_save, sender=User)
 def create_or_update_ohq_account(sender, instance, created, **kwargs):
     """
     Automatically create or update an OHQ Account when a User is created or saved.
     This ensures an Account exists and the email is synced.
     """
+    caches.bump_user(instance.id)
     if created:
         # Create a new Account
         nickname = f"{instance.first_name} {instance.last_name}".title()
@@ -26,6 +37,8 @@ def create_or_update_ohq_account(sender, instance, created, **kwargs):
         # Update existing Account if email differs
         try:
             account = Account.objects.get(user=instance)
+            if getattr(instance, '_was_superuser', None) not in (None, instance.is_superuser):
+                access.bump([account.id])
             if account.email != instance.email:
                 account.email = instance.email
                 account.save()
@@ -40,6 +53,56 @@ def create_or_update_ohq_account(sender, instance, created, **kwargs):
                 nickname=nickname
             )
 
+# what other pages show of an account; saves that change none of it only drop the account's own cache
+ACCOUNT_SHOWN_FIELDS = ('nickname', 'email', 'isAdmin')
+
+@receiver(pre_save, sender=Account)
+def account_saving(sender, instance, update_fields=None, **kwargs):
+    instance._previous = None
+    if instance.id is not None and (update_fields is None or set(update_fields) & set(ACCOUNT_SHOWN_FIELDS)):
+        instance._previous = Account.objects.filter(id=instance.id).values(*ACCOUNT_SHOWN_FIELDS).first()
+
+@receiver(post_save, sender=Account)
+def account_updated(sender, instance, created, **kwargs):
+    """
+    Queue snapshots show nicknames, so any queue this account is on is stale
+    once its nickname changes.
+    """
+    caches.bump_user(instance.user_id)
+    if created:
+        caches.bump_accounts() # user searches
+        return
+    previous = getattr(instance, '_previous', None) or {}
+    changed = {name for name in previous if previous[name] != getattr(instance, name)}
+    if not changed:
+        return
+    if 'isAdmin' in changed:
+        access.bump([instance.id])
+    if changed & {'nickname', 'email'}:
+        caches.bump_accounts() # user searches
+        # queue settings pages list the nickname and email of everyone on the roster
+        for queue_id in Queue.objects.filter(Q(allowedStaff=instance) | Q(allowedStudents=instance)) \
+                                     .values_list('id', flat=True).distinct():
+            caches.bump_queue_page(queue_id)
+    if 'nickname' in changed:
+        livestate.flush() # live entries hold the old nickname, and may not be in the table yet
+        for queue_id in AccountEntry.objects.filter(account=instance).values_list('queue_id', flat=True):
+            livestate.discard(queue_id)
+            snapshots.bump(queue_id)
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Account)
+def account_deleted(sender, instance, **kwargs):
+    caches.bump_user(instance.id if sender is User else instance.user_id)
+    caches.bump_accounts()
+
+@receiver(pre_save, sender=Queue)
+def queue_saving(sender, instance, **kwargs):
+    # the pages that showed the queue before this save need to hear about it too
+    instance._previous = None
+    if instance.id is not None:
+        instance._previous = Queue.objects.filter(id=instance.id).values('courseNumber', 'isPublic').first()
+
 @receiver(post_save, sender=Queue)
 def queue_updated(sender, instance, created, **kwargs):
     """
@@ -48,22 +111,24 @@ def queue_updated(sender, instance, created, **kwargs):
     staff status possibly changing, etc.
     """
     channel_layer = get_channel_layer()
+    caches.bump_queue_page(instance.id)
 
-    # trigger entire home page to refresh for everyone
-    group_name = QueueListConsumer.group_name
-    async_to_sync(channel_layer.group_send)(
-        group_name,
-        {
-            'type': 'queue_add',
-        }
-    )
+    # trigger the home pages that show this queue to refresh
+    groups = QueueListConsumer.queue_groups(instance.id, instance.courseNumber, instance.isPublic)
+    previous = getattr(instance, '_previous', None)
+    if previous:
+        groups |= QueueListConsumer.queue_groups(instance.id, previous['courseNumber'], previous['isPublic'])
+    QueueListConsumer.notify(groups, {'type': 'queue_add'})
     if not created:
+        snapshots.bump(instance.id)
         # inform those who are vieiwng the queue that the queue has been updated
         group_name = QueueConsumer.group_name + f'_{instance.id}'
         async_to_sync(channel_layer.group_send)(
             group_name,
             {
                 'type': 'queue_update',
+                'stream': 'queue',
+                'queueID': instance.id,
                 'model_data': {
                     'queue-status': instance.isOpen,
                     'queue-publicity': instance.isPublic,
@@ -77,6 +142,9 @@ def queue_deleted(sender, instance, **kwargs):
     When a queue is deleted, anyone currently viewing that queue
     should be redirected to the home page
     """
+    snapshots.bump(instance.id) # drops cached copies of the queue
+    caches.bump_queue_page(instance.id)
+    livestate.discard(instance.id)
     channel_layer = get_channel_layer()
 
     # inform those that are viewing the queue that the queue has been deleted
@@ -85,31 +153,61 @@ def queue_deleted(sender, instance, **kwargs):
         group_name,
         {
             'type': 'queue_delete',
+            'stream': 'queue',
+            'queueID': instance.id,
         }
     )
 
     # inform those on the home page that the queue has been deleted
-    group_name = QueueListConsumer.group_name
-    async_to_sync(channel_layer.group_send)(
-        group_name,
-        {
-            'type': 'queue_delete',
-            'queueID': instance.id,
-        }
+    QueueListConsumer.notify(
+        QueueListConsumer.queue_groups(instance.id, instance.courseNumber, instance.isPublic),
+        {'type': 'queue_delete', 'queueID': instance.id}
     )
 
+@receiver(m2m_changed, sender=Queue.allowedStaff.through)
+@receiver(m2m_changed, sender=Queue.allowedStudents.through)
+def roster_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    The queue's settings page lists its roster, and the access index of
+    everyone added or removed is stale. They may also now belong to a
+    different course's home page group, which only their own pages can
+    work out.
+    """
+    if action == 'pre_clear':
+        # the rows are gone by post_clear, so note whose they were
+        if reverse:
+            instance._cleared = set(sender.objects.filter(account_id=instance.id).values_list('queue_id', flat=True))
+        else:
+            instance._cleared = set(sender.objects.filter(queue_id=instance.id).values_list('account_id', flat=True))
+        return
+    if action == 'post_clear':
+        action, pk_set = 'post_remove', getattr(instance, '_cleared', None)
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    for queue_id in (pk_set if reverse else [instance.id]):
+        caches.bump_queue_page(queue_id)
+    account_ids = [instance.id] if reverse else pk_set
+    groups = [QueueListConsumer.account_group(id) for id in account_ids]
+    access.bump(account_ids, then=lambda: QueueListConsumer.notify(groups, {'type': 'queue_add'}))
+
 @receiver(post_save, sender=AccountEntry)
 def accountEntry_updated(sender, instance, **kwargs):
     """
     If the staff member is made no longer staff but they are helping a student,
     the corresponding account entry should be updated.
     """
+    if livestate.writing_behind():
+        return # the live state already has it
+    livestate.discard(instance.queue_id)
+    snapshots.bump(instance.queue_id)
     channel_layer = get_channel_layer()
     group_name = QueueConsumer.group_name + f'_{instance.queue.id}'
     async_to_sync(channel_layer.group_send)(
         group_name,
         {
-            'type': 'refresh_account_entries'
+            'type': 'refresh_account_entries',
+            'stream': 'queue',
+            'queueID': instance.queue_id,
         }
     )
 
@@ -120,11 +218,17 @@ def accountEntry_deleted(sender, instance, **kwargs):
     Account entries can be deleted when an account is removed from having
     access to a queue. List of students on the queue should be updated.
     """
+    if livestate.writing_behind():
+        return # the live state already has it
+    livestate.discard(instance.queue_id)
+    snapshots.bump(instance.queue_id)
     channel_layer = get_channel_layer()
     group_name = QueueConsumer.group_name + f'_{instance.queue.id}'
     async_to_sync(channel_layer.group_send)(
         group_name,
         {
-            'type': 'refresh_account_entries'
+            'type': 'refresh_account_entries',
+            'stream': 'queue',
+            'queueID': instance.queue_id,
         }
     )
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+Versioned snapshots of a queue's state.
+
+Every write that changes what a queue page shows bumps a per-queue version
+number kept in the cache (see ohq.signals). The last snapshot built for a
+queue is cached along with the version it was built at, so sending the state
+again, whether to a socket group or to an HTTP poller, costs a cache read
+until something actually changes.
+"""
+import time
+from datetime import datetime
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from ohq import estimates, livestate
+from ohq.models import AccountEntry, Queue
+
+MAX_AGE = 60 # rebuild at least this often so the wait estimates don't go stale
+SNAPSHOT_TIMEOUT = 3600
+
+
+def _version_key(queue_id):
+    return f'ohq:queue-version:{queue_id}'
+
+
+def _snapshot_key(queue_id):
+    return f'ohq:queue-snapshot:{queue_id}'
+
+
+def get_version(queue_id):
+    version = cache.get(_version_key(queue_id))
+    if version is None:
+        # start from the clock so a flushed cache never hands out an old version again
+        version = int(time.time() * 1000)
+        if not cache.add(_version_key(queue_id), version, None):
+            version = cache.get(_version_key(queue_id), version)
+    return version
+
+
+def bump(queue_id):
+    try:
+        cache.incr(_version_key(queue_id))
+    except ValueError:
+        get_version(queue_id)
+
+
+def _is_fresh(cached, version):
+    return cached and cached['message']['version'] == version and time.time() < cached['staleAt']
+
+
+def is_due(queue_id):
+    """Whether a snapshot is cached for the queue and due to be rebuilt."""
+    cached = cache.get(_snapshot_key(queue_id))
+    return cached is not None and time.time() >= cached['staleAt']
+
+
+def get_fresh_version(queue_id):
+    """
+    The current version, after rebuilding the snapshot if the cached one
+    has gone stale (e.g. a frozen student is due to be unfrozen, which
+    changes the queue without any write having bumped the version).
+    """
+    version = get_version(queue_id)
+    if _is_fresh(cache.get(_snapshot_key(queue_id)), version):
+        return version
+    message = get(queue_id)
+    if message['version'] != version:
+        # students were unfrozen during the rebuild; the sockets need to hear about it too
+        from ohq.consumers import QueueConsumer
+        async_to_sync(get_channel_layer().group_send)(
+            QueueConsumer.group_name + f'_{queue_id}',
+            {'type': 'broadcast_event', 'stream': 'queue', 'queueID': queue_id, 'message': message}
+        )
+    return message['version']
+
+
+def get(queue_id):
+    """
+    Returns the snapshot QueueConsumer broadcasts, plus its 'version'.
+    Raises Queue.DoesNotExist for unknown queues.
+    """
+    version = get_version(queue_id)
+    cached = cache.get(_snapshot_key(queue_id))
+    if _is_fresh(cached, version):
+        return cached['message']
+
+    queue = Queue.objects.get(id=queue_id)
+    if livestate.unfreeze_stale(queue):
+        version = get_version(queue_id)
+    # read the version before the entries: a write that lands in between
+    # bumps it again and the next call rebuilds
+    students = estimates.annotate(queue_id, livestate.get_all_students(queue_id))
+    message = {
+        'version': version,
+        'queue-status': queue.isOpen,
+        'students': students,
+        'queue_freeze_timeout': queue.freeze_timeout,
+    }
+
+    # the snapshot also has to be rebuilt when the next frozen student is due to be unfrozen
+    stale_at = time.time() + MAX_AGE
+    if queue.freeze_timeout > 0:
+        for student in students:
+            if student['status'] == AccountEntry.STATUS_FROZEN and student['freezeTime']:
+                due = datetime.fromisoformat(student['freezeTime']).timestamp() + queue.freeze_timeout
+                stale_at = min(stale_at, due)
+    cache.set(_snapshot_key(queue_id), {'message': message, 'staleAt': stale_at}, SNAPSHOT_TIMEOUT)
+    return message
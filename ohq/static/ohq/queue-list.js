@@ -15,7 +15,28 @@ const QueueList = Object.freeze({
 })
 
 
+// Reconnect backoff: doubles per failed attempt up to the cap, with jitter so a
+// restarted server isn't hit by every page at the same moment
+const RECONNECT_BASE = 1000
+const RECONNECT_MAX = 30000
+let reconnectAttempts = 0
+let retryAfterHint = 0 // seconds, from the server's "retry" message
+
+// The server pings every 25s. If nothing at all arrives for this long the
+// connection is dead, even if the browser hasn't noticed yet.
+const HEARTBEAT_TIMEOUT = 60000
+let heartbeatTimer = null
+
+
 function connectToServer() {
+    openSocket()
+
+    // Handling updating template upon entering a search query
+    let searchInput = document.getElementById("search")
+    searchInput.addEventListener('input', searchAction)
+}
+
+function openSocket() {
     // Use wss: protocol if site using https:, otherwise use ws: protocol
     let wsProtocol = window.location.protocol === "https:" ? "wss:" : "ws:"
 
@@ -24,30 +45,59 @@ function connectToServer() {
     // websocket handshake process done here
     socket = new WebSocket(url)
 
+    socket.onopen = function(event) {
+        resetHeartbeatTimer()
+    }
+
     // Handle any errors that occur.
     socket.onerror = function(error) {
         displayError("WebSocket Error: " + error)
     }
 
-    // // Show a connected message when the WebSocket is opened.
-    // socket.onopen = function(event) {
-    //     displayError("WebSocket Connected")
-    // }
-
-    // // Show a disconnected message when the WebSocket is closed.
-    // socket.onclose = function(event) {
-    //     displayError("WebSocket Disconnected")
-    // }
+    socket.onclose = function(event) {
+        clearTimeout(heartbeatTimer)
+        scheduleReconnect()
+    }
 
     // Handle messages received from the server.
     socket.onmessage = function(event) {
+        resetHeartbeatTimer()
         let response = JSON.parse(event.data)
+        if (response.type === 'ping') {
+            socket.send(JSON.stringify({type: "pong"}))
+            return
+        }
+        if (response.type === 'retry') {
+            retryAfterHint = response.retryAfter
+            return
+        }
+        if (reconnectAttempts > 0 && !response.hasOwnProperty('error')) {
+            // back after a reconnect; restore the search the page is showing
+            reconnectAttempts = 0
+            displayError("")
+            if (document.getElementById("search").value.trim() !== "") searchAction()
+        }
         updateState(response)
     }
+}
 
-    // Handling updating template upon entering a search query
-    let searchInput = document.getElementById("search")
-    searchInput.addEventListener('input', searchAction)
+function resetHeartbeatTimer() {
+    clearTimeout(heartbeatTimer)
+    heartbeatTimer = setTimeout(function() {
+        // closing a dead socket can take minutes to report, so don't wait for onclose
+        socket.onclose = null
+        socket.close()
+        scheduleReconnect()
+    }, HEARTBEAT_TIMEOUT)
+}
+
+function scheduleReconnect() {
+    // exponential backoff with "equal jitter", but never sooner than the server asked
+    let backoff = Math.min(RECONNECT_MAX, RECONNECT_BASE * Math.pow(2, reconnectAttempts))
+    let delay = Math.max(retryAfterHint * 1000, backoff / 2 + Math.random() * backoff / 2)
+    reconnectAttempts += 1
+    retryAfterHint = 0
+    setTimeout(openSocket, delay)
 }
 
 function displayError(message) {
@@ -75,6 +125,9 @@ function updateState(response) {
             }
             removeQueueFromPage(response['queueID'])
         }
+        if (response['type'] == 'task') {
+            showTaskProgress(response)
+        }
         return
     }
 
@@ -95,6 +148,22 @@ function updateState(response) {
     }
 }
 
+// Progress of a background task this user started, e.g. deleting a queue
+const TASK_NAMES = {'delete-queue': 'Deleting queue', 'roster-removed': 'Updating roster'}
+
+function showTaskProgress(task) {
+    let name = TASK_NAMES[task.task] || task.task
+    if (task.state === 'done') {
+        displayError("")
+    } else if (task.state === 'failed') {
+        displayError(`${name} failed: ${task.error}`)
+    } else if (task.total) {
+        displayError(`${name}... (${task.done} of ${task.total})`)
+    } else {
+        displayError(`${name}...`)
+    }
+}
+
 // Remove queue entry from pinned section and all queues section
 function removeQueueFromPage(queueID) {
     let pinnedItems = document.querySelectorAll(".queue-item-box.pinned-list")
@@ -194,18 +263,26 @@ function makeQueueItemElement(queueItem, queueListType) {
 
 function pinQueue(queueID) {
     let data = {action: "pin", userID: userID, queueID: queueID}
-    socket.send(JSON.stringify(data))
+    sendToServer(data)
 }
 
 function sortQueues(sortType) {
     let data = {action: "sort", userID: userID, type: sortType}
-    socket.send(JSON.stringify(data))
+    sendToServer(data)
 }
 
 function searchAction() {
     const searchInput = document.getElementById("search")
     const query = searchInput.value.trim()
     let data = {action: "search", userID: userID, query: query}
+    sendToServer(data)
+}
+
+function sendToServer(data) {
+    if (socket.readyState !== WebSocket.OPEN) {
+        displayError("Reconnecting to the server...")
+        return
+    }
     socket.send(JSON.stringify(data))
 }
 
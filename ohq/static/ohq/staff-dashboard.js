@@ -0,0 +1,227 @@
+"use strict"
+
+// Staff dashboard: every queue panel on the page is one stream of a single
+// multiplexed socket (see MultiplexConsumer in consumers.py).
+
+let socket = null
+
+// Reconnect backoff: doubles per failed attempt up to the cap, with jitter so a
+// restarted server isn't hit by every page at the same moment
+const RECONNECT_BASE = 1000
+const RECONNECT_MAX = 30000
+let reconnectAttempts = 0
+let retryAfterHint = 0 // seconds, from the server's "retry" message
+let retryingQueues = new Set() // queue streams the server asked us to resubscribe to later
+let panelStudents = {} // queue id -> the students last shown in its panel
+
+// The server pings every 25s. If nothing at all arrives for this long the
+// connection is dead, even if the browser hasn't noticed yet.
+const HEARTBEAT_TIMEOUT = 60000
+let heartbeatTimer = null
+
+
+function connectToServer() {
+    // Use wss: protocol if site using https:, otherwise use ws: protocol
+    let wsProtocol = window.location.protocol === "https:" ? "wss:" : "ws:"
+
+    let url = `${wsProtocol}//${window.location.host}/ohq/data/multiplex`
+    socket = new WebSocket(url)
+
+    socket.onerror = function(error) {
+        displayError("WebSocket Error: " + error)
+    }
+
+    // Subscribe to every queue shown on the page
+    socket.onopen = function(event) {
+        resetHeartbeatTimer()
+        document.querySelectorAll(".dashboard-panel").forEach((panel) => {
+            subscribe(parseInt(panel.dataset.queueId))
+        })
+    }
+
+    socket.onclose = function(event) {
+        clearTimeout(heartbeatTimer)
+        scheduleReconnect()
+    }
+
+    socket.onmessage = function(event) {
+        resetHeartbeatTimer()
+        let response = JSON.parse(event.data)
+
+        if (response.type === 'ping') {
+            socket.send(JSON.stringify({type: "pong"}))
+            return
+        }
+        if (response.type === 'retry') {
+            if (response.stream === "queue") {
+                // just this queue was turned away; the socket itself is fine
+                retryingQueues.add(response.queueID)
+                setTimeout(function() {
+                    retryingQueues.delete(response.queueID)
+                    subscribe(response.queueID)
+                }, response.retryAfter * 1000)
+            } else {
+                retryAfterHint = response.retryAfter
+            }
+            return
+        }
+        if (response.hasOwnProperty('students') && reconnectAttempts > 0) {
+            reconnectAttempts = 0
+            displayError("")
+        }
+
+        if (response.hasOwnProperty('error') && !response.hasOwnProperty('stream')) {
+            displayError(response.error)
+            return
+        }
+        if (response.stream !== "queue") return
+
+        let panel = document.getElementById(`queue-panel-${response.queueID}`)
+        if (panel === null) return
+
+        if (response.type === 'stream-closed' && retryingQueues.has(response.queueID)) {
+            return
+        }
+        if (response.type === 'queue-deleted' || response.type === 'stream-closed' || response.type === 'redirect-home') {
+            panel.remove()
+            return
+        }
+        if (response.type === 'announcement' || response.type === 'connection_established') {
+            return
+        }
+        if (response.type === 'conflict') {
+            // another staff member got to this student first: show what they did
+            displayError(response.error)
+            patchEntry(panel, response.entryID, response.entry)
+            return
+        }
+        if (response.hasOwnProperty('error')) {
+            displayError(response.error)
+            return
+        }
+
+        updatePanel(panel, response)
+    }
+}
+
+function resetHeartbeatTimer() {
+    clearTimeout(heartbeatTimer)
+    heartbeatTimer = setTimeout(function() {
+        // closing a dead socket can take minutes to report, so don't wait for onclose
+        socket.onclose = null
+        socket.close()
+        scheduleReconnect()
+    }, HEARTBEAT_TIMEOUT)
+}
+
+function scheduleReconnect() {
+    // exponential backoff with "equal jitter", but never sooner than the server asked
+    let backoff = Math.min(RECONNECT_MAX, RECONNECT_BASE * Math.pow(2, reconnectAttempts))
+    let delay = Math.max(retryAfterHint * 1000, backoff / 2 + Math.random() * backoff / 2)
+    reconnectAttempts += 1
+    retryAfterHint = 0
+    displayError("Connection lost. Reconnecting...")
+    setTimeout(connectToServer, delay)
+}
+
+function subscribe(queueID) {
+    if (socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({subscribe: "queue", queueID: queueID}))
+    }
+}
+
+function displayError(message) {
+    let errorElement = document.getElementById("error")
+    if (errorElement !== null) {
+        errorElement.innerHTML = sanitize(message)
+    }
+}
+
+// ===================SERVER TO CLIENT FUNCTIONS=====================
+
+function updatePanel(panel, response) {
+    if (response.hasOwnProperty('queue-status')) {
+        let label = panel.querySelector(".queue-status-label")
+        label.innerHTML = response['queue-status'] ? "OPEN" : "CLOSED"
+        label.className = "queue-status-label " + (response['queue-status'] ? "open-status" : "close-status")
+        panel.querySelector(".toggle-queue-btn").innerText = response['queue-status'] ? "Close Queue" : "Open Queue"
+    }
+
+    if (response.hasOwnProperty('students')) {
+        let queueID = parseInt(panel.dataset.queueId)
+        let entries = response['students']
+        panelStudents[queueID] = entries
+        let waiting = entries.filter((entry) => entry.status === 'waiting').length
+        panel.querySelector(".student-count").innerText = `${entries.length} on the queue, ${waiting} waiting`
+
+        let list = panel.querySelector(".student-queue-list")
+        list.innerHTML = ""
+        if (entries.length === 0) {
+            list.innerHTML = "<p>The queue is empty.</p>"
+        }
+        entries.forEach((entry, index) => {
+            list.append(createEntry(queueID, entry, index + 1))
+        })
+    }
+}
+
+function patchEntry(panel, entryID, entry) {
+    let entries = panelStudents[parseInt(panel.dataset.queueId)] || []
+    let index = entries.findIndex((student) => student.id == entryID)
+    if (index === -1) return
+    if (entry === null) {
+        entries.splice(index, 1)
+    } else {
+        entries[index] = Object.assign({}, entries[index], entry)
+    }
+    updatePanel(panel, {students: entries})
+}
+
+function createEntry(queueID, entry, position) {
+    let elem = document.createElement("div")
+    elem.className = "queue-list-item"
+
+    let statusIndicator = ""
+    if (entry.status === 'helping') {
+        let safeStaffName = entry.helping_staff_name ? sanitize(entry.helping_staff_name) : "";
+        statusIndicator = `<span class="status-helping">(Helping: ${safeStaffName})</span>`
+    } else if (entry.status === 'frozen') {
+        statusIndicator = `<span class="status-frozen">(Frozen)</span>`
+    }
+
+    let left = `<div><strong>#${position} ${sanitize(entry.name)}</strong> ${statusIndicator}<br><p>${sanitize(entry.question)}</p></div>`
+    let buttons = `
+        <button class="btn-primary" onclick="sendAction(${queueID}, 'help', ${entry.id}, ${entry.version})">Help</button>
+        <button class="btn-secondary" onclick="sendAction(${queueID}, 'freeze', ${entry.id}, ${entry.version})">Freeze</button>
+        <button class="btn-primary" onclick="sendAction(${queueID}, 'finish-help', ${entry.id}, ${entry.version})">Finish</button>
+    `
+    elem.innerHTML = `${left}<div>${buttons}</div>`
+    return elem
+}
+
+// ===================CLIENT TO SERVER FUNCTIONS=====================
+
+function sendAction(queueID, action, entryID, version) {
+    let data = {stream: "queue", queueID: queueID, action: action}
+    if (entryID !== undefined) data.entry_id = entryID
+    if (version !== undefined) data.version = version
+    if (socket.readyState !== WebSocket.OPEN) {
+        displayError("Reconnecting to the server...")
+        return
+    }
+    socket.send(JSON.stringify(data))
+}
+
+function toggleQueue(queueID) {
+    sendAction(queueID, "toggle-queue")
+}
+
+// =========================HELPER FUNCTIONS=========================
+
+function sanitize(s) {
+    // Be sure to replace ampersand first
+    return s.replace(/&/g, '&amp;')
+            .replace(/</g, '&lt;')
+            .replace(/>/g, '&gt;')
+            .replace(/"/g, '&quot;')
+}
@@ -1,65 +1,198 @@
 "use strict"
 
 let socket = null
+let eventSource = null // Server-Sent Events fallback when WebSockets don't get through
+let currentQueueID = null
+let everOpened = false // whether any socket to this queue has opened
+let lastVersion = null // version of the last queue state received, to resume from
+let leavingPage = false
+
+// Reconnect backoff: doubles per failed attempt up to the cap, with jitter so a
+// restarted server isn't hit by every page at the same moment
+const RECONNECT_BASE = 1000
+const RECONNECT_MAX = 30000
+let reconnectAttempts = 0
+let retryAfterHint = 0 // seconds, from the server's "retry" message
+
+// The server pings every 25s. If nothing at all arrives for this long the
+// connection is dead, even if the browser hasn't noticed yet.
+const HEARTBEAT_TIMEOUT = 60000
+let heartbeatTimer = null
 let myAccountID = -1 // Global variable to store the user's account ID
 let autoUnfreezeTimer = null // Timer for auto-unfreezing logic
+let lastStudents = [] // the students last shown, so a conflict can patch one of them
+let lastFreezeTimeout = 0
+let selectedEntries = new Set() // ids of the students staff ticked for a batch action
 
 
+// Some networks (campus proxies, library Wi-Fi) break WebSockets. If the socket
+// doesn't open within this many ms, switch to the read-only event stream.
+const SOCKET_OPEN_TIMEOUT = 5000
+
 function connectToServer(queueID) {
+    currentQueueID = queueID
     // Use wss: protocol if site using https:, otherwise use ws: protocol
     let wsProtocol = window.location.protocol === "https:" ? "wss:" : "ws:"
 
-    // Create a new WebSocket.
+    // Create a new WebSocket. Tell the server which state we already have (the
+    // one the page was rendered with, or the last one received) so it can skip
+    // resending it.
     let url = `${wsProtocol}//${window.location.host}/ohq/data/queue/${queueID}`
+    if (lastVersion !== null) url += `?version=${lastVersion}`
     // websocket handshake process done here
     socket = new WebSocket(url)
+    let opened = false
+
+    let openTimer = setTimeout(function() {
+        if (!opened) socket.close()
+    }, SOCKET_OPEN_TIMEOUT)
+
+    socket.onopen = function(event) {
+        opened = true
+        everOpened = true
+        clearTimeout(openTimer)
+        resetHeartbeatTimer()
+    }
 
     // Handle any errors that occur.
     socket.onerror = function(error) {
-        displayError("WebSocket Error: " + error) // <-- Fixed: "D" is now "D"
+        if (opened) displayError("WebSocket Error: " + error) // <-- Fixed: "D" is now "D"
     }
 
-    // // Show a connected message when the WebSocket is opened.
-    // socket.onopen = function(event) {
-    //     displayError("WebSocket Connected")
-    // }
-
-    // // Show a disconnected message when the WebSocket is closed.
-    // socket.onclose = function(event) {
-    //     displayError("WebSocket Disconnected")
-    // }
+    // The socket never got through: fall back to Server-Sent Events.
+    // Otherwise the server went away (or asked us to retry later).
+    socket.onclose = function(event) {
+        clearTimeout(openTimer)
+        clearTimeout(heartbeatTimer)
+        if (!everOpened) {
+            connectEventStream(queueID)
+        } else {
+            scheduleReconnect()
+        }
+    }
 
     // Handle messages received from the server.
     socket.onmessage = function(event) {
-        let response = JSON.parse(event.data)
-        
-        // Check for the initial connection message
-        if (response.type === 'connection_established') {
-            myAccountID = response.my_account_id;
-            return; // Don't process this as a state update
-        }
+        resetHeartbeatTimer()
+        handleMessage(JSON.parse(event.data))
+    }
+}
 
-        if (response.type === 'announcement') {
-            showAnnouncement(response.message);
-            return; // Don't process this as a state update
-        } else if (response.type === 'queue-deleted') {
-            window.location.pathname = ''
-            return
-        } else if (response.type === 'redirect-home') {
-            var message = ''
-            if (!response.hasOwnProperty('message')) {
-                message = "You do not have permission to access this queue."
-            } else {
-                message = response.message
-            }
-            window.location.href = `/?error=${encodeURIComponent(message)}`
-            return
-        } else if (response.type === 'update-staff-status') {
-            isStaff = response['isStaff']
+// The page is rendered with the queue's state, so it can be shown before the
+// socket opens. The socket is then opened from that version and only sends
+// what changed since the page was rendered.
+function hydrate(accountID) {
+    myAccountID = accountID
+    let element = document.getElementById("queue-snapshot")
+    if (element === null) return
+    let snapshot = JSON.parse(element.textContent)
+    lastVersion = snapshot.version
+    updateState(snapshot)
+}
+
+function resetHeartbeatTimer() {
+    clearTimeout(heartbeatTimer)
+    heartbeatTimer = setTimeout(function() {
+        // closing a dead socket can take minutes to report, so don't wait for onclose
+        socket.onclose = null
+        socket.close()
+        scheduleReconnect()
+    }, HEARTBEAT_TIMEOUT)
+}
+
+function scheduleReconnect() {
+    if (leavingPage) return
+    // exponential backoff with "equal jitter", but never sooner than the server asked
+    let backoff = Math.min(RECONNECT_MAX, RECONNECT_BASE * Math.pow(2, reconnectAttempts))
+    let delay = Math.max(retryAfterHint * 1000, backoff / 2 + Math.random() * backoff / 2)
+    reconnectAttempts += 1
+    retryAfterHint = 0
+    displayError("Connection lost. Reconnecting...")
+    setTimeout(function() { connectToServer(currentQueueID) }, delay)
+}
+
+function connectEventStream(queueID) {
+    if (eventSource !== null || typeof EventSource === "undefined") {
+        displayError("Could not connect to the queue. Please check your connection.")
+        return
+    }
+    // EventSource reconnects on its own if the stream drops
+    eventSource = new EventSource(`/ohq/events/queue/${queueID}`)
+    eventSource.onmessage = function(event) {
+        handleMessage(JSON.parse(event.data))
+    }
+    displayError("Your network is blocking live connections; showing updates in view-only mode.")
+}
+
+function handleMessage(response) {
+    if (response.type === 'ping') {
+        socket.send(JSON.stringify({type: "pong"}))
+        return
+    }
+    if (response.type === 'retry') {
+        retryAfterHint = response.retryAfter
+        return
+    }
+
+    // Anything carrying the queue state means we're (back) in sync
+    if (response.type === 'up-to-date' || response.hasOwnProperty('version')) {
+        if (response.hasOwnProperty('version')) lastVersion = response.version
+        if (reconnectAttempts > 0) displayError("")
+        reconnectAttempts = 0
+        if (response.type === 'up-to-date') return
+    }
+
+    // Check for the initial connection message
+    if (response.type === 'connection_established') {
+        myAccountID = response.my_account_id;
+        return; // Don't process this as a state update
+    }
+
+    if (response.type === 'announcement') {
+        showAnnouncement(response.message);
+        return; // Don't process this as a state update
+    } else if (response.type === 'queue-deleted') {
+        leavingPage = true
+        window.location.pathname = ''
+        return
+    } else if (response.type === 'redirect-home') {
+        var message = ''
+        if (!response.hasOwnProperty('message')) {
+            message = "You do not have permission to access this queue."
+        } else {
+            message = response.message
         }
-        
-        updateState(response)
+        leavingPage = true
+        window.location.href = `/?error=${encodeURIComponent(message)}`
+        return
+    } else if (response.type === 'update-staff-status') {
+        isStaff = response['isStaff']
+    } else if (response.type === 'conflict') {
+        // another staff member got to this student first: show what they did
+        displayError(response.error)
+        patchStudent(response.entryID, response.entry)
+        return
+    } else if (response.type === 'batch-result') {
+        if (response.conflicts.length > 0) {
+            let count = response.conflicts.length
+            displayError(`${count} student${count == 1 ? " was" : "s were"} just changed by another staff member and skipped.`)
+        }
+        return
     }
+    
+    updateState(response)
+}
+
+function sendToServer(data) {
+    if (eventSource !== null) {
+        displayError("Actions are unavailable in view-only mode. Reload the page on a different network to join or manage the queue.")
+        return
+    }
+    if (socket.readyState !== WebSocket.OPEN) {
+        displayError("Reconnecting to the server...")
+        return
+    }
+    socket.send(JSON.stringify(data))
 }
 
 function displayError(message) {
@@ -89,10 +222,24 @@ function updateState(response) {
     let freezeTimeout = response.hasOwnProperty('queue_freeze_timeout') ? response['queue_freeze_timeout'] : 0;
 
     if (response.hasOwnProperty('students')) {
+        lastStudents = response['students']
+        lastFreezeTimeout = freezeTimeout
         updateStudents(response['students'], freezeTimeout)
     }
 }
 
+function patchStudent(entryID, entry) {
+    let index = lastStudents.findIndex((student) => student.id == entryID)
+    if (index === -1) return
+    if (entry === null) {
+        lastStudents.splice(index, 1)
+    } else {
+        // the estimate isn't sent with a single entry; keep the one we have
+        lastStudents[index] = Object.assign({}, lastStudents[index], entry)
+    }
+    updateStudents(lastStudents, lastFreezeTimeout)
+}
+
 function updateQueueStatus(isOpen) {
     let elem = document.getElementById("queue-status")
     let toggleBtn = document.getElementById("toggle-queue-btn")
@@ -118,6 +265,9 @@ function updateStudents(accountEntryList, freezeTimeout = 0) {
         autoUnfreezeTimer = null;
     }
 
+    // students who left can't stay selected
+    selectedEntries = new Set(accountEntryList.filter((entry) => selectedEntries.has(entry.id)).map((entry) => entry.id))
+
     // Update total student count
     let countElem = document.getElementById("student-count")
     let verb = accountEntryList.length == 1 ? "is" : "are"
@@ -165,6 +315,15 @@ function updateStudents(accountEntryList, freezeTimeout = 0) {
             document.getElementById("my-position-in-queue").innerText = `#${myPosition}`
             document.getElementById("my-question").innerText = myEntry.question
 
+            // Estimated wait is only known for waiting students once staff have finished someone
+            let estimateElem = document.getElementById("my-estimated-wait")
+            if (myEntry.status === 'waiting' && myEntry.estimatedWait !== null && myEntry.estimatedWait !== undefined) {
+                estimateElem.innerText = `Estimated wait: ${formatWait(myEntry.estimatedWait)}`
+                estimateElem.style.display = "block"
+            } else {
+                estimateElem.style.display = "none"
+            }
+
             // Update status message (e.g., for "frozen")
             let statusMessageElem = document.getElementById("my-status-message")
             let unfreezeBtn = document.getElementById("unfreeze-btn");
@@ -230,12 +389,19 @@ function createStaffStudentEntry(entry, position) {
     let safeName = sanitize(entry.name)
     let safeQuestion = sanitize(entry.question)
 
-    let left = `<div><strong>#${position} ${safeName}</strong> ${statusIndicator}<br><p>${safeQuestion}</p></div>`
+    let waitIndicator = ""
+    if (entry.status === 'waiting' && entry.estimatedWait !== null && entry.estimatedWait !== undefined) {
+        waitIndicator = `<span class="weak">(est. wait ${formatWait(entry.estimatedWait)})</span>`
+    }
+
+    let checked = selectedEntries.has(entry.id) ? "checked" : ""
+    let checkbox = `<input type="checkbox" class="select-entry" onchange="toggleSelected(${entry.id}, this.checked)" ${checked}>`
+    let left = `<div>${checkbox} <strong>#${position} ${safeName}</strong> ${statusIndicator}${waitIndicator}<br><p>${safeQuestion}</p></div>`
     
     let buttons = `
-        <button class="btn-primary" onclick="helpStudent(${entry.id})">Help</button>
-        <button class="btn-secondary" onclick="freezeStudent(${entry.id})">Freeze</button>
-        <button class="btn-primary" onclick="finishHelpingStudent(${entry.id})">Finish</button>
+        <button class="btn-primary" onclick="helpStudent(${entry.id}, ${entry.version})">Help</button>
+        <button class="btn-secondary" onclick="freezeStudent(${entry.id}, ${entry.version})">Freeze</button>
+        <button class="btn-primary" onclick="finishHelpingStudent(${entry.id}, ${entry.version})">Finish</button>
     `
     
     elem.innerHTML = `${left}<div>${buttons}</div>`
@@ -273,44 +439,92 @@ function askQuestion() {
     let questionText = questionBox.value
     if (questionText == "") return
     let data = {action: "ask-question", text: questionText}
-    socket.send(JSON.stringify(data))
+    sendToServer(data)
     questionBox.value = ""
 }
 
 function leaveQueue() {
     let data = {action: "leave-queue"}
-    socket.send(JSON.stringify(data))
+    sendToServer(data)
 }
 
 function unfreezeMe() {
     let data = {action: "unfreeze"};
-    socket.send(JSON.stringify(data));
+    sendToServer(data);
 }
 
 function triggerAutoRefresh() {
+    if (eventSource !== null) {
+        // fetching the state runs the auto-unfreeze, which is then pushed down the event stream
+        fetch(`/api/queue/${currentQueueID}/state`)
+        return
+    }
     let data = {action: "refresh"};
-    socket.send(JSON.stringify(data));
+    sendToServer(data);
 }
 
 // STAFF ACTIONS
 function toggleQueue() {
     let data = {action: "toggle-queue"}
-    socket.send(JSON.stringify(data))
+    sendToServer(data)
 }
 
-function freezeStudent(accountEntryId) {
-    let data = {action: "freeze", entry_id: accountEntryId}
-    socket.send(JSON.stringify(data))
+function freezeStudent(accountEntryId, version) {
+    let data = {action: "freeze", entry_id: accountEntryId, version: version}
+    sendToServer(data)
 }
 
-function helpStudent(accountEntryId) {
-    let data = {action: "help", entry_id: accountEntryId}
-    socket.send(JSON.stringify(data))
+function helpStudent(accountEntryId, version) {
+    let data = {action: "help", entry_id: accountEntryId, version: version}
+    sendToServer(data)
 }
 
-function finishHelpingStudent(accountEntryId) {
-    let data = {action: "finish-help", entry_id: accountEntryId}
-    socket.send(JSON.stringify(data))
+function finishHelpingStudent(accountEntryId, version) {
+    let data = {action: "finish-help", entry_id: accountEntryId, version: version}
+    sendToServer(data)
+}
+
+// BATCH STAFF ACTIONS: one message and one update for every selected student
+function toggleSelected(entryID, selected) {
+    if (selected) {
+        selectedEntries.add(entryID)
+    } else {
+        selectedEntries.delete(entryID)
+    }
+}
+
+function selectAllStudents(selected) {
+    selectedEntries = new Set(selected ? lastStudents.map((entry) => entry.id) : [])
+    updateStudents(lastStudents, lastFreezeTimeout)
+}
+
+function sendBatch(action) {
+    // each student goes with the version shown, so changes made meanwhile aren't overwritten
+    let entries = lastStudents.filter((entry) => selectedEntries.has(entry.id))
+                              .map((entry) => ({entry_id: entry.id, version: entry.version}))
+    if (entries.length === 0) {
+        displayError("Select some students first.")
+        return
+    }
+    let data = {action: action, entries: entries}
+    let assignee = document.getElementById("assign-to")
+    if (action === "batch-help" && assignee !== null && assignee.value !== "") {
+        data.staff_id = parseInt(assignee.value)
+    }
+    sendToServer(data)
+    selectedEntries.clear()
+    document.getElementById("select-all-students").checked = false
+}
+
+function clearQueue() {
+    // as for the other batches, students changed meanwhile are skipped
+    let entries = lastStudents.map((entry) => ({entry_id: entry.id, version: entry.version}))
+    if (entries.length === 0) {
+        displayError("The queue is already empty.")
+        return
+    }
+    if (!confirm("Take every student off the queue?")) return
+    sendToServer({action: "clear-queue", entries: entries})
 }
 
 function sendAnnouncement() {
@@ -319,13 +533,13 @@ function sendAnnouncement() {
     if (text === "") return;
     
     let data = { action: "send-announcement", text: text };
-    socket.send(JSON.stringify(data));
+    sendToServer(data);
     textBox.value = ""; // Clear the box after sending
 }
 
 
 function sendFreezeAll() {
-    socket.send(JSON.stringify({ action: "freeze-all" }));
+    sendToServer({ action: "freeze-all" });
     hideFreezeAllModal();
 }
 
@@ -355,6 +569,12 @@ function hideFreezeAllModal() {
 
 // =========================HELPER FUNCTIONS=========================
 
+function formatWait(seconds) {
+    if (seconds < 60) return "less than a minute"
+    let minutes = Math.round(seconds / 60)
+    return minutes == 1 ? "about 1 minute" : `about ${minutes} minutes`
+}
+
 function sanitize(s) {
     // Be sure to replace ampersand first
     return s.replace(/&/g, '&amp;')
@@ -0,0 +1,244 @@
+"""
+Background tasks, run off the request and socket paths.
+
+Views and consumers enqueue() a registered task by name. When a task
+worker is deployed (OHQ_TASK_WORKER, which needs a shared channel layer)
+the message goes to the TASK_CHANNEL channel and is run by
+`manage.py runworker ohq-tasks`; otherwise by a small thread pool in the
+process that enqueued it, so tasks still run when nobody started a worker.
+Either way each worker process runs at most
+OHQ_TASK_CONCURRENCY tasks at once, failed tasks are retried with backoff,
+and progress is kept in the cache (see status()) and sent to the sockets
+of whoever started the task, if asked, as a 'task_progress' event.
+"""
+import asyncio
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from asgiref.sync import async_to_sync
+from channels.consumer import AsyncConsumer
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from ohq.models import Account, AccountEntry, HelpSession, Queue, QueueHistory
+
+logger = logging.getLogger(__name__)
+
+TASK_CHANNEL = 'ohq-tasks'
+RETRY_DELAY = 2 # seconds before the first retry; doubles after that
+STATUS_TIMEOUT = 3600
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_RETRYING = 'retrying'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+_registry = {}
+
+
+def task(name, retries=2):
+    """
+    Registers a task. It is called with its keyword arguments (which must
+    be JSON-serializable) plus `progress`, which it may call as
+    progress(done, total) while it works. What it returns is reported as
+    the result.
+    """
+    def register(function):
+        _registry[name] = {'function': function, 'retries': retries}
+        return function
+    return register
+
+
+def _status_key(task_id):
+    return f'ohq:task:{task_id}'
+
+
+def status(task_id):
+    return cache.get(_status_key(task_id))
+
+
+def _report(message, state, **fields):
+    current = status(message['taskID']) or {}
+    current.update(fields, taskID=message['taskID'], task=message['task'], state=state,
+                   accountID=message['accountID'])
+    cache.set(_status_key(message['taskID']), current, STATUS_TIMEOUT)
+    if message['reply']:
+        reply = dict(message['reply'])
+        async_to_sync(get_channel_layer().group_send)(reply.pop('group'), dict(reply, type='task_progress', status=current))
+
+
+def enqueue(name, account=None, reply_group=None, reply_tag=None, **kwargs):
+    """
+    Starts task `name` in the background and returns its id. Progress goes
+    to the sockets in `reply_group`, with `reply_tag` (e.g. a multiplexed
+    stream's tag) added to each event.
+    """
+    if name not in _registry:
+        raise ValueError(f'Unknown task "{name}"')
+    message = {
+        'type': 'run_task',
+        'task': name,
+        'taskID': uuid.uuid4().hex,
+        'kwargs': kwargs,
+        'accountID': account.id if account else None,
+        'reply': dict(reply_tag or {}, group=reply_group) if reply_group else None,
+        'attempt': 1,
+    }
+    _report(message, STATE_QUEUED)
+    _send(message)
+    return message['taskID']
+
+
+def _send(message):
+    layer = get_channel_layer()
+    if not settings.OHQ_TASK_WORKER or isinstance(layer, InMemoryChannelLayer):
+        # no worker is reading TASK_CHANNEL (or can read this layer)
+        _local_pool().submit(_run_local, message)
+    else:
+        async_to_sync(layer.send)(TASK_CHANNEL, message)
+
+
+def run(message):
+    """Runs one task message. Returns the message to send again if it should be retried."""
+    entry = _registry.get(message['task'])
+    if entry is None:
+        _report(message, STATE_FAILED, error='unknown task')
+        return None
+
+    _report(message, STATE_RUNNING)
+    def progress(done, total=None):
+        _report(message, STATE_RUNNING, done=done, total=total)
+    try:
+        result = entry['function'](progress=progress, **message['kwargs'])
+    except Exception as e:
+        logger.exception(f'Task {message["task"]} failed (attempt {message["attempt"]})')
+        if message['attempt'] <= entry['retries']:
+            _report(message, STATE_RETRYING, error=str(e))
+            return dict(message, attempt=message['attempt'] + 1)
+        _report(message, STATE_FAILED, error=str(e))
+        return None
+    _report(message, STATE_DONE, result=result, error=None)
+    return None
+
+
+def _retry_delay(message):
+    return RETRY_DELAY * 2 ** (message['attempt'] - 2)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _local_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.OHQ_TASK_CONCURRENCY, thread_name_prefix='ohq-task')
+    return _pool
+
+
+def _run_local(message):
+    close_old_connections()
+    try:
+        retry = run(message)
+    finally:
+        close_old_connections()
+    if retry:
+        threading.Timer(_retry_delay(retry), _local_pool().submit, args=(_run_local, retry)).start()
+
+
+class TaskConsumer(AsyncConsumer):
+    """
+    Runs the tasks sent to TASK_CHANNEL. While every slot is busy the next
+    message stays in the channel layer, so a flood of tasks waits there
+    instead of piling up in the worker.
+    """
+    slots = None
+
+    async def run_task(self, message):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(settings.OHQ_TASK_CONCURRENCY)
+        await self.slots.acquire()
+        asyncio.ensure_future(self.execute(message))
+
+    async def execute(self, message):
+        try:
+            retry = await database_sync_to_async(run, thread_sensitive=False)(message)
+        finally:
+            self.slots.release()
+        if retry:
+            await asyncio.sleep(_retry_delay(retry))
+            await self.channel_layer.send(TASK_CHANNEL, retry)
+
+
+# ========================== TASKS ==========================
+
+DELETE_CHUNK = 1000
+
+
+@task('delete-queue')
+def delete_queue(queue_id, progress):
+    """Deletes a queue, its history and its help sessions a chunk at a time."""
+    queue = Queue.objects.filter(id=queue_id).first()
+    if queue is None:
+        return None # already gone, e.g. this is a retry
+    total = HelpSession.objects.filter(queue_id=queue_id).count() + \
+            QueueHistory.objects.filter(queue_id=queue_id).count()
+    done = 0
+    for model in (HelpSession, QueueHistory):
+        while True:
+            ids = list(model.objects.filter(queue_id=queue_id).values_list('id', flat=True)[:DELETE_CHUNK])
+            if not ids:
+                break
+            model.objects.filter(id__in=ids).delete()
+            done += len(ids)
+            progress(done, total)
+    queue.delete() # entries and rollups, and the signals that tell the sockets
+    return {'deleted': queue_id}
+
+
+@task('roster-removed')
+def roster_removed(queue_id, account_id, role, progress):
+    """Takes a removed staff member or student off what they had on the queue."""
+    from ohq import access, livestate
+    queue = Queue.objects.filter(id=queue_id).first()
+    account = Account.objects.filter(id=account_id).first()
+    if queue is None or account is None:
+        return None
+    livestate.flush() # the entries below are edited in the table directly
+    if role == 'staff':
+        # removed staff can't be helping anyone
+        for entry in AccountEntry.objects.filter(helping_staff=account, queue=queue):
+            entry.helping_staff = None
+            entry.helpTime = None
+            entry.status = AccountEntry.STATUS_WAITING
+            entry.version += 1
+            entry.save()
+        # or be on the queue if they aren't an allowed student.
+        if queue.id not in access.get(account).students:
+            AccountEntry.objects.filter(account=account, queue=queue).delete()
+    else:
+        # student should no longer be on queue for this course
+        # unless they're staff still
+        if queue.id not in access.get(account).staff:
+            AccountEntry.objects.filter(account=account, queue=queue).delete()
+    return None
+
+
+@task('archive-session')
+def archive_session(queue_id, account_id, staff_id, joinTime, helpTime, finishTime, progress):
+    """HelpSession.archive (and its rollups) for a student staff finished helping."""
+    if not Queue.objects.filter(id=queue_id).exists():
+        return None
+    entry = AccountEntry(queue_id=queue_id, account_id=account_id, joinTime=datetime.fromisoformat(joinTime),
+                         helpTime=datetime.fromisoformat(helpTime) if helpTime else None)
+    staff = Account.objects.filter(id=staff_id).first() if staff_id else None
+    session = HelpSession.archive(entry, staff, datetime.fromisoformat(finishTime))
+    return {'session': session.id}
@@ -1,3 +1,702 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from ohq import access, caches, livestate, presence, ratelimit, snapshots, tasks
+from ohq.consumers import QueueConsumer, QueueListConsumer
+from ohq.loadtest import login_session
+from ohq.models import Account, AccountEntry, Queue
+from ohq.profiling import ProfilingMiddleware
+
+# the maintenance thread would run against the test database
+with mock.patch('ohq.maintenance.start'):
+    from webapps.asgi import application
+
+SOCKET_HEADERS = [(b'host', b'localhost'), (b'origin', b'http://localhost')]
+
+
+def clear_caches():
+    # the shared cache and the per-process LRUs outlive each test's transaction
+    cache.clear()
+    for lru in (caches.users, caches.accounts, caches.queues, caches.search_results):
+        lru.clear()
+
+
+class AccountSignalTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.account = Account.objects.get(user=User.objects.create(username='student'))
+        self.queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122')
+        self.queue.allowedStudents.add(self.account)
+
+    def save(self, **kwargs):
+        with mock.patch.object(caches, 'bump_accounts') as bump_accounts, \
+                mock.patch.object(caches, 'bump_queue_page') as bump_queue_page, \
+                mock.patch.object(access, 'bump') as bump_access, \
+                mock.patch.object(livestate, 'flush') as flush:
+            self.account.save(**kwargs)
+        return bump_accounts.called, bump_queue_page.called, bump_access.called, flush.called
+
+    def test_unchanged_save_only_drops_the_account(self):
+        self.assertEqual(self.save(), (False, False, False, False))
+        self.account.nickname = 'Renamed' # not among the fields saved
+        self.assertEqual(self.save(update_fields=['user']), (False, False, False, False))
+
+    def test_nickname_change_reaches_rosters_and_queues(self):
+        self.account.nickname = 'Renamed'
+        self.assertEqual(self.save(), (True, True, False, True))
+
+    def test_admin_toggle_rebuilds_access(self):
+        self.account.isAdmin = True
+        self.assertEqual(self.save(), (False, False, True, False))
+
+
+class UserSignalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ta')
+
+    def test_sign_in_leaves_the_access_index(self):
+        with mock.patch.object(access, 'bump') as bump:
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=['last_login'])
+            self.user.first_name = 'Renamed'
+            self.user.save()
+        bump.assert_not_called()
+
+    def test_superuser_toggle_rebuilds_access(self):
+        account = Account.objects.get(user=self.user)
+        with mock.patch.object(access, 'bump') as bump:
+            self.user.is_superuser = True
+            self.user.save()
+        bump.assert_called_once_with([account.id])
+
+
+class RosterSignalTests(TestCase):
+    def test_pages_are_told_after_the_index_is_dropped(self):
+        clear_caches()
+        account = Account.objects.get(user=User.objects.create(username='ta'))
+        queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122', isPublic=False)
+        self.assertFalse(access.get(account).is_staff(queue.id))
+        seen = [] # what a notified page would read
+        def notify(groups, event):
+            seen.append(access.get(account).is_staff(queue.id))
+        with mock.patch.object(QueueListConsumer, 'notify', side_effect=notify):
+            with self.captureOnCommitCallbacks(execute=True):
+                queue.allowedStaff.add(account)
+                self.assertEqual(seen, [])
+        self.assertEqual(seen, [True])
+
+
+class VersionedCacheTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create(username='ta')
+        self.account = Account.objects.get(user=self.user)
+        self.queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122')
+
+    def test_account_is_cached_until_saved(self):
+        caches.get_account(self.user)
+        with self.assertNumQueries(0):
+            caches.get_account(self.user)
+        self.account.nickname = 'Renamed'
+        self.account.save()
+        self.assertEqual(caches.get_account(self.user).nickname, 'Renamed')
+
+    def test_version_bump_from_another_worker_drops_local_copy(self):
+        caches.get_account(self.user)
+        Account.objects.filter(id=self.account.id).update(nickname='Elsewhere')
+        self.assertNotEqual(caches.get_account(self.user).nickname, 'Elsewhere')
+        # the other worker's save only reaches this one through the shared version
+        cache.incr(caches._user_version_key(self.user.id))
+        self.assertEqual(caches.get_account(self.user).nickname, 'Elsewhere')
+
+    def test_callers_get_copies(self):
+        caches.get_queue(self.queue.id).isOpen = True
+        self.assertFalse(caches.get_queue(self.queue.id).isOpen)
+
+    def test_queue_save_and_delete_invalidate(self):
+        caches.get_queue(self.queue.id)
+        self.queue.queueName = 'Renamed'
+        self.queue.save()
+        self.assertEqual(caches.get_queue(self.queue.id).queueName, 'Renamed')
+        queue_id = self.queue.id
+        self.queue.delete()
+        with self.assertRaises(Queue.DoesNotExist):
+            caches.get_queue(queue_id)
+
+    def test_missing_account_is_not_cached(self):
+        user = User.objects.create(username='orphan')
+        Account.objects.filter(user=user).delete()
+        with self.assertRaises(Account.DoesNotExist):
+            caches.get_account(user)
+        Account.objects.create(user=user, email='', nickname='Back')
+        self.assertEqual(caches.get_account(user).nickname, 'Back')
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('ohq.ratelimit.time.monotonic', return_value=100.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_denied_until_refilled(self):
+        bucket = ratelimit.TokenBucket(rate=2, capacity=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(), 0.5) # one token at 2 per second
+        self.clock.return_value = 100.25
+        self.assertAlmostEqual(bucket.take(), 0.25)
+        self.clock.return_value = 100.5
+        self.assertEqual(bucket.take(), 0)
+
+    def test_refill_stops_at_capacity(self):
+        bucket = ratelimit.TokenBucket(rate=1, capacity=2)
+        self.clock.return_value = 1000.0
+        self.assertEqual([bucket.take() for _ in range(2)], [0, 0])
+        self.assertGreater(bucket.take(), 0)
+
+    def test_retry_after_is_jittered_up_to_double(self):
+        with mock.patch.object(ratelimit, 'worker_connects', ratelimit.TokenBucket(rate=1, capacity=1)):
+            self.assertEqual(ratelimit.admit_connect(), 0)
+            with mock.patch('ohq.ratelimit.random.random', return_value=0.0):
+                self.assertEqual(ratelimit.admit_connect(), 1.0)
+            with mock.patch('ohq.ratelimit.random.random', return_value=0.99):
+                self.assertEqual(ratelimit.admit_connect(), 1.99)
+
+    def test_per_queue_bucket(self):
+        with mock.patch.object(ratelimit, 'worker_connects', ratelimit.TokenBucket(rate=100, capacity=100)), \
+                self.settings(OHQ_QUEUE_CONNECT_RATE=1):
+            ratelimit.queue_connects.clear()
+            self.assertEqual(ratelimit.admit_connect(1), 0)
+            self.assertEqual(ratelimit.admit_connect(1), 0) # a burst of two
+            self.assertGreater(ratelimit.admit_connect(1), 0)
+            self.assertEqual(ratelimit.admit_connect(2), 0)
+
+    def test_action_limits_are_per_action_and_shared_per_account(self):
+        ratelimit.account_actions.clear()
+        limiter = ratelimit.ActionLimiter(account_id=1)
+        rate, burst = ratelimit.ACTION_RATES['send-announcement']
+        self.assertEqual([limiter.check('send-announcement') for _ in range(burst)], [0] * burst)
+        self.assertGreater(limiter.check('send-announcement'), 0)
+        self.assertEqual(limiter.check('refresh'), 0)
+        # a second socket has its own bucket, but the account's is shared
+        other = ratelimit.ActionLimiter(account_id=1)
+        for _ in range(burst):
+            self.assertEqual(other.check('send-announcement'), 0)
+        self.assertGreater(other.check('send-announcement'), 0)
+
+    def test_batches_pay_per_entry(self):
+        ratelimit.account_actions.clear()
+        limiter = ratelimit.ActionLimiter(account_id=1)
+        rate, burst = ratelimit.ACTION_RATES['batch-entries']
+        self.assertGreaterEqual(burst, QueueConsumer.max_batch)
+        self.assertEqual(limiter.check('batch-entries', cost=burst - 10), 0)
+        self.assertAlmostEqual(limiter.check('batch-entries', cost=20), 10 / rate) # only 10 left
+        self.assertEqual(limiter.check('batch-entries', cost=10), 0)
+
+
+class AdmissionTests(TestCase):
+    async def test_rejected_connect_is_told_when_to_retry(self):
+        empty = ratelimit.TokenBucket(rate=0.5, capacity=1)
+        empty.take()
+        with mock.patch.object(ratelimit, 'worker_connects', empty), \
+                mock.patch('ohq.ratelimit.random.random', return_value=0.5):
+            socket = WebsocketCommunicator(application, '/ohq/data/multiplex', headers=SOCKET_HEADERS)
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            message = await socket.receive_json_from()
+            self.assertEqual(message['type'], 'retry')
+            self.assertAlmostEqual(message['retryAfter'], 3.0, places=1) # 2s wait, jittered by 1.5
+            closed = await socket.receive_output()
+            self.assertEqual(closed, {'type': 'websocket.close', 'code': ratelimit.RETRY_CLOSE_CODE})
+            await socket.disconnect()
+
+
+class SlowConsumerTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122', isOpen=True)
+        self.consumer = QueueConsumer()
+        self.consumer.id = queue.id
+        self.consumer.send = mock.Mock()
+        self.consumer.close = mock.Mock()
+
+    def event(self):
+        return {'type': 'broadcast_event', 'message': snapshots.get(self.consumer.id)}
+
+    def sent_versions(self):
+        return [json.loads(call.kwargs['text_data'])['version'] for call in self.consumer.send.call_args_list]
+
+    def test_late_event_is_answered_with_the_newest_snapshot(self):
+        late = [self.event()]
+        for _ in range(3):
+            snapshots.bump(self.consumer.id)
+            late.append(self.event())
+        for event in late:
+            self.consumer.broadcast_event(event)
+        self.assertEqual(self.sent_versions(), [late[-1]['message']['version']])
+        self.consumer.close.assert_not_called()
+
+    def test_far_behind_consumer_is_closed(self):
+        event = self.event()
+        for _ in range(ratelimit.SLOW_CONSUMER_BACKLOG):
+            snapshots.bump(self.consumer.id)
+        with mock.patch('ohq.consumers.traffic.record'):
+            self.consumer.broadcast_event(event)
+        self.consumer.send.assert_not_called()
+        self.consumer.close.assert_called_once_with(code=ratelimit.SLOW_CONSUMER_CLOSE_CODE)
+
+
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(presence, 'FLUSH_DELAY', 60) # tests flush by hand
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.forget_channels)
+
+    def forget_channels(self):
+        for channel in list(presence._channels):
+            presence.disconnect(channel)
+        if presence._flush_timer:
+            presence._flush_timer.cancel()
+        presence.publish_dirty()
+
+    def test_burst_of_joins_is_published_in_one_pass(self):
+        for i in range(50):
+            presence.connect(f'channel-{i}')
+            for group in ('public', f'account-{i}', 'course-15122'):
+                presence.join(f'channel-{i}', group)
+        with mock.patch.object(presence.cache, 'set_many', wraps=presence.cache.set_many) as set_many:
+            presence.publish_dirty()
+        self.assertEqual(set_many.call_count, 1)
+        self.assertEqual(presence.gauge('public'), {'live': 50, 'stale': 0})
+        self.assertEqual(presence.gauge('account-7'), {'live': 1, 'stale': 0})
+
+    def test_last_leave_is_published(self):
+        presence.connect('channel')
+        presence.join('channel', 'queue-1')
+        presence.publish_dirty()
+        presence.leave('channel', 'queue-1')
+        presence.publish_dirty()
+        self.assertEqual(presence.gauge('queue-1'), {'live': 0, 'stale': 0})
+
+
+# the redis-mode tests need a server: OHQ_TEST_REDIS_URL, or REDIS_URL
+class QueueStateTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122', isOpen=True)
+        self.private = Queue.objects.create(queueName='Private', courseNumber='15122', isPublic=False)
+        self.session = login_session(User.objects.create(username='kiosk'))
+
+    async def get(self, queue, query='', etag=None):
+        headers = SOCKET_HEADERS + [(b'cookie', f'sessionid={self.session}'.encode())]
+        if etag:
+            headers.append((b'if-none-match', etag))
+        path = f'/api/queue/{queue.id}/state' + (f'?{query}' if query else '')
+        response = await HttpCommunicator(application, 'GET', path, headers=headers).get_response(timeout=5)
+        return response['status'], dict(response['headers']), response['body']
+
+    async def test_etag_and_not_modified(self):
+        status, headers, body = await self.get(self.queue)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'ETag'], f'"{json.loads(body)["version"]}"'.encode())
+        status, _, body = await self.get(self.queue, etag=headers[b'ETag'])
+        self.assertEqual((status, body), (304, b''))
+
+    async def test_long_poll_answers_when_the_queue_changes(self):
+        _, headers, _ = await self.get(self.queue)
+        async def change():
+            await asyncio.sleep(0.2)
+            await sync_to_async(snapshots.bump)(self.queue.id)
+            await get_channel_layer().group_send(QueueConsumer.group_name + f'_{self.queue.id}',
+                                                 {'type': 'refresh_account_entries'})
+        changing = asyncio.create_task(change())
+        status, after, _ = await self.get(self.queue, 'wait=10', etag=headers[b'ETag'])
+        await changing
+        self.assertEqual(status, 200)
+        self.assertNotEqual(after[b'ETag'], headers[b'ETag'])
+
+    async def test_private_queue_is_refused(self):
+        status, _, body = await self.get(self.private)
+        self.assertEqual(status, 403)
+        self.assertEqual(json.loads(body)['error'], 'You do not have permission to access this queue.')
+
+
+class ProfilingMiddlewareTests(SimpleTestCase):
+    async def test_async_chain_stays_async(self):
+        async def view(request):
+            return HttpResponse('ok')
+        middleware = ProfilingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        response = await middleware(request)
+        self.assertEqual(response.content, b'ok')
+
+
+class TaskRoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.layer = mock.Mock() # a shared (not in-memory) layer
+        patcher = mock.patch.object(tasks, 'get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(OHQ_TASK_WORKER=False)
+    def test_runs_in_process_without_a_worker(self):
+        with mock.patch.object(tasks, '_local_pool') as pool:
+            tasks._send({'taskID': 'x'})
+        pool.return_value.submit.assert_called_once_with(tasks._run_local, {'taskID': 'x'})
+        self.layer.send.assert_not_called()
+
+    @override_settings(OHQ_TASK_WORKER=True)
+    def test_goes_to_the_worker_when_deployed(self):
+        self.layer.send = mock.AsyncMock()
+        with mock.patch.object(tasks, '_local_pool') as pool:
+            tasks._send({'taskID': 'x'})
+        self.layer.send.assert_awaited_once_with(tasks.TASK_CHANNEL, {'taskID': 'x'})
+        pool.assert_not_called()
+
+
+class TaskTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        registry = mock.patch.dict(tasks._registry)
+        registry.start()
+        self.addCleanup(registry.stop)
+        self.owner = Account.objects.select_related('user').get(user=User.objects.create(username='owner'))
+        self.calls = 0
+
+        @tasks.task('count-to', retries=1)
+        def count_to(progress, total):
+            for done in range(1, total + 1):
+                progress(done, total)
+            return {'counted': total}
+
+        @tasks.task('flaky', retries=1)
+        def flaky(progress):
+            self.calls += 1
+            raise RuntimeError(f'attempt {self.calls}')
+
+    def enqueue(self, name, **kwargs):
+        with mock.patch.object(tasks, '_send') as send:
+            task_id = tasks.enqueue(name, account=self.owner, **kwargs)
+        return task_id, send.call_args.args[0]
+
+    def test_enqueue_reports_queued(self):
+        task_id, _ = self.enqueue('count-to', total=3)
+        self.assertEqual(tasks.status(task_id), {'taskID': task_id, 'task': 'count-to', 'state': tasks.STATE_QUEUED,
+                                                 'accountID': self.owner.id})
+        with self.assertRaises(ValueError):
+            tasks.enqueue('no-such-task')
+
+    def test_run_reports_progress_and_result(self):
+        task_id, message = self.enqueue('count-to', total=3)
+        self.assertIsNone(tasks.run(message))
+        status = tasks.status(task_id)
+        self.assertEqual(status['state'], tasks.STATE_DONE)
+        self.assertEqual((status['done'], status['total']), (3, 3))
+        self.assertEqual(status['result'], {'counted': 3})
+
+    def test_failure_is_retried_then_reported(self):
+        task_id, message = self.enqueue('flaky')
+        with self.assertLogs('ohq.tasks', 'ERROR'):
+            retry = tasks.run(message)
+        self.assertEqual(retry['attempt'], 2)
+        self.assertEqual(tasks.status(task_id)['state'], tasks.STATE_RETRYING)
+        with self.assertLogs('ohq.tasks', 'ERROR'):
+            self.assertIsNone(tasks.run(retry))
+        status = tasks.status(task_id)
+        self.assertEqual(status['state'], tasks.STATE_FAILED)
+        self.assertEqual(status['error'], 'attempt 2')
+
+    def get_status(self, account, task_id):
+        self.client.force_login(account.user)
+        return self.client.get(reverse('api-task-status', args=[task_id]), HTTP_HOST='localhost')
+
+    def test_status_api_authorization(self):
+        task_id, _ = self.enqueue('count-to', total=1)
+        response = self.get_status(self.owner, task_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], tasks.STATE_QUEUED)
+
+        other = Account.objects.get(user=User.objects.create(username='other'))
+        self.assertEqual(self.get_status(other, task_id).status_code, 403)
+
+        other.isAdmin = True
+        other.save()
+        self.assertEqual(self.get_status(other, task_id).status_code, 200)
+
+        self.assertEqual(self.get_status(self.owner, 'no-such-task').status_code, 404)
+
+    async def test_progress_reaches_the_starters_sockets(self):
+        session = await sync_to_async(login_session)(self.owner.user)
+        socket = WebsocketCommunicator(application, '/ohq/data/queue-list',
+                                       headers=SOCKET_HEADERS + [(b'cookie', f'sessionid={session}'.encode())])
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        await socket.receive_json_from() # the queue lists
+
+        task_id, message = await sync_to_async(self.enqueue)('count-to', total=2,
+                                                             **QueueListConsumer.task_reply(self.owner.id))
+        await sync_to_async(tasks.run)(message)
+        states = []
+        while not await socket.receive_nothing(0.2):
+            event = await socket.receive_json_from()
+            self.assertEqual((event['type'], event['taskID']), ('task', task_id))
+            states.append((event['state'], event.get('done')))
+        self.assertEqual(states, [(tasks.STATE_QUEUED, None), (tasks.STATE_RUNNING, None), (tasks.STATE_RUNNING, 1),
+                                  (tasks.STATE_RUNNING, 2), (tasks.STATE_DONE, 2)])
+        await socket.disconnect()
+
+
+TEST_REDIS_URL = os.environ.get('OHQ_TEST_REDIS_URL', os.environ.get('REDIS_URL'))
+
+
+def redis_available():
+    if not TEST_REDIS_URL:
+        return False
+    import redis
+    try:
+        return redis.Redis.from_url(TEST_REDIS_URL).ping()
+    except redis.exceptions.ConnectionError:
+        return False
+
+
+class LiveStateTestCase(TestCase):
+    """A fresh store for each test; writes are flushed by hand rather than by the background thread."""
+    mode = 'memory'
+
+    def setUp(self):
+        clear_caches()
+        overrides = override_settings(OHQ_LIVE_STATE=self.mode, OHQ_REDIS_URL=TEST_REDIS_URL)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(livestate, '_start_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        livestate._store = None
+        self.addCleanup(setattr, livestate, '_store', None)
+        if self.mode == 'redis':
+            store = livestate.get_store()
+            for key in store.redis.scan_iter('ohq:live:*'):
+                store.redis.delete(key)
+
+        self.queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122', isOpen=True)
+        self.staff = Account.objects.get(user=User.objects.create(username='ta'))
+        self.students = [Account.objects.get(user=User.objects.create(username=f'student{i}')) for i in range(3)]
+
+    def add_row(self, account):
+        # as if written before the queue was loaded
+        return AccountEntry.objects.create(queue=self.queue, account=account, joinTime=timezone.now(),
+                                           question='?', status=AccountEntry.STATUS_WAITING)
+
+
+class LiveStateTests(LiveStateTestCase):
+    def test_load_keeps_table_ids(self):
+        rows = [self.add_row(account) for account in self.students[:2]]
+        students = livestate.get_all_students(self.queue.id)
+        self.assertEqual([student['id'] for student in students], [row.id for row in rows])
+
+    def test_new_entries_get_ids_above_the_table(self):
+        row = self.add_row(self.students[0])
+        entry = livestate.create(self.queue, self.students[1], 'hi')
+        self.assertGreater(entry.id, row.id)
+
+    def test_writes_reach_the_table_on_flush(self):
+        entry = livestate.create(self.queue, self.students[0], 'hi')
+        self.assertFalse(AccountEntry.objects.filter(id=entry.id).exists())
+        livestate.flush()
+        self.assertEqual(AccountEntry.objects.get(id=entry.id).account_id, self.students[0].id)
+
+        entry.status, entry.helping_staff = AccountEntry.STATUS_HELPING, self.staff
+        self.assertTrue(livestate.save(entry))
+        self.assertEqual(AccountEntry.objects.get(id=entry.id).status, AccountEntry.STATUS_WAITING)
+        livestate.flush()
+        row = AccountEntry.objects.get(id=entry.id)
+        self.assertEqual((row.status, row.helping_staff_id, row.version), (AccountEntry.STATUS_HELPING, self.staff.id, 1))
+
+        self.assertTrue(livestate.delete(livestate.find(self.queue, entry_id=entry.id)))
+        livestate.flush()
+        self.assertFalse(AccountEntry.objects.filter(id=entry.id).exists())
+
+    def test_ids_survive_discard(self):
+        row = self.add_row(self.students[0])
+        created = livestate.create(self.queue, self.students[1], 'hi')
+        seen = {student['id']: student['version'] for student in livestate.get_all_students(self.queue.id)}
+
+        livestate.discard(self.queue.id) # e.g. a nickname changed
+        entry = livestate.find(self.queue, entry_id=created.id)
+        self.assertEqual(entry.account_id, self.students[1].id)
+        self.assertEqual({student['id'] for student in livestate.get_all_students(self.queue.id)}, set(seen))
+        # a staff action on what the page showed before the reload still applies
+        entry.status = AccountEntry.STATUS_FROZEN
+        self.assertTrue(livestate.save(entry, version=seen[created.id]))
+        self.assertTrue(livestate.delete(livestate.find(self.queue, entry_id=row.id), version=seen[row.id]))
+
+    def test_leave_and_rejoin_before_a_flush(self):
+        first = livestate.create(self.queue, self.students[0], 'hi')
+        livestate.flush()
+        self.assertTrue(livestate.delete(livestate.find(self.queue, entry_id=first.id)))
+        again = livestate.create(self.queue, self.students[0], 'back')
+        livestate.flush()
+        rows = list(AccountEntry.objects.filter(queue=self.queue).values_list('id', 'question'))
+        self.assertEqual(rows, [(again.id, 'back')])
+
+        livestate.discard(self.queue.id)
+        entry = livestate.find(self.queue, account=self.students[0])
+        self.assertEqual(entry.id, again.id)
+        entry.status = AccountEntry.STATUS_FROZEN
+        self.assertTrue(livestate.save(entry, version=again.version)) # what the pages showed still applies
+
+    def test_directly_written_rows_keep_new_ids_unique(self):
+        livestate.create(self.queue, self.students[0], 'hi')
+        livestate.flush() # as code that writes the table directly must
+        row = self.add_row(self.students[1]) # its signal discards the queue
+        entry = livestate.create(self.queue, self.students[2], 'hi')
+        self.assertGreater(entry.id, row.id)
+        livestate.flush()
+        self.assertEqual(AccountEntry.objects.filter(queue=self.queue).count(), 3)
+
+
+@unittest.skipUnless(redis_available(), 'needs a Redis server (OHQ_TEST_REDIS_URL)')
+class RedisLiveStateTests(LiveStateTests):
+    mode = 'redis'
+
+
+class ConcurrencyTests(LiveStateTestCase):
+    """Staff actions carry the version they saw; the loser of a race writes nothing. Runs without live state."""
+    mode = None
+
+    def setUp(self):
+        super().setUp()
+        self.entry = livestate.create(self.queue, self.students[0], 'hi')
+
+    def test_stale_version_is_rejected(self):
+        first = livestate.find(self.queue, entry_id=self.entry.id)
+        second = livestate.find(self.queue, entry_id=self.entry.id)
+        first.status, first.helping_staff = AccountEntry.STATUS_HELPING, self.staff
+        self.assertTrue(livestate.save(first))
+        second.status = AccountEntry.STATUS_FROZEN
+        self.assertFalse(livestate.save(second))
+        self.assertFalse(livestate.delete(second))
+        current = livestate.find(self.queue, entry_id=self.entry.id)
+        self.assertEqual((current.status, current.version), (AccountEntry.STATUS_HELPING, self.entry.version + 1))
+
+    def test_batch_wins_over_single_action_read_before_it(self):
+        single = livestate.find(self.queue, entry_id=self.entry.id)
+        done = livestate.update_many(self.queue, {self.entry.id: self.entry.version},
+                                     status=AccountEntry.STATUS_FROZEN, freezeTime=timezone.now())
+        self.assertEqual([entry.id for entry in done], [self.entry.id])
+        single.status = AccountEntry.STATUS_HELPING
+        self.assertFalse(livestate.save(single))
+        self.assertEqual(livestate.find(self.queue, entry_id=self.entry.id).status, AccountEntry.STATUS_FROZEN)
+
+    def test_single_action_wins_over_batch_sent_before_it(self):
+        single = livestate.find(self.queue, entry_id=self.entry.id)
+        single.status, single.helping_staff = AccountEntry.STATUS_HELPING, self.staff
+        self.assertTrue(livestate.save(single))
+        versions = {self.entry.id: self.entry.version}
+        self.assertEqual(livestate.update_many(self.queue, versions, status=AccountEntry.STATUS_FROZEN), [])
+        self.assertEqual(livestate.delete_many(self.queue, versions), [])
+        self.assertEqual(livestate.find(self.queue, entry_id=self.entry.id).status, AccountEntry.STATUS_HELPING)
+
+
+class MemoryConcurrencyTests(ConcurrencyTests):
+    mode = 'memory'
+
+
+@unittest.skipUnless(redis_available(), 'needs a Redis server (OHQ_TEST_REDIS_URL)')
+class RedisConcurrencyTests(ConcurrencyTests):
+    mode = 'redis'
+
+
+class ConflictReplyTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        patcher = mock.patch.object(tasks, '_send') # finished students are archived by a task
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = Queue.objects.create(queueName='15-122 OH', courseNumber='15122', isOpen=True)
+        self.tas = [User.objects.create(username=f'ta{i}') for i in range(2)]
+        for user in self.tas:
+            self.queue.allowedStaff.add(Account.objects.get(user=user))
+        student = Account.objects.get(user=User.objects.create(username='student'))
+        self.entry = livestate.create(self.queue, student, 'hi')
+        self.sessions = [login_session(user) for user in self.tas]
+
+    async def connect(self, session):
+        socket = WebsocketCommunicator(application, f'/ohq/data/queue/{self.queue.id}',
+                                       headers=SOCKET_HEADERS + [(b'cookie', f'sessionid={session}'.encode())])
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        while not await socket.receive_nothing(0.2):
+            await socket.receive_from() # the snapshot and the rest of the connect messages
+        return socket
+
+    async def test_loser_of_a_race_is_told(self):
+        first, second = [await self.connect(session) for session in self.sessions]
+        await first.send_json_to({'action': 'help', 'entry_id': self.entry.id, 'version': self.entry.version})
+        snapshot = await first.receive_json_from()
+        self.assertEqual(snapshot['students'][0]['status'], AccountEntry.STATUS_HELPING)
+
+        await second.receive_json_from() # the same snapshot, unless the client acts before it arrives
+        await second.send_json_to({'action': 'freeze', 'entry_id': self.entry.id, 'version': self.entry.version})
+        conflict = await second.receive_json_from()
+        self.assertEqual(conflict['type'], 'conflict')
+        self.assertEqual(conflict['entryID'], self.entry.id)
+        self.assertEqual(conflict['entry']['status'], AccountEntry.STATUS_HELPING)
+        self.assertEqual(conflict['entry']['version'], self.entry.version + 1)
+        self.assertTrue(await first.receive_nothing(0.2)) # nothing changed, so nothing is broadcast
+        for socket in (first, second):
+            await socket.disconnect()
+
+    async def test_batch_reports_conflicts(self):
+        socket = await self.connect(self.sessions[0])
+        await socket.send_json_to({'action': 'help', 'entry_id': self.entry.id, 'version': self.entry.version})
+        await socket.receive_json_from()
+        await socket.send_json_to({'action': 'batch-freeze',
+                                   'entries': [{'entry_id': self.entry.id, 'version': self.entry.version}]})
+        result = await socket.receive_json_from()
+        self.assertEqual(result, {'type': 'batch-result', 'action': 'batch-freeze', 'done': [],
+                                  'conflicts': [self.entry.id]})
+        await socket.disconnect()
+
+    async def test_clear_queue_skips_students_changed_meanwhile(self):
+        socket = await self.connect(self.sessions[0])
+        shown = {'entry_id': self.entry.id, 'version': self.entry.version}
+        await socket.send_json_to({'action': 'help', **shown})
+        await socket.receive_json_from()
+        await socket.send_json_to({'action': 'clear-queue', 'entries': [shown]})
+        result = await socket.receive_json_from()
+        self.assertEqual((result['done'], result['conflicts']), ([], [self.entry.id]))
+
+        await socket.send_json_to({'action': 'clear-queue', 'entries': [dict(shown, version=self.entry.version + 1)]})
+        self.assertEqual((await socket.receive_json_from())['done'], [self.entry.id])
+        await socket.disconnect()
+
+    async def test_batch_help_assigns_only_to_staff(self):
+        socket = await self.connect(self.sessions[0])
+        entries = [{'entry_id': self.entry.id, 'version': self.entry.version}]
+        outsider = await Account.objects.aget(user__username='student')
+        await socket.send_json_to({'action': 'batch-help', 'entries': entries, 'staff_id': outsider.id})
+        self.assertEqual(await socket.receive_json_from(), {'error': 'That account is not staff for this queue.'})
+
+        other_ta = await Account.objects.aget(user=self.tas[1])
+        await socket.send_json_to({'action': 'batch-help', 'entries': entries, 'staff_id': other_ta.id})
+        self.assertEqual((await socket.receive_json_from())['done'], [self.entry.id])
+        snapshot = await socket.receive_json_from()
+        self.assertEqual(snapshot['students'][0]['helping_staff_name'], other_ta.nickname)
+        await socket.disconnect()
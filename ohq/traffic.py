@@ -0,0 +1,60 @@
+"""
+Opt-in recording and replay of inbound WebSocket traffic.
+
+When settings.OHQ_TRAFFIC_LOG names a file, every action either consumer
+receives (plus connects and disconnects) is appended to it as one compact
+JSON array per line:
+
+    [unix time, consumer, queue id, anonymized account, action, payload bytes]
+
+`manage.py replay_traffic <file>` plays a recording back against the ASGI
+application at 1x or accelerated speed (see ohq.loadtest.TrafficReplay).
+"""
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+from django.conf import settings
+
+QUEUE_CONSUMER = 'queue'
+QUEUE_LIST_CONSUMER = 'queue-list'
+
+STAFF_ACTIONS = {'help', 'freeze', 'finish-help', 'toggle-queue', 'send-announcement', 'freeze-all',
+                 'batch-help', 'batch-freeze', 'batch-unfreeze', 'batch-finish', 'clear-queue'}
+
+_lock = threading.Lock()
+_log = None
+
+
+def anonymize(account_id):
+    # stable within a deployment (keyed by SECRET_KEY), meaningless outside it
+    digest = hmac.new(settings.SECRET_KEY.encode(), str(account_id).encode(), hashlib.sha256)
+    return digest.hexdigest()[:10]
+
+
+def record(consumer, queue_id, account, action, size=0):
+    global _log
+    path = getattr(settings, 'OHQ_TRAFFIC_LOG', None)
+    if not path:
+        return
+    line = json.dumps([round(time.time(), 3), consumer, queue_id,
+                       anonymize(account.id) if account else None, action, size],
+                      separators=(',', ':'))
+    with _lock:
+        if _log is None:
+            # line buffered and opened for append: each line is a single write
+            _log = open(path, 'a', buffering=1)
+        _log.write(line + '\n')
+
+
+def load_trace(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    events.sort(key=lambda event: event[0])
+    return events
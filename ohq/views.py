@@ -1,8 +1,10 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from ohq.models import Account, Queue, AccountEntry, QueueHistory
+from ohq.models import Account, Queue, AccountEntry, QueueHistory, QueueRollup
 from ohq.forms import EditAccountForm, CreateQueueForm 
+from ohq import access, caches, exports, livestate, presence, profiling, snapshots, tasks
+from ohq.consumers import QueueConsumer, QueueListConsumer
 
 from django.urls import reverse_lazy, reverse
 from allauth.account.views import EmailView
@@ -10,8 +12,7 @@ from allauth.account.forms import AddEmailForm
 from allauth.account.models import EmailAddress
 from allauth.socialaccount.models import SocialAccount
 
-from django.http import JsonResponse, HttpResponseForbidden, HttpResponseBadRequest
-from django.db.models import Q
+from django.http import JsonResponse, HttpResponseForbidden, HttpResponseBadRequest, StreamingHttpResponse, FileResponse, Http404
 import json
 from ohq.forms import EditAccountForm
 from datetime import datetime
@@ -24,14 +25,25 @@ def index(request):
 @login_required
 def queue_list_action(request):
     print('/queue_list_action')
-    _create_debug_queues()
     context = dict()
     account = get_object_or_404(Account, user=request.user)
     context['DEBUG'] = settings.DEBUG
     context['account'] = account 
     context['error'] = request.GET.get('error', None)
+    context['has_staff_queues'] = account.staff.exists()
     return render(request, 'ohq/home.html', context)
 
+# One page for staff covering several queues, all over a single multiplexed socket
+@login_required
+def staff_dashboard_action(request):
+    print('/staff_dashboard_action')
+    account = get_object_or_404(Account, user=request.user)
+    context = dict()
+    context['account'] = account
+    context['queues'] = account.staff.order_by('courseNumber', 'queueName')
+    context['DEBUG'] = settings.DEBUG
+    return render(request, 'ohq/staff-dashboard.html', context)
+
 @login_required
 def queue_action(request, id):
     print('/queue_action')
@@ -47,10 +59,10 @@ def queue_action(request, id):
         return redirect(redirect_url)
 
     # Check if user is staff for this queue or a site admin
-    is_staff = queue.allowedStaff.filter(id=account.id).exists() or account.isAdmin or request.user.is_superuser
+    roles = access.get(account)
+    is_staff = roles.is_staff(queue.id)
 
-    if (not queue.isPublic and not (queue.allowedStudents.filter(id=account.id).exists()
-                                    or is_staff)):
+    if not roles.can_view(queue):
         url = reverse('queue-list')
         query_params = urlencode({'error': "You do not have permission to access this queue."})
         redirect_url = f"{url}?{query_params}"
@@ -64,8 +76,12 @@ def queue_action(request, id):
     context['description'] = queue.description
     context['DEBUG'] = settings.DEBUG
     context['is_staff'] = is_staff
+    if is_staff:
+        context['staff'] = queue.get_staff() # who students can be assigned to
     context['is_admin'] = account.isAdmin or request.user.is_superuser
     context['account'] = account 
+    # the page shows the queue straight away and the socket picks up from this version
+    context['snapshot'] = snapshots.get(queue.id)
 
     # keep track of user's recently viewed queues
     try:
@@ -80,6 +96,67 @@ def queue_action(request, id):
     qh.save()
     return render(request, 'ohq/student-queue.html', context)
 
+# Wait/help statistics for a queue, rendered from the precomputed rollups
+@login_required
+def queue_analytics_action(request, id):
+    print('/queue_analytics_action')
+
+    queue = get_object_or_404(Queue, id=id)
+    account = get_object_or_404(Account, user=request.user)
+
+    # Authorization: only queue staff and site admins can see analytics
+    is_staff = access.get(account).is_staff(queue.id)
+    if not is_staff:
+        return redirect('queue', id=id)
+
+    context = {
+        'queue': queue,
+        'account': account,
+        'DEBUG': settings.DEBUG,
+        'hourly': [_format_rollup(r) for r in QueueRollup.get_recent(queue.id, QueueRollup.GRANULARITY_HOUR, 24)],
+        'daily': [_format_rollup(r) for r in QueueRollup.get_recent(queue.id, QueueRollup.GRANULARITY_DAY, 30)],
+        'connections': presence.gauge(QueueConsumer.group_name + f'_{queue.id}'),
+        'conflicts': livestate.conflict_stats(queue.id),
+    }
+    return render(request, 'ohq/queue-analytics.html', context)
+
+# Streams a queue's help sessions, history or roster as CSV or NDJSON
+@login_required
+def queue_export_action(request, id, dataset):
+    print('/queue_export_action')
+
+    queue = get_object_or_404(Queue, id=id)
+    account = get_object_or_404(Account, user=request.user)
+
+    # Authorization: only queue staff and site admins can export
+    is_staff = access.get(account).is_staff(queue.id)
+    if not is_staff:
+        return HttpResponseForbidden(json.dumps({'error': 'Not authorized.'}), content_type='application/json')
+
+    fmt = request.GET.get('format', exports.FORMAT_CSV)
+    if dataset not in exports.DATASETS:
+        raise Http404(f'Unknown export "{dataset}"')
+    if fmt not in exports.CONTENT_TYPES:
+        return HttpResponseBadRequest(json.dumps({'error': f'Unknown format "{fmt}"'}), content_type='application/json')
+
+    response = StreamingHttpResponse(exports.stream(queue.id, dataset, fmt), content_type=exports.CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="queue-{queue.id}-{dataset}.{fmt}"'
+    return response
+
+def _format_rollup(rollup):
+    # seconds -> minutes for display; a missing p90 means it is past the last histogram bucket
+    def minutes(seconds, overflow='-'):
+        return f'{seconds / 60:.1f}' if seconds is not None else overflow
+    last_bound = QueueRollup.BUCKET_BOUNDS[-1] // 60
+    return {
+        'start': datetime.fromisoformat(rollup['start']),
+        'count': rollup['count'],
+        'meanWait': minutes(rollup['meanWait']),
+        'p90Wait': minutes(rollup['p90Wait'], f'> {last_bound}'),
+        'meanHelp': minutes(rollup['meanHelp']),
+        'p90Help': minutes(rollup['p90Help'], f'> {last_bound}'),
+    }
+
 # Configuring settings for a queue
 @login_required
 def queue_settings_action(request, id):
@@ -94,7 +171,12 @@ def queue_settings_action(request, id):
 
     if request.method == 'POST':
         if 'action_delete_queue' in request.POST:
-            queue.delete()
+            # the delete cascades through all of the queue's history, so it runs
+            # as a task; nobody can join in the meantime
+            queue.isOpen = False
+            queue.save()
+            tasks.enqueue('delete-queue', account=account, queue_id=queue.id,
+                          **QueueListConsumer.task_reply(account.id))
             # Redirect to the homepage (queue list) after deletion.
             return redirect('queue-list')
 
@@ -107,6 +189,7 @@ def queue_settings_action(request, id):
 
     context = {
         'queue': queue,
+        'page_version': caches.get_queue_page_version(queue.id), # the rosters are cached under it
         'current_staff': current_staff, 
         'DEBUG': settings.DEBUG,
         'account': account,
@@ -202,27 +285,24 @@ def user_search_api(request, id):
     if not query_str:
         return JsonResponse([], safe=False) # Return empty list if no query
 
+    # the page version changes with the queue's roster
+    page_version = caches.get_queue_page_version(queue.id)
     if staff_lookup:
         # Find accounts matching query that are NOT already staff
-        results = Account.objects.filter(
-            Q(nickname__icontains=query_str) | Q(email__icontains=query_str)
-        ).exclude(
-            staff__id=queue.id
-        ).values(
-            'id', 'nickname', 'email', 'isAdmin' 
-        )[:10] # Limit to 10 results
+        results = caches.search_accounts(
+            ('staff', queue.id, page_version), query_str,
+            Account.objects.exclude(staff__id=queue.id),
+            ('id', 'nickname', 'email', 'isAdmin')
+        )
     else:
         # Find accounts matching query that are NOT already permitted to look at queue
-        results = Account.objects.filter(
-            Q(nickname__icontains=query_str) | Q(email__icontains=query_str)
-        ).exclude(
-            students__id=queue.id
-        ).values(
-            'id', 'nickname', 'email', 'isAdmin' 
-        )[:10] # Limit to 10 results
-
+        results = caches.search_accounts(
+            ('students', queue.id, page_version), query_str,
+            Account.objects.exclude(students__id=queue.id),
+            ('id', 'nickname', 'email', 'isAdmin')
+        )
 
-    return JsonResponse(list(results), safe=False)
+    return JsonResponse(results, safe=False)
 
 # --- API View for Managing Staff ---
 @login_required
@@ -247,19 +327,16 @@ def manage_queue_staff_api(request, id):
 
         queue = get_object_or_404(Queue, id=id)
         account_to_manage = get_object_or_404(Account, id=account_id_to_manage)
+        task_id = None
 
         if action == 'add':
             queue.allowedStaff.add(account_to_manage)
         elif action == 'remove':
             queue.allowedStaff.remove(account_to_manage)
-            # removed staff can't be helping anyone
-            for entry in AccountEntry.objects.filter(helping_staff=account_to_manage, queue=queue):
-                entry.helping_staff = None
-                entry.status = AccountEntry.STATUS_WAITING
-                entry.save()
-            # or be on the queue if they aren't an allowed student.
-            if not (queue.allowedStudents.filter(id=account_to_manage.id)).exists():
-                AccountEntry.objects.filter(account=account_to_manage, queue=queue).delete()
+            # their entries on the queue are cleaned up in the background
+            task_id = tasks.enqueue('roster-removed', account=account, queue_id=queue.id,
+                                    account_id=account_to_manage.id, role='staff',
+                                    **QueueListConsumer.task_reply(account.id))
         elif action == 'toggle_admin':
             is_admin = data.get('is_admin')
             if is_admin is None:
@@ -271,7 +348,7 @@ def manage_queue_staff_api(request, id):
             raise ValueError('Invalid action')
         queue.save()
 
-        return JsonResponse({'status': 'ok'})
+        return JsonResponse({'status': 'ok', 'taskID': task_id})
 
     except Exception as e:
         return HttpResponseBadRequest(json.dumps({'error': str(e)}), content_type='application/json')
@@ -324,25 +401,40 @@ def manage_queue_students_api(request, id):
 
         queue = get_object_or_404(Queue, id=id)
         account_to_manage = get_object_or_404(Account, id=account_id_to_manage)
+        task_id = None
 
         if action == 'add':
             queue.allowedStudents.add(account_to_manage)
         elif action == 'remove':
             queue.allowedStudents.remove(account_to_manage)
-            # student should no longer be on queue for this course
-            # unless they're staff still
-            if not (queue.allowedStaff.filter(id=account_to_manage.id)).exists():
-                AccountEntry.objects.filter(account=account_to_manage, queue=queue).delete()
+            # their entry on the queue is cleaned up in the background
+            task_id = tasks.enqueue('roster-removed', account=account, queue_id=queue.id,
+                                    account_id=account_to_manage.id, role='student',
+                                    **QueueListConsumer.task_reply(account.id))
         else:
             raise ValueError('Invalid action')
 
         queue.save()
 
-        return JsonResponse({'status': 'ok'})
+        return JsonResponse({'status': 'ok', 'taskID': task_id})
 
     except Exception as e:
         return HttpResponseBadRequest(json.dumps({'error': str(e)}), content_type='application/json')
 
+# Progress of a background task started by one of the views above
+@login_required
+def task_status_api(request, task_id):
+    print('/task_status_api')
+
+    account = get_object_or_404(Account, user=request.user)
+    status = tasks.status(task_id)
+    if status is None:
+        return JsonResponse({'error': 'Unknown task.'}, status=404)
+    # Authorization: whoever started the task, or a site admin
+    if status['accountID'] != account.id and not (account.isAdmin or request.user.is_superuser):
+        return HttpResponseForbidden(json.dumps({'error': 'Not authorized.'}), content_type='application/json')
+    return JsonResponse(status)
+
 # --- START: Site Admin Views ---
 @login_required
 def site_settings_action(request):
@@ -364,6 +456,34 @@ def site_settings_action(request):
     return render(request, 'ohq/site-settings.html', context)
 
 
+# The slowest profiles captured (see ohq/profiling.py), and one of them in detail
+@login_required
+def site_profiles_action(request):
+    print('/site_profiles_action')
+    account = get_object_or_404(Account, user=request.user)
+
+    # Authorization: Only site admins or superusers can access this page
+    if not (account.isAdmin or request.user.is_superuser):
+        return redirect('queue-list') # Redirect non-authorized
+
+    context = {
+        'account': account,
+        'traces': profiling.slowest(),
+        'sample_rate': settings.OHQ_PROFILE_SAMPLE_RATE,
+        'DEBUG': settings.DEBUG,
+    }
+    name = request.GET.get('trace')
+    if name:
+        path = profiling.path(name)
+        if path is None:
+            raise Http404(f'No profile "{name}"')
+        if request.GET.get('download'):
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
+        context['selected'] = name
+        context['report'] = profiling.report(name)
+    return render(request, 'ohq/site-profiles.html', context)
+
+
 @login_required
 def site_search_api(request):
     print('/api_site_search_users')
@@ -379,15 +499,13 @@ def site_search_api(request):
         return JsonResponse([], safe=False) # Return empty list if no query
 
     # Find accounts matching query that are NOT already admins
-    results = Account.objects.filter(
-        Q(nickname__icontains=query_str) | Q(email__icontains=query_str)
-    ).exclude(
-        isAdmin=True
-    ).values(
-        'id', 'nickname', 'email'
-    )[:10] # Limit to 10 results
+    results = caches.search_accounts(
+        ('admins',), query_str,
+        Account.objects.exclude(isAdmin=True),
+        ('id', 'nickname', 'email')
+    )
 
-    return JsonResponse(list(results), safe=False)
+    return JsonResponse(results, safe=False)
 
 
 @login_required
@@ -420,33 +538,9 @@ def manage_site_admin_api(request):
             raise ValueError('Invalid action')
         
         account_to_manage.save()
+        # their home page now shows (or no longer shows) every queue
+        QueueListConsumer.notify([QueueListConsumer.account_group(account_to_manage.id)], {'type': 'queue_add'})
         return JsonResponse({'status': 'ok'})
 
     except Exception as e:
         return HttpResponseBadRequest(json.dumps({'error': str(e)}), content_type='application/json')
-
-def _create_debug_queues():
-    # objects already exist. creating debug entry is unnecessary
-    if len(Queue.objects.all()) > 0:
-        return False
-    queue = Queue()
-    queue.queueName = "Web Application Development"
-    queue.courseNumber = '17437'
-    queue.description = "This is a test queue with a very very very very very very very very very very very very long description"
-    queue.save()
-
-    queue2 = Queue()
-    queue2.queueName = "Foundations of Software Engineering"
-    queue2.courseNumber = '17313'
-    queue2.description = "See Piazza for OH rules"
-    queue2.save()
-    
-    queue3 = Queue()
-    queue3.queueName = "Principles of Imperative Computation"
-    queue3.courseNumber = '15122'
-    queue3.save()
-
-    queue4 = Queue()
-    queue4.queueName = "Distributed Systems"
-    queue4.courseNumber = '15440'
-    queue4.save()
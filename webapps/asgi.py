@@ -9,22 +9,33 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapps.settings')
 
 application = get_asgi_application()
 
 import ohq.routing
+from ohq import maintenance, tasks
+from ohq.auth import CachedAuthMiddlewareStack
+
+# every server process competes to be the one that runs periodic maintenance
+maintenance.start()
 
 application = ProtocolTypeRouter({
-    "http": application,
-    # urls.py routes for http are added by default
-    'websocket': AuthMiddlewareStack(
+    # Server-Sent Events streams, then everything else (urls.py)
+    "http": URLRouter(
+        ohq.routing.http_urlpatterns + [re_path(r'', application)]
+    ),
+    'websocket': CachedAuthMiddlewareStack(
         URLRouter(
             ohq.routing.websocket_urlpatterns
         )
     ),
+    # background tasks, run by `manage.py runworker ohq-tasks` (OHQ_TASK_WORKER)
+    'channel': ChannelNameRouter({
+        tasks.TASK_CHANNEL: tasks.TaskConsumer.as_asgi(),
+    }),
 })
\ No newline at end of file
@@ -72,6 +72,58 @@ else:
         },
     }
 
+# Cache (Redis for Production, In-Memory for Local). Holds small shared
+# per-queue state such as wait-time estimates, so it must be shared across
+# workers in production.
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get('REDIS_URL'),
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
+# Sessions are read through the cache (Redis in production) so socket
+# handshakes don't hit the session table
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Admission control for new sockets, per worker process (see ohq/ratelimit.py):
+# connects per second for the whole worker, and for any single queue
+OHQ_CONNECT_RATE = float(os.environ.get('OHQ_CONNECT_RATE', 50))
+OHQ_QUEUE_CONNECT_RATE = float(os.environ.get('OHQ_QUEUE_CONNECT_RATE', 20))
+
+# Background tasks each worker process runs at once (see ohq/tasks.py)
+OHQ_TASK_CONCURRENCY = int(os.environ.get('OHQ_TASK_CONCURRENCY', 4))
+# Set to True only when `manage.py runworker ohq-tasks` runs next to the web
+# processes (needs REDIS_URL); otherwise tasks run in the web processes
+OHQ_TASK_WORKER = os.environ.get('OHQ_TASK_WORKER', '') == 'True'
+
+# Where open queues' entries live (see ohq/livestate.py): unset reads and
+# writes the database directly; 'memory' keeps them in this process (a single
+# worker only); 'redis' keeps them in REDIS_URL. Both write the database behind.
+OHQ_LIVE_STATE = os.environ.get('OHQ_LIVE_STATE', '')
+
+# Redis used directly (not through the cache) by the live-state store and
+# the maintenance leader's lock; unset when running without Redis
+OHQ_REDIS_URL = os.environ.get('REDIS_URL')
+
+# Append every inbound WebSocket action to this file for later replay
+# with `manage.py replay_traffic` (disabled when unset)
+OHQ_TRAFFIC_LOG = os.environ.get('OHQ_TRAFFIC_LOG')
+
+# Profiling (see ohq/profiling.py): site admins profile a request with
+# ?profile=1; the sample rate profiles that fraction of every request and
+# socket message. Only the newest OHQ_PROFILE_KEEP profiles are kept.
+OHQ_PROFILE_DIR = os.environ.get('OHQ_PROFILE_DIR', str(BASE_DIR / 'profiles'))
+OHQ_PROFILE_SAMPLE_RATE = float(os.environ.get('OHQ_PROFILE_SAMPLE_RATE', 0))
+OHQ_PROFILE_KEEP = int(os.environ.get('OHQ_PROFILE_KEEP', 200))
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware', # <-- Added Whitenoise for static file serving
@@ -82,6 +134,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "allauth.account.middleware.AccountMiddleware", # <-- Added for allauth
+    'ohq.profiling.ProfilingMiddleware', # after auth: admins can ask for a profile
 ]
 
 ROOT_URLCONF = 'webapps.urls'
@@ -28,9 +28,13 @@ urlpatterns = [
     path('', views.queue_list_action, name = 'queue-list'), # list of all queues
     path('queue/create', views.queue_create_action, name='queue-create'), # <-- New URL
     path('queue/<int:id>', views.queue_action, name = 'queue'), # individual queue view
+    path('dashboard', views.staff_dashboard_action, name = 'staff-dashboard'), # every queue the user staffs on one page
     path('settings/queue/<int:id>', views.queue_settings_action, name = 'queue-settings'), # settings for an individual queue
+    path('queue/<int:id>/analytics', views.queue_analytics_action, name = 'queue-analytics'), # wait/help statistics for a queue
+    path('queue/<int:id>/export/<str:dataset>', views.queue_export_action, name = 'queue-export'), # streamed CSV/NDJSON exports
 
     path('settings/site', views.site_settings_action, name='site-settings'),
+    path('settings/site/profiles', views.site_profiles_action, name='site-profiles'), # slowest profiled requests and socket messages
     path('api/site/search_users', views.site_search_api, name='api-site-search-users'),
     path('api/site/manage_admin', views.manage_site_admin_api, name='api-site-manage-admin'),
 
@@ -39,6 +43,7 @@ urlpatterns = [
 
     path('api/queue/<int:id>/toggle_queue_visibility', views.toggle_queue_visibility_api, name='api-queue-visibility'),
     path('api/queue/<int:id>/manage_student', views.manage_queue_students_api, name='api-manage-student'),
+    path('api/task/<str:task_id>', views.task_status_api, name='api-task-status'),
 
     # This is the new, unified control panel.
     path('accounts/', views.user_control_panel, name='user-control-panel'),